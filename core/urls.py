@@ -7,12 +7,16 @@ from marketdata.views import (
     PositionsSnapshotView,
     SimFillView,
     ClosePositionView,
+    CloseAllPositionsView,
+    BulkOrderView,
     OrderListView,
     FillListView,
     MarginCheckView,
     ExitPositionAPIView,
     CapitalView,
-    OrderHistoryView
+    BalanceAtView,
+    OrderHistoryView,
+    TickRangeView,
 )
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.conf import settings
@@ -36,13 +40,17 @@ urlpatterns = [
     path("health", health),
     path("api/candles", candles),
     path("api/orders", OrderListView.as_view()),
+    path("api/orders/bulk", BulkOrderView.as_view()),
     path("api/fills", FillListView.as_view()),
     path('api/orderhistory/', OrderHistoryView.as_view(), name='order-history'),
     path("api/symbols", symbols),
+    path("api/ticks", TickRangeView.as_view(), name="ticks"),
     path('api/capital/', CapitalView.as_view(), name='capital'),
+    path("api/balance_at", BalanceAtView.as_view(), name="balance-at"),
     path("api/positions/snapshot", PositionsSnapshotView.as_view()),
     path("api/sim/fill", SimFillView.as_view()),
     path("api/positions/close", ClosePositionView.as_view()),
+    path("api/positions/close_all", CloseAllPositionsView.as_view()),
     path("api/margin/check", MarginCheckView.as_view(), name="margin-check"),
     path("api/exit_position/", ExitPositionAPIView.as_view(), name='exit_position'),
     # JWT endpoints
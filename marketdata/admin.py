@@ -2,13 +2,14 @@
 from django.contrib import admin, messages
 from django.utils import timezone
 
-from .models import Order, Fill, LedgerEntry, PositionSnapshot, UserAccount
+from .models import Order, Fill, LedgerEntry, PositionSnapshot, UserAccount, ClosedTrade, BackgroundJob
 from .models_admintrades import (
     AdminBroadcastTrade,
     UserTradeGroup,
     AdminTradeApplication,
 )
-from .services.admin_broadcast_trades import User, apply_closed_admin_trade_on_save
+from .services.admin_broadcast_trades import User
+from .services.jobs import enqueue_admin_trade_apply, enqueue_admin_trade_mirror_open
 from .admin_kyc import *
 from django.contrib import admin, messages
 from django.db import transaction
@@ -43,12 +44,36 @@ class FillAdmin(admin.ModelAdmin):
     autocomplete_fields = ("order",)
 
 
+@admin.action(description="Delete selected and reverse their balance effect", permissions=["delete"])
+def delete_with_reversal(modeladmin, request, queryset):
+    n = queryset.delete_with_reversal()
+    messages.success(request, f"Deleted {n} ledger entr{'y' if n == 1 else 'ies'}; balances reversed.")
+
+
 @admin.register(LedgerEntry)
 class LedgerEntryAdmin(admin.ModelAdmin):
     list_display = ("id", "user_id", "symbol", "kind", "amount", "ref")
     list_filter = ("kind", "symbol")
     search_fields = ("ref", "symbol", "user_id")
     ordering = ("-id",)
+    actions = [delete_with_reversal]
+
+    def get_actions(self, request):
+        # the stock bulk delete reverses balances one locked row at a time
+        actions = super().get_actions(request)
+        actions.pop("delete_selected", None)
+        return actions
+
+
+@admin.register(ClosedTrade)
+class ClosedTradeAdmin(admin.ModelAdmin):
+    list_display = (
+        "id", "position_id", "user_id", "symbol", "side", "lots",
+        "entry_price", "exit_price", "realized_pnl", "closed_at",
+    )
+    list_filter = ("symbol", "side")
+    search_fields = ("position_id", "user_id")
+    ordering = ("-closed_at",)
 
 
 @admin.register(PositionSnapshot)
@@ -72,31 +97,29 @@ class AdminTradeApplicationInline(admin.TabularInline):
 
 @admin.action(description="Set selected trades LIVE (opened_at=now)")
 def set_live(modeladmin, request, queryset):
+    mirrored = list(queryset.exclude(status="closed").filter(mirror_positions=True).values_list("id", flat=True))
     n = queryset.exclude(status="closed").update(
         status="live",
         opened_at=timezone.now()
     )
-    messages.success(request, f"{n} trade(s) set LIVE.")
+    for trade_id in mirrored:
+        enqueue_admin_trade_mirror_open(trade_id)
+    messages.success(request, f"{n} trade(s) set LIVE." + (
+        f" Opening mirrored positions for {len(mirrored)} trade(s)." if mirrored else ""
+    ))
 
 
-@admin.action(description="Close & Apply now (affects capital; skips low capital)")
+@admin.action(description="Close & Apply (queued; affects capital; skips low capital)")
 def close_and_apply(modeladmin, request, queryset):
-    applied_total = skipped_total = 0
+    queued = 0
     for t in queryset:
         # Ensure it has the required fields
         if not (t.entry_price and t.exit_price and t.lots and t.side and t.symbol):
             messages.warning(request, f"Trade {t.ref}: missing fields (entry/exit/lots/side/symbol). Skipped.")
             continue
-        try:
-            res = apply_closed_admin_trade_on_save(t.id)
-            applied_total += res.get("applied", 0)
-            skipped_total += res.get("skipped", 0)
-        except Exception as e:
-            messages.error(request, f"Trade {t.ref}: error applying — {e}")
-    messages.info(
-        request,
-        f"Applied to {applied_total} user(s); skipped {skipped_total} (insufficient capital)."
-    )
+        job, created = enqueue_admin_trade_apply(t.id)
+        queued += created
+    messages.info(request, f"Queued {queued} trade application(s); progress under Background jobs.")
 
 
 @admin.register(AdminBroadcastTrade)
@@ -104,12 +127,13 @@ class AdminBroadcastTradeAdmin(admin.ModelAdmin):
     list_display = (
         "ref", "symbol", "side", "lots",
         "entry_price", "exit_price", "leverage",
-        "status", "opened_at", "closed_at",
+        "status", "mirror_positions", "opened_at", "closed_at",
     )
-    list_filter = ("status", "symbol", "side", "leverage")
+    list_filter = ("status", "symbol", "side", "leverage", "mirror_positions")
     search_fields = ("ref", "symbol", "notes")
     filter_horizontal = ("groups",)
     ordering = ("-closed_at", "-opened_at", "-id")
+    actions = [set_live, close_and_apply]
 
     # Don't apply here (M2M not saved yet)
     def save_model(self, request, obj, form, change):
@@ -119,16 +143,35 @@ class AdminBroadcastTradeAdmin(admin.ModelAdmin):
     def save_related(self, request, form, formsets, change):
         super().save_related(request, form, formsets, change)
         obj = form.instance
-        if obj.entry_price and obj.exit_price and obj.lots and obj.side and obj.symbol:
-            try:
-                res = apply_closed_admin_trade_on_save(obj.id)
-                messages.info(
-                    request,
-                    f"Admin Trade applied. Success: {res['applied']}, "
-                    f"Skipped (insufficient capital): {res['skipped']}."
-                )
-            except Exception as e:
-                messages.error(request, f"Error applying trade {obj.ref}: {e}")
+        if obj.mirror_positions and obj.status == "live" and not obj.exit_price:
+            # mirrored positions are opened by a run_jobs worker in one fan-out per chunk
+            job, created = enqueue_admin_trade_mirror_open(obj.id)
+            messages.info(request, f"Opening mirrored positions as job #{job.id}.")
+        elif obj.entry_price and obj.exit_price and obj.lots and obj.side and obj.symbol:
+            # applied by a run_jobs worker in chunks; the request returns right away
+            job, created = enqueue_admin_trade_apply(obj.id)
+            messages.info(
+                request,
+                f"Admin Trade queued as job #{job.id} for {job.progress_total or 0} user(s)."
+                if created else f"Admin Trade is already being applied (job #{job.id})."
+            )
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "key", "status", "progress", "attempts", "worker",
+                    "created_at", "heartbeat_at", "finished_at")
+    list_filter = ("status", "kind")
+    search_fields = ("key",)
+    ordering = ("-id",)
+    readonly_fields = ("kind", "key", "payload", "status", "progress_done", "progress_total", "result",
+                       "error", "attempts", "worker", "created_at", "started_at", "heartbeat_at", "finished_at")
+
+    @admin.display(description="Progress")
+    def progress(self, obj):
+        if obj.progress_total:
+            return f"{obj.progress_done}/{obj.progress_total} ({100 * obj.progress_done // obj.progress_total}%)"
+        return str(obj.progress_done)
 
 
 
@@ -208,6 +251,8 @@ class WithdrawalRequestAdmin(admin.ModelAdmin):
                     return
                 ua.balance = ua.balance - obj.amount
                 ua.save(update_fields=["balance"])
+                LedgerEntry.objects.create(user_id=obj.user_id, kind="withdrawal",
+                                           amount=obj.amount, ref=f"withdrawal:{obj.pk}")
                 obj.status = WithdrawalRequest.Status.APPROVED
                 obj.reviewed_by = request.user
                 super().save_model(request, obj, form, change)
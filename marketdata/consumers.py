@@ -2,6 +2,7 @@
 
 import os
 import json
+import logging
 import threading
 import time
 import ssl
@@ -10,8 +11,10 @@ import websocket
 from django.conf import settings
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from .streams.user_ws import UserStream, CapitalConsumer
+from .streams.candles import aggregator as candle_aggregator, candle_group, forming_bar, INTERVAL_SECONDS
+from .history.tick_store import recorder as tick_recorder
 
 
 # Redis: publish ticks and cache latest marks
@@ -23,13 +26,51 @@ from django.urls import re_path
 from django_channels_jwt_auth_middleware.auth import JWTAuthMiddlewareStack
 from .streams.user_ws import UserStream  # ensure this file exists
 
+logger = logging.getLogger(__name__)
+
 HEARTBEAT_SEC = 20
 _symbol_threads = {}
 
+# run_market_feed refreshes this while it runs; workers use it to tell whether to start the feed
+FEED_ALIVE_KEY = "feed:alive"
+FEED_ALIVE_TTL = 30
+_feed_missing_logged = 0.0
+
 # Add BTCUSDT for weekend testing
 SUPPORTED_SYMBOLS = ["EURUSD", "GBPUSD", "USDJPY", "AUDUSD", "USDCAD", "BTCUSDT", "XAUUSD", "NZDUSD"]
 
 
+def _ensure_feed():
+    """
+    The Alltick feed (tick publish, tick history, candle aggregation) must run
+    exactly once. With several ASGI workers run `run_market_feed` and set
+    MARKET_FEED_IN_WORKERS=False. By default (True, the behaviour before
+    run_market_feed existed) the first quote/candle connection starts it inside
+    the worker, unless a run_market_feed process is alive.
+    """
+    global _feed_missing_logged
+    if "alltick" in _symbol_threads:
+        return
+    try:
+        feed_running = bool(r.exists(FEED_ALIVE_KEY))
+    except Exception:
+        feed_running = False
+    if feed_running:
+        return
+    if not getattr(settings, "MARKET_FEED_IN_WORKERS", True):
+        now = time.monotonic()
+        if now - _feed_missing_logged >= 60:
+            _feed_missing_logged = now
+            logger.error("MARKET_FEED_IN_WORKERS is off but no run_market_feed process is alive: "
+                         "quotes, marks and candles are not updating")
+        return
+    logger.warning("starting the Alltick feed inside this ASGI worker; with several workers run "
+                   "`manage.py run_market_feed` and set MARKET_FEED_IN_WORKERS=False")
+    t = threading.Thread(target=start_alltick_ws, daemon=True)
+    t.start()
+    _symbol_threads["alltick"] = t
+
+
 class QuoteConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.symbol = self.scope["url_route"]["kwargs"]["symbol"].upper()
@@ -37,10 +78,7 @@ class QuoteConsumer(AsyncJsonWebsocketConsumer):
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
         await self.send_json({"type": "status", "message": f"subscribing {self.symbol}"})
-        if "alltick" not in _symbol_threads:
-            t = threading.Thread(target=start_alltick_ws, daemon=True)
-            t.start()
-            _symbol_threads["alltick"] = t
+        _ensure_feed()
 
     async def disconnect(self, code):
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
@@ -52,6 +90,38 @@ class QuoteConsumer(AsyncJsonWebsocketConsumer):
             pass
 
 
+class CandleConsumer(AsyncJsonWebsocketConsumer):
+    """Live bars for one (symbol, interval), built from the same tick stream as QuoteConsumer."""
+
+    async def connect(self):
+        kwargs = self.scope["url_route"]["kwargs"]
+        self.symbol = kwargs["symbol"].upper()
+        self.interval = kwargs["interval"]
+        if self.interval not in INTERVAL_SECONDS:
+            await self.close()
+            return
+        self.group_name = candle_group(self.symbol, self.interval)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        _ensure_feed()
+
+        # Hand over the forming bar so the chart doesn't wait for the next tick
+        bar = await sync_to_async(forming_bar)(self.symbol, self.interval)
+        if bar:
+            await self.send_json({"type": "candle", "symbol": self.symbol, "interval": self.interval,
+                                  "final": False, **bar})
+
+    async def disconnect(self, code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def candle_update(self, event):
+        try:
+            await self.send_json({"type": "candle", **event["candle"]})
+        except Exception:
+            pass
+
+
 def start_alltick_ws():
     ws_url = f"{settings.ALLTICK_BASE_WS}?token={settings.ALLTICK_API_KEY}"
     channel_layer = get_channel_layer()
@@ -113,6 +183,16 @@ def start_alltick_ws():
             except Exception:
                 pass
 
+            # Append to the on-disk tick history (buffered, fixed-size records)
+            if getattr(settings, "TICK_RECORDER_ENABLED", True):
+                try:
+                    tick_recorder.record(symbol, int(d.get("tick_time", 0)), bid, ask)
+                except Exception:
+                    pass
+
+            # Feed live candle bars (pushes are conflated inside the aggregator)
+            candle_aggregator.on_tick(symbol, float(mid), int(d.get("tick_time", 0)) // 1000)
+
             tick = {
                 "type": "tick",
                 "symbol": symbol,
@@ -150,6 +230,7 @@ def start_alltick_ws():
 # WebSocket routes (public quotes, JWT-protected user stream)
 websocket_urlpatterns = [
     re_path(r"^ws/quotes/(?P<symbol>[A-Za-z0-9]+)/$", QuoteConsumer.as_asgi()),
+    re_path(r"^ws/candles/(?P<symbol>[A-Za-z0-9]+)/(?P<interval>[0-9]+[mhd])/$", CandleConsumer.as_asgi()),
     re_path(r"^ws/user/stream/$", JWTAuthMiddlewareStack(UserStream.as_asgi())),
     re_path(r"^ws/user/capital/$", JWTAuthMiddlewareStack(CapitalConsumer.as_asgi())),   #
 ]
@@ -0,0 +1,42 @@
+# marketdata/engine/capital.py
+"""
+Capital stream shared by run_margin_updater and the user WebSocket.
+
+The client gets a full `capital_snapshot` on connect (read from the hot
+risk:{uid} state) and then `capital_update` messages holding only the fields
+that changed, each numbered from capseq:{uid}. A client that sees a gap in
+`seq` sends {"type": "capital_resync"} for a fresh snapshot.
+"""
+from decimal import Decimal
+
+CAPITAL_FIELDS = ("balance", "equity", "used_margin", "free_margin", "unrealized_pnl")
+CHANGE_EPSILON = 1e-6
+
+
+def k_capseq(uid) -> str:
+    return f"capseq:{uid}"
+
+
+def capital_view(balance, used_margin, unrealized_pnl) -> dict:
+    balance = Decimal(str(balance or 0))
+    used_margin = Decimal(str(used_margin or 0))
+    unrealized_pnl = Decimal(str(unrealized_pnl or 0))
+    equity = balance + unrealized_pnl
+    return {
+        "balance": float(balance),
+        "equity": float(equity),
+        "used_margin": float(used_margin),
+        "free_margin": float(equity - used_margin),
+        "unrealized_pnl": float(unrealized_pnl),
+    }
+
+
+def capital_delta(previous: dict | None, current: dict) -> dict:
+    """Fields of `current` that differ from `previous` (all of them when there is none)."""
+    if not previous:
+        return dict(current)
+    changed = {}
+    for f in CAPITAL_FIELDS:
+        if f in current and (f not in previous or abs(current[f] - previous[f]) > CHANGE_EPSILON):
+            changed[f] = current[f]
+    return changed
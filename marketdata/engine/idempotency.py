@@ -0,0 +1,60 @@
+# marketdata/engine/idempotency.py
+"""
+Order idempotency keys in Redis.
+
+idem:{uid}:{client_id} holds "pending" while the first request is being
+processed (short TTL, so a crashed request doesn't block the key forever) and
+then the JSON response {"status", "body"} for IDEMPOTENCY_TTL. Retries are
+answered from that value with a single GET, before any margin check or netting.
+"""
+import json
+
+from django.conf import settings
+
+from marketdata.engine.redis_ops import get_redis
+
+PENDING = "pending"
+PENDING_TTL = 30           # seconds a claimed-but-unfinished key blocks retries
+IDEMPOTENCY_TTL = 86_400   # seconds a completed response is replayed
+
+
+def k_idem(uid, client_id) -> str:
+    return f"idem:{uid}:{client_id}"
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "ORDER_IDEMPOTENCY_TTL", IDEMPOTENCY_TTL))
+
+
+def _decode(raw):
+    if raw == PENDING:
+        return "pending", None
+    return "done", json.loads(raw)
+
+
+def claim(uid, client_id):
+    """
+    ("new", None) if this request owns the key and should do the work,
+    ("pending", None) if another request with the same key is in flight,
+    ("done", {"status", "body"}) with the original response otherwise.
+    """
+    r = get_redis()
+    key = k_idem(uid, client_id)
+    raw = r.get(key)
+    if raw is not None:
+        return _decode(raw)
+    if r.set(key, PENDING, nx=True, ex=PENDING_TTL):
+        return "new", None
+    raw = r.get(key)  # lost the race to a concurrent retry
+    return _decode(raw) if raw is not None else ("pending", None)
+
+
+def complete(uid, client_id, status_code: int, body) -> None:
+    """Store the response to replay for retries."""
+    value = json.dumps({"status": status_code, "body": body}, default=str)
+    get_redis().set(k_idem(uid, client_id), value, ex=_ttl())
+
+
+def release(uid, client_id) -> None:
+    """Forget a claim whose request was rejected or failed, so the client may retry."""
+    get_redis().delete(k_idem(uid, client_id))
@@ -0,0 +1,259 @@
+# marketdata/engine/journal.py
+"""
+Fill journal: every fill is appended to the `journal:fills` Redis Stream in the
+same MULTI as its position update, and `run_fill_persister` drains the stream
+into Postgres in batches (Order, Fill, PositionSnapshot, LedgerEntry and the
+balance booking). Events carry their own id, stored on the unique
+Fill.event_id, so a redelivered event is skipped instead of booked twice, also
+when it reuses an existing client_id order. A fill that takes a position flat
+carries a "closed_trade" summary and also gets its ClosedTrade row.
+
+An event that keeps failing is moved to `journal:fills:dead` after
+MAX_DELIVERIES attempts instead of blocking the rest of its batch. Database
+outages (is_transient) never count: those events stay pending until Postgres
+is back. `requeue_dead_fills` puts dead-lettered events back on the journal.
+The stream is trimmed by the persister, only below what the group has
+acknowledged.
+"""
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_STREAM = "journal:fills"
+JOURNAL_GROUP = "persister"
+DEAD_LETTER_STREAM = "journal:fills:dead"
+MAX_DELIVERIES = 5  # attempts before an event is dead-lettered
+
+
+def is_transient(error: Exception) -> bool:
+    """Connection-level database errors: retry later, never dead-letter."""
+    return isinstance(error, (OperationalError, InterfaceError))
+
+
+def journal_enabled() -> bool:
+    return getattr(settings, "FILL_JOURNAL_ENABLED", True)
+
+
+def new_fill_event(user_id, symbol, side, lots, price, leverage, client_id=None,
+                   order_type="market") -> dict:
+    """Event skeleton; apply_fill_netting fills in position_id/realized/new_net/new_avg."""
+    return {
+        "eid": uuid.uuid4().hex,
+        "user_id": int(user_id),
+        "symbol": symbol.upper(),
+        "side": side,
+        "lots": str(abs(Decimal(str(lots)))),
+        "price": str(Decimal(str(price))),
+        "leverage": int(leverage),
+        "client_id": client_id,
+        "type": order_type,
+        "ts": time.time(),
+    }
+
+
+def journal_fill(client, event: dict) -> None:
+    """Queue the XADD on a pipeline (or run it on a client)."""
+    client.xadd(JOURNAL_STREAM, {"data": json.dumps(event, default=str)})
+
+
+def trim_journal(r) -> None:
+    """Drop entries below the group's oldest unacked (or last delivered) id; never an unacked one."""
+    groups = {g["name"]: g for g in r.xinfo_groups(JOURNAL_STREAM)}
+    group = groups.get(JOURNAL_GROUP)
+    if group is None:
+        return
+    pending = r.xpending(JOURNAL_STREAM, JOURNAL_GROUP)
+    floor = pending["min"] if pending["pending"] else group["last-delivered-id"]
+    if floor and floor != "0-0":
+        r.xtrim(JOURNAL_STREAM, minid=floor, approximate=True)
+
+
+def requeue_dead_letters(r, ids=None, count: int = 1000) -> int:
+    """
+    Move dead-lettered events back onto the journal, the given stream ids or the
+    oldest `count`. Each move is one MULTI (XADD + XDEL); events already booked
+    are skipped by the persister on their event id. Returns events moved.
+    """
+    if ids:
+        entries = [e for sid in ids for e in r.xrange(DEAD_LETTER_STREAM, min=sid, max=sid)]
+    else:
+        entries = r.xrange(DEAD_LETTER_STREAM, count=count)
+    for sid, fields in entries:
+        with r.pipeline() as p:
+            p.xadd(JOURNAL_STREAM, {"data": fields["data"]})
+            p.xdel(DEAD_LETTER_STREAM, sid)
+            p.execute()
+    return len(entries)
+
+
+def decode_entries(entries) -> list:
+    """XREADGROUP/XAUTOCLAIM entries -> [(stream_id, event)]."""
+    out = []
+    for stream_id, fields in entries:
+        if not fields:
+            continue  # deleted entry still listed in the PEL
+        out.append((stream_id, json.loads(fields["data"])))
+    return out
+
+
+def _dt(epoch):
+    return datetime.fromtimestamp(float(epoch), tz=timezone.utc) if epoch else None
+
+
+def closed_trade_row(user_id, position_id, symbol, ct: dict, closed_ts, close_fill_id=None):
+    """ClosedTrade (unsaved) from the closed_trade dict apply_fill_netting puts on a closing fill."""
+    from marketdata.models import ClosedTrade
+    q = Decimal("0.000001")
+    return ClosedTrade(
+        user_id=int(user_id),
+        position_id=str(position_id),
+        symbol=symbol,
+        side=ct["side"],
+        lots=Decimal(str(ct["lots"])).quantize(q),
+        entry_price=Decimal(str(ct["entry_price"])).quantize(q),
+        exit_price=Decimal(str(ct["exit_price"])).quantize(q),
+        realized_pnl=Decimal(str(ct["realized"])).quantize(Decimal("0.00000001")),
+        opened_at=_dt(ct.get("open_time")),
+        closed_at=_dt(closed_ts),
+        close_fill_id=close_fill_id,
+    )
+
+
+def _clear_pending(events) -> None:
+    """
+    Booked (now or by an earlier delivery): the risk seed no longer needs to add
+    the event's realized P&L. Best effort: the seed also skips booked fills.
+    """
+    from marketdata.engine.risk import clear_pending_realized
+    try:
+        clear_pending_realized(events)
+    except Exception as e:
+        logger.warning("could not clear pending realized P&L for %d fill events: %s", len(events), e)
+
+
+def persist_fill_events(events: list) -> int:
+    """Write a batch of fill events to the database in one transaction; returns rows booked."""
+    from marketdata.models import Order, Fill, PositionSnapshot, LedgerEntry, UserAccount, ClosedTrade
+
+    if not events:
+        return 0
+
+    with transaction.atomic():
+        eids = [e["eid"] for e in events]
+        # Fill.event_id covers every booked event; Order.event_id those booked before it existed
+        done = set(Fill.objects.filter(event_id__in=eids).values_list("event_id", flat=True))
+        done.update(Order.objects.filter(event_id__in=eids).values_list("event_id", flat=True))
+        todo = []
+        for e in events:
+            if e["eid"] not in done:
+                done.add(e["eid"])
+                todo.append(e)
+        if not todo:
+            _clear_pending(events)
+            return 0
+
+        # client_id orders created earlier are reused, as the synchronous path did
+        by_client = {}
+        client_keys = {(e["user_id"], e["client_id"]) for e in todo if e.get("client_id")}
+        if client_keys:
+            for o in Order.objects.filter(
+                user_id__in={u for u, _ in client_keys},
+                client_id__in={c for _, c in client_keys},
+            ):
+                by_client.setdefault((o.user_id, o.client_id), o)
+
+        # rows carry the time of the fill, not of this (possibly late or redelivered) batch
+        now = datetime.now(timezone.utc)
+        when = {e["eid"]: _dt(e.get("ts")) or now for e in todo}
+
+        new_orders = []
+        orders = []
+        for e in todo:
+            order = by_client.get((e["user_id"], e.get("client_id"))) if e.get("client_id") else None
+            if order is None:
+                order = Order(
+                    user_id=e["user_id"],
+                    symbol=e["symbol"],
+                    side=e["side"],
+                    lots=Decimal(e["lots"]),
+                    price=Decimal(e["price"]),
+                    type=e.get("type", "market"),
+                    status="filled",
+                    client_id=e.get("client_id"),
+                    position_id=e["position_id"],
+                    leverage=e.get("leverage"),
+                    event_id=e["eid"],
+                    created_at=when[e["eid"]],
+                )
+                new_orders.append(order)
+            orders.append(order)
+        Order.objects.bulk_create(new_orders)
+
+        backfill = {}
+        for o, e in zip(orders, todo):
+            if o.event_id != e["eid"] and not o.position_id:
+                o.position_id = e["position_id"]
+                backfill[o.pk] = o
+        if backfill:
+            Order.objects.bulk_update(list(backfill.values()), ["position_id"])
+
+        fills, snaps, ledger = [], [], []
+        balance_delta = defaultdict(Decimal)
+        for o, e in zip(orders, todo):
+            realized = Decimal(str(e.get("realized") or 0))
+            fills.append(Fill(
+                order=o,
+                user_id=e["user_id"],
+                symbol=e["symbol"],
+                side=e["side"],
+                lots=Decimal(e["lots"]),
+                price=Decimal(e["price"]),
+                realized_pnl=realized,
+                event_id=e["eid"],
+                ts=when[e["eid"]],
+            ))
+            snaps.append(PositionSnapshot(
+                user_id=e["user_id"],
+                position_id=e["position_id"],
+                symbol=e["symbol"],
+                net_lots=Decimal(str(e.get("new_net") or 0)),
+                avg_entry=Decimal(str(e.get("new_avg") or 0)),
+                unreal_pnl=Decimal("0"),
+                margin=Decimal("0"),
+                mark=Decimal(e["price"]),
+                ts=when[e["eid"]],
+            ))
+            if realized != 0:
+                ledger.append(LedgerEntry(
+                    user_id=e["user_id"],
+                    symbol=e["symbol"],
+                    kind="realized_pnl",
+                    amount=realized,
+                    ref=str(e["position_id"]),
+                    ts=when[e["eid"]],
+                ))
+                balance_delta[e["user_id"]] += realized
+
+        Fill.objects.bulk_create(fills)
+        PositionSnapshot.objects.bulk_create(snaps)
+        LedgerEntry.objects.bulk_create(ledger)
+        ClosedTrade.objects.bulk_create([
+            closed_trade_row(e["user_id"], e["position_id"], e["symbol"], e["closed_trade"],
+                             e.get("ts"), close_fill_id=f.pk)
+            for f, e in zip(fills, todo) if e.get("closed_trade")
+        ])
+        for uid, delta in balance_delta.items():
+            UserAccount.objects.filter(user_id=uid).update(balance=F("balance") + delta)
+
+    _clear_pending(events)
+    return len(todo)
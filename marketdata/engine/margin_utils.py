@@ -26,6 +26,40 @@ def validate_order(account: UserAccount, lots: Decimal, price: Decimal, contract
     }
 
 
+def check_order_margin(user_id, lots: Decimal, price: Decimal, contract_size: int, leverage: int):
+    """validate_order against the Redis risk state (no database read, nothing held)."""
+    from marketdata.engine.risk import check_margin
+    required_margin = calc_required_margin(lots, price, contract_size, leverage)
+    ok, free = check_margin(user_id, required_margin)
+    if ok is None:
+        return {"ok": False, "error": "User account not found."}
+    if not ok:
+        return {
+            "ok": False,
+            "error": f"Insufficient funds. Required: {required_margin:.2f}, Free Margin: {free:.2f}"
+        }
+    return {"ok": True, "margin_required": required_margin}
+
+
+def reserve_order_margin(user_id, lots: Decimal, price: Decimal, contract_size: int, leverage: int):
+    """
+    Atomic check-and-reserve of the order's margin in Redis. On success the
+    result carries "reservation", which the caller must hand to
+    risk.release_margin once the order fills or is rejected.
+    """
+    from marketdata.engine.risk import reserve_margin
+    required_margin = calc_required_margin(lots, price, contract_size, leverage)
+    ok, free, reservation = reserve_margin(user_id, required_margin)
+    if ok is None:
+        return {"ok": False, "error": "User account not found."}
+    if not ok:
+        return {
+            "ok": False,
+            "error": f"Insufficient funds. Required: {required_margin:.2f}, Free Margin: {free:.2f}"
+        }
+    return {"ok": True, "margin_required": required_margin, "reservation": reservation}
+
+
 def calculate_unrealized_pnl(side: str, open_price: Decimal, mark_price: Decimal, lots: Decimal, contract_size: int) -> Decimal:
     """
     Calculate PnL for an open position.
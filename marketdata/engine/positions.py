@@ -1,13 +1,19 @@
+import logging
 from decimal import Decimal
-from django.db import transaction
 from rest_framework.response import Response
 from rest_framework import status
-from marketdata.models import Order, Fill, PositionSnapshot, UserAccount
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from marketdata.engine.redis_ops import apply_fill_netting
+from marketdata.engine.redis_ops import (
+    apply_fill_netting, apply_fills_batch, refresh_account_totals,
+    positions_snapshot, positions_for_symbol, get_redis,
+)
 from marketdata.contracts import spec_for
-from marketdata.engine.margin_utils import validate_order
+from marketdata.engine.margin_utils import reserve_order_margin, calc_required_margin
+from marketdata.engine.risk import release_margin, reserve_margin
+from marketdata.engine.journal import new_fill_event
+
+logger = logging.getLogger(__name__)
 
 
 def on_fill(
@@ -19,107 +25,169 @@ def on_fill(
     mode: str = "netting",
     client_id: str | None = None,
     leverage: int = 500,
+    position_id: str | None = None,
+    on_applied=None,
 ):
     spec = spec_for(symbol)
     norm_side = side.capitalize()  # "Buy"/"Sell"
     signed_lots = float(lots) if norm_side == "Buy" else -float(lots)
 
-    # Validate margin/capital
+    # Pre-trade risk gate: atomically check and hold margin in Redis.
+    # Netting against an existing position (close / partial close) frees margin, so skip it.
+    reservation = None
+    if position_id is None:
+        d_lots = Decimal(str(abs(lots)))
+        d_price = Decimal(str(price))
+        validation = reserve_order_margin(user_id, d_lots, d_price, spec.contract_size, leverage)
+        if not validation["ok"]:
+            return Response(
+                {"error": "Insufficient margin", "details": validation["error"]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        reservation = validation["reservation"]
+
+    # Apply to Redis and append the fill to the journal in the same MULTI
+    # position_id=None opens a new position; an existing id nets against it (close / partial close)
+    event = new_fill_event(user_id, symbol, norm_side, lots, price, leverage, client_id=client_id)
     try:
-        account = UserAccount.objects.get(user_id=user_id)
-    except UserAccount.DoesNotExist:
-        return Response({"error": "UserAccount not found"}, status=status.HTTP_400_BAD_REQUEST)
-
-    d_lots = Decimal(str(abs(lots)))
-    d_price = Decimal(str(price))
-    validation = validate_order(account, d_lots, d_price, spec.contract_size, leverage)
-    if not validation["ok"]:
-        return Response(
-            {"error": "Insufficient margin", "details": validation["error"]},
-            status=status.HTTP_400_BAD_REQUEST,
+        res = apply_fill_netting(
+            user_id,
+            position_id,
+            signed_lots,
+            float(price),
+            spec.contract_size,
+            leverage,
+            mode=mode,
+            side=norm_side,
+            symbol=symbol,
+            open_time=None,
+            journal=event,
         )
-
-    # Apply to Redis (and book realized PnL in DB)
-    res = apply_fill_netting(
-        user_id,
-        None,
-        signed_lots,
-        float(price),
-        spec.contract_size,
-        leverage,
-        mode=mode,
-        side=norm_side,
-        symbol=symbol,
-        open_time=None,
-    )
-
-    position_id = res["position_id"]
-    realized = Decimal(str(res.get("realized", 0) or 0))
+    except Exception:
+        if reservation:
+            release_margin(user_id, reservation)
+        raise
+    if on_applied:
+        on_applied(res)  # the fill is in Redis from here on, whatever fails below
+    if reservation:
+        # the fill itself moved the margin into risk:{uid} used_margin
+        release_margin(user_id, reservation)
 
     # Push WebSocket update
-    ch = get_channel_layer()
-    async_to_sync(ch.group_send)(
-        f"user_{user_id}",
-        {
-            "type": "positions_update",
-            "data": {
-                "symbol": symbol,
-                "mark": float(price),
-                "unreal_pnl": 0.0,
-                "margin": 0.0,
-                "ts": res["updated_at"],
-            },
-        },
-    )
-
-    # Persist Order / Fill / Snapshot atomically
-    with transaction.atomic():
-        order = None
-        if client_id:
-            order = (
-                Order.objects.select_for_update()
-                .filter(client_id=client_id, user_id=user_id)
-                .first()
-            )
+    _push(user_id, {
+        "symbol": symbol,
+        "mark": float(price),
+        "unreal_pnl": 0.0,
+        "margin": 0.0,
+        "ts": res["updated_at"],
+    })
 
-        if order is None:
-            order = Order.objects.create(
-                user_id=user_id,
-                symbol=symbol,
-                side=norm_side,
-                lots=Decimal(str(abs(lots))),
-                price=Decimal(str(price)),
-                type="market",
-                status="filled",
-                client_id=client_id,
-                position_id=position_id,  # NEW
-            )
-        else:
-            if not getattr(order, "position_id", None):
-                order.position_id = position_id
-                order.save(update_fields=["position_id"])
-
-        Fill.objects.create(
-            order=order,
-            user_id=user_id,
-            symbol=symbol,
-            side=norm_side,
-            lots=Decimal(str(abs(lots))),
-            price=Decimal(str(price)),
-            realized_pnl=realized,
+    # Order / Fill / PositionSnapshot rows are written by run_fill_persister from the journal
+    return res
+
+def _push(user_id, data):
+    """Best-effort positions_update; the fill is already applied, so a push failure is only logged."""
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            f"user_{user_id}", {"type": "positions_update", "data": data},
         )
+    except Exception:
+        logger.exception("positions_update push failed for user %s", user_id)
 
-        # Realized PnL already ledgered inside apply_fill_netting
-        PositionSnapshot.objects.create(
-            user_id=user_id,
-            symbol=symbol,
-            net_lots=Decimal(str(res.get("new_net", 0))),
-            avg_entry=Decimal(str(res.get("new_avg", 0) or 0)),
-            unreal_pnl=Decimal("0"),
-            margin=Decimal("0"),
-            mark=Decimal(str(price)),
+
+def _push_batch(user_id, results):
+    """One positions_update for a whole batch instead of one per fill."""
+    _push(user_id, {
+        "batch": True,
+        "symbols": sorted({res["symbol"] for res in results}),
+        "position_ids": [res["position_id"] for res in results],
+        "ts": results[0]["updated_at"] if results else 0,
+    })
+
+
+def submit_orders(user_id: int, orders: list, mode: str = "netting", on_applied=None):
+    """
+    Fill N market orders for one user together: one margin reservation for the
+    total, one Redis MULTI for all positions, one journal batch, one WS push.
+    `orders` items: {symbol, side, lots, price, leverage, client_id?}, already validated.
+    """
+    fills = []
+    total_margin = Decimal("0")
+    for o in orders:
+        spec = spec_for(o["symbol"])
+        side = o["side"].capitalize()
+        lots = float(o["lots"])
+        total_margin += calc_required_margin(
+            Decimal(str(lots)), Decimal(str(o["price"])), spec.contract_size, o["leverage"]
         )
+        fills.append({
+            "position_id": None,
+            "fill_lots": lots if side == "Buy" else -lots,
+            "fill_price": float(o["price"]),
+            "contract_size": spec.contract_size,
+            "leverage": o["leverage"],
+            "side": side,
+            "symbol": o["symbol"],
+            "journal": new_fill_event(user_id, o["symbol"], side, lots, o["price"], o["leverage"],
+                                      client_id=o.get("client_id")),
+        })
+
+    ok, free, reservation = reserve_margin(user_id, total_margin)
+    if ok is None:
+        return Response({"error": "User account not found."}, status=status.HTTP_400_BAD_REQUEST)
+    if not ok:
+        return Response(
+            {"error": "Insufficient margin",
+             "details": f"Insufficient funds. Required: {total_margin:.2f}, Free Margin: {free:.2f}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        results = apply_fills_batch(user_id, fills, mode=mode)
+        if on_applied:
+            on_applied(results)
+    finally:
+        release_margin(user_id, reservation)
+
+    _push_batch(user_id, results)
+    return results
+
+
+def close_positions(user_id: int, symbol: str | None = None, mode: str = "netting"):
+    """
+    Close every open position of the user (or only those on `symbol`) at the
+    latest marks in one batch. Returns (results, skipped_symbols_without_mark).
+    """
+    positions = positions_for_symbol(user_id, symbol) if symbol else [
+        pos for pos in positions_snapshot(user_id) if pos["net_lots"]
+    ]
+    if not positions:
+        return [], []
+
+    symbols = sorted({pos["symbol"] for pos in positions})
+    marks = dict(zip(symbols, get_redis().mget([f"mark:{sym}" for sym in symbols])))
+
+    fills = []
+    for pos in positions:
+        mark = marks.get(pos["symbol"])
+        if mark is None:
+            continue
+        leverage = int(pos.get("leverage") or 500)
+        fills.append({
+            "position_id": pos["id"],
+            "fill_lots": None,  # whatever is open when the batch runs
+            "fill_price": float(mark),
+            "contract_size": spec_for(pos["symbol"]).contract_size,
+            "leverage": leverage,
+            "symbol": pos["symbol"],
+            "journal": new_fill_event(user_id, pos["symbol"], pos["side"], pos["net_lots"],
+                                      mark, leverage),
+        })
+
+    results = apply_fills_batch(user_id, fills, mode=mode)
+    if results:
+        refresh_account_totals(user_id)
+        _push_batch(user_id, results)
+    return results, [sym for sym in symbols if marks.get(sym) is None]
 
-    return res
 
 # Working
\ No newline at end of file
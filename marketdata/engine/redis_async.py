@@ -0,0 +1,71 @@
+# marketdata/engine/redis_async.py
+"""
+redis.asyncio reads of the position and capital state for the user socket
+(streams/user_ws.py), which runs on the ASGI event loop. One connection pool
+per event loop is shared by every consumer on the worker, so a reconnect storm
+costs a few awaited round trips per user instead of blocking the loop on sync
+sockets.
+"""
+import asyncio
+import os
+import weakref
+from typing import Any, Dict, List
+
+import redis.asyncio as aioredis
+
+from marketdata.engine.capital import capital_view, k_capseq
+from marketdata.engine.redis_ops import _position_view, k_pos, k_posidx, k_posver
+from marketdata.engine.risk import k_risk
+
+POOL_MAX_CONNECTIONS = 200
+
+# keyed by the loop itself: an id() can be reused by a new loop once the old one is collected
+_clients = weakref.WeakKeyDictionary()  # event loop -> aioredis.Redis
+
+
+def get_async_redis() -> aioredis.Redis:
+    """Shared client for the running event loop (pools can't cross loops)."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        url = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+        pool = aioredis.ConnectionPool.from_url(url, decode_responses=True,
+                                                max_connections=POOL_MAX_CONNECTIONS)
+        client = _clients[loop] = aioredis.Redis(connection_pool=pool)
+    return client
+
+
+async def _views(r, uid, position_ids) -> List[Dict[str, Any]]:
+    position_ids = list(position_ids)
+    if not position_ids:
+        return []
+    async with r.pipeline(transaction=False) as p:
+        for pos_id in position_ids:
+            p.hgetall(k_pos(uid, pos_id))
+        results = await p.execute()
+    return [
+        _position_view(pos_id, fields) for pos_id, fields in zip(position_ids, results)
+        if fields
+    ]
+
+
+async def positions_snapshot_versioned(uid: int | str):
+    """(version, positions) read in one round trip for the index, one for the hashes."""
+    r = get_async_redis()
+    async with r.pipeline(transaction=False) as p:
+        p.get(k_posver(uid))
+        p.smembers(k_posidx(uid))
+        version, position_ids = await p.execute()
+    return int(version or 0), await _views(r, uid, position_ids or ())
+
+
+async def capital_snapshot(uid: int | str):
+    """(seq, capital) from the hot risk:{uid} state, or (seq, None) when it isn't seeded."""
+    r = get_async_redis()
+    async with r.pipeline(transaction=False) as p:
+        p.get(k_capseq(uid))
+        p.hmget(k_risk(uid), "balance", "used_margin", "unreal_pnl")
+        seq, (balance, used, unreal) = await p.execute()
+    if balance is None:
+        return int(seq or 0), None
+    return int(seq or 0), capital_view(balance, used, unreal)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 import os, time, math
 from typing import Optional, Tuple, Dict, Any, List
 from decimal import Decimal
@@ -23,6 +24,11 @@ from marketdata.models import UserAccount, LedgerEntry
 
 
 
+logger = logging.getLogger(__name__)
+
+FANOUT_WATCH_RETRIES = 3  # WATCH conflicts tolerated before apply_fills_fanout splits its batch
+
+
 def generate_position_id() -> str:
     return str(uuid.uuid4())
 
@@ -41,6 +47,72 @@ def k_posidx(uid: int | str) -> str:
 def k_symidx(symbol: str) -> str:
     return f"symidx:{symbol}"
 
+def k_userpos(uid: int | str, symbol: str) -> str:
+    return f"userpos:{uid}:{symbol}"
+
+def k_posver(uid: int | str) -> str:
+    return f"posver:{uid}"
+
+def k_poschg(uid: int | str) -> str:
+    return f"poschg:{uid}"
+
+def k_posfloor(uid: int | str) -> str:
+    return f"posfloor:{uid}"
+
+def k_posmark(uid: int | str) -> str:
+    return f"posmark:{uid}"
+
+# ---- Per-user position versioning ----
+# posver:{uid}   counter bumped on every position change
+# poschg:{uid}   zset position_id -> version of its last change (bounded)
+# posfloor:{uid} highest version pruned from poschg; deltas older than this need a full snapshot
+# posmark:{uid}  epoch second of the last mark-to-market; marks don't bump the version, so
+#                snapshot ETags carry both (positions_etag)
+POSCHG_KEEP = 512
+
+_BUMP_LUA = """
+local v = redis.call('INCR', KEYS[1])
+local keep = tonumber(ARGV[#ARGV])
+for i = 1, #ARGV - 1 do
+    redis.call('ZADD', KEYS[2], v, ARGV[i])
+end
+local n = redis.call('ZCARD', KEYS[2])
+if n > keep then
+    local cut = redis.call('ZRANGE', KEYS[2], n - keep - 1, n - keep - 1, 'WITHSCORES')
+    redis.call('SET', KEYS[3], cut[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, n - keep - 1)
+end
+return v
+"""
+_bump_script = None
+
+# Drop uid from symidx:{symbol} once its userpos:{uid}:{symbol} set is empty.
+# Runs inside the same MULTI as the SREM so a concurrent open can't be lost.
+_UNREG_LUA = """
+if redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 0
+"""
+_unreg_script = None
+
+def unregister_symbol_if_flat(client, uid: int | str, symbol: str) -> None:
+    global _unreg_script
+    if _unreg_script is None:
+        _unreg_script = get_redis().register_script(_UNREG_LUA)
+    _unreg_script(keys=[k_userpos(uid, symbol), k_symidx(symbol)], args=[uid], client=client)
+
+def bump_positions_version(client, uid: int | str, *position_ids: str) -> None:
+    """Queue (on a pipeline) or run a version bump recording which positions changed."""
+    global _bump_script
+    if _bump_script is None:
+        _bump_script = get_redis().register_script(_BUMP_LUA)
+    _bump_script(
+        keys=[k_posver(uid), k_poschg(uid), k_posfloor(uid)],
+        args=[*position_ids, POSCHG_KEEP],
+        client=client,
+    )
+
 # ---- Math helpers (netting) ----
 def _apply_fill_math(net_lots: float, avg_entry: Optional[float],
     fill_lots: float, fill_price: float, contract_size: int
@@ -74,6 +146,133 @@ def _apply_fill_math(net_lots: float, avg_entry: Optional[float],
     
     return (Lp, avg_entry, realized)
 
+def _stage_fill(
+    p, uid, position_id: str, pos: Dict[str, Any], fill_lots: float, fill_price: float,
+    contract_size: int, leverage: int, mode: str, side: Optional[str],
+    symbol: Optional[str], open_time: Optional[int], now: int,
+) -> Dict[str, Any]:
+    """Net one fill against `pos` (its current hash) and queue the writes on pipeline `p`."""
+    key = k_pos(uid, position_id)
+
+    L = float(pos.get("net_lots", 0) or 0)
+    avg = float(pos["avg_entry"]) if pos.get("avg_entry") not in (None, "", "None") else None
+
+    new_net, new_avg, realized = _apply_fill_math(L, avg, fill_lots, fill_price, contract_size)
+
+    # we need the symbol even if we fully close (before we blank it below)
+    resolved_symbol = (symbol or pos.get("symbol", "")).upper()
+    old_margin = float(pos.get("margin") or 0) if L else 0.0
+    new_margin = 0.0
+
+    # lifetime totals for the closed-trade record; avg_entry doesn't move on a reduction
+    reduced = min(abs(fill_lots), abs(L)) if L and fill_lots and (L > 0) != (fill_lots > 0) else 0.0
+    realized_total = float(pos.get("realized_total") or 0) + float(realized or 0)
+    closed_lots = float(pos.get("closed_lots") or 0) + reduced
+    closed_trade = None
+
+    if abs(Decimal(str(new_net))) < Decimal('1e-12'):
+        if L and closed_lots and avg is not None:
+            direction = 1 if L > 0 else -1
+            closed_trade = {
+                "side": "Buy" if L > 0 else "Sell",
+                "lots": closed_lots,
+                "entry_price": avg,
+                # volume-weighted exit over all reductions, recovered from the realized total
+                "exit_price": avg + realized_total / (contract_size * closed_lots * direction),
+                "realized": realized_total,
+                "open_time": int(pos.get("open_time") or now),
+            }
+        # Closing position – remove from index, blank fields
+        p.hset(key, mapping={
+            "net_lots": 0.0, "avg_entry": "",
+            "updated_at": now, "mode": mode,
+            "side": "", "symbol": "", "open_time": "", "margin": 0.0,
+            "realized_total": 0.0, "closed_lots": 0.0,
+        })
+        p.srem(k_posidx(uid), position_id)
+        if resolved_symbol:
+            p.srem(k_userpos(uid, resolved_symbol), position_id)
+            unregister_symbol_if_flat(p, uid, resolved_symbol)
+    else:
+        # side follows the remaining net; a partial close must not flip the label
+        resolved_side = "Sell" if new_net < 0 else "Buy" if new_net > 0 else (side or "")
+        if not resolved_symbol:
+            raise Exception("Missing symbol value for position!")
+
+        # margin at fill price so account aggregation counts it before the first mark
+        new_margin = abs(float(new_net) * contract_size * float(fill_price)) / max(1, int(leverage))
+        p.hset(key, mapping={
+            "net_lots": new_net,
+            "avg_entry": new_avg if new_avg is not None else "",
+            "updated_at": now,
+            "mode": mode,
+            "side": resolved_side,
+            "symbol": resolved_symbol,
+            "open_time": open_time or pos.get("open_time") or now,
+            "leverage": leverage,   # keep leverage stored on the position hash
+            "margin": new_margin,
+            "realized_total": realized_total,
+            "closed_lots": closed_lots,
+        })
+
+        # Only add to index if we're opening a new position or changing lots
+        if abs(Decimal(str(L))) < Decimal('1e-12') or abs(Decimal(str(new_net - L))) > Decimal('1e-12'):
+            p.sadd(k_posidx(uid), position_id)
+            p.sadd(k_userpos(uid, resolved_symbol), position_id)
+
+            # Ensure user is registered for tick updates of this symbol
+            p.sadd(k_symidx(resolved_symbol), uid)
+
+    return {
+        "position_id": position_id,
+        "symbol": resolved_symbol,
+        "new_net": new_net,
+        "new_avg": new_avg,
+        "realized": realized,
+        "margin_delta": new_margin - old_margin,
+        "realized_total": realized_total,
+        "closed_lots": closed_lots,
+        "closed_trade": closed_trade,
+        "updated_at": now,
+    }
+
+
+def _stage_journal(p, uid, results, events, realized_total, margin_delta) -> None:
+    """Queue risk-state increments and journal appends for staged fills."""
+    from marketdata.engine.risk import incr_risk_field, stage_pending_realized
+    from marketdata.engine.journal import journal_enabled, journal_fill
+
+    if realized_total:
+        # keep the pre-trade risk state in step with the position change
+        incr_risk_field(p, uid, "balance", realized_total)
+    if margin_delta:
+        incr_risk_field(p, uid, "used_margin", margin_delta)
+    for res, event in zip(results, events):
+        if event is None:
+            continue
+        event.update({
+            "position_id": res["position_id"],
+            "symbol": res["symbol"],
+            "realized": res["realized"],
+            "new_net": res["new_net"],
+            "new_avg": res["new_avg"],
+            "closed_trade": res["closed_trade"],
+        })
+        if res["realized"]:
+            # seeding adds this until the fill is booked into UserAccount.balance
+            stage_pending_realized(p, uid, event["eid"], res["realized"])
+        if journal_enabled():
+            journal_fill(p, event)
+
+
+def _book_sync(events) -> None:
+    from marketdata.engine.journal import journal_enabled, persist_fill_events
+    events = [e for e in events if e is not None]
+    if events and not journal_enabled():
+        # journal switched off: book synchronously through the same code path
+        persist_fill_events(events)
+
+
 # Atomic Redis ops
 def apply_fill_netting(
     uid: int | str,
@@ -85,8 +284,15 @@ def apply_fill_netting(
     mode: str = "netting",
     side: Optional[str] = None,
     symbol: Optional[str] = None,
-    open_time: Optional[int] = None
+    open_time: Optional[int] = None,
+    journal: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
+    """
+    Net a fill into the position hash. With `journal` (an event from
+    journal.new_fill_event) the fill is appended to the fill journal in the same
+    MULTI and the persister books Order/Fill/ledger later; without it realized
+    P&L is booked to the database here, as before.
+    """
 
     r = get_redis()
     now = int(time.time())
@@ -94,57 +300,22 @@ def apply_fill_netting(
     if position_id is None:
         position_id = generate_position_id()
 
-    key = k_pos(uid, position_id)
-
     with r.pipeline() as p:
-        p.hgetall(key)
+        p.hgetall(k_pos(uid, position_id))
         pos = p.execute()[0] or {}
 
-    L = float(pos.get("net_lots", 0) or 0)
-    avg = float(pos["avg_entry"]) if pos.get("avg_entry") not in (None, "", "None") else None
-
-    new_net, new_avg, realized = _apply_fill_math(L, avg, fill_lots, fill_price, contract_size)
-
-    # we need the symbol even if we fully close (before we blank it below)
-    # resolved_symbol = symbol if symbol else (pos.get("symbol") or "")
-    resolved_symbol = (symbol or pos.get("symbol", "")).upper()
-
     with r.pipeline() as p:
-        if abs(Decimal(str(new_net))) < Decimal('1e-12'):
-            # Closing position – remove from index, blank fields
-            p.hset(key, mapping={
-                "net_lots": 0.0, "avg_entry": "",
-                "updated_at": now, "mode": mode,
-                "side": "", "symbol": "", "open_time": ""
-            })
-            p.srem(k_posidx(uid), position_id)
-        else:
-            resolved_side = (
-                side if side else ("Sell" if new_net < 0 else "Buy" if new_net > 0 else "")
-            )
-            if not resolved_symbol:
-                raise Exception("Missing symbol value for position!")
-
-            p.hset(key, mapping={
-                "net_lots": new_net,
-                "avg_entry": new_avg if new_avg is not None else "",
-                "updated_at": now,
-                "mode": mode,
-                "side": resolved_side,
-                "symbol": resolved_symbol,
-                "open_time": open_time or pos.get("open_time") or now,
-                "leverage": leverage,   # keep leverage stored on the position hash
-            })
-
-            # Only add to index if we're opening a new position or changing lots
-            if abs(Decimal(str(L))) < Decimal('1e-12') or abs(Decimal(str(new_net - L))) > Decimal('1e-12'):
-                p.sadd(k_posidx(uid), position_id)
-
-                # Ensure user is registered for tick updates of this symbol
-                p.sadd(k_symidx(resolved_symbol), uid)
-
+        res = _stage_fill(p, uid, position_id, pos, fill_lots, fill_price, contract_size,
+                          leverage, mode, side, symbol, open_time, now)
+        bump_positions_version(p, uid, position_id)
+        _stage_journal(p, uid, [res], [journal], res["realized"], res["margin_delta"])
         p.execute()
 
+    realized = res["realized"]
+    if journal is not None:
+        _book_sync([journal])
+        return {k: res[k] for k in ("position_id", "new_net", "new_avg", "realized", "updated_at")}
+
     # ---- NEW: Book realized P&L to DB balance + ledger (atomic) ----
     realized_dec = Decimal(str(realized or 0))
     if realized_dec != 0:
@@ -157,20 +328,184 @@ def apply_fill_netting(
             # optional but strongly recommended for audit
             LedgerEntry.objects.create(
                 user_id=int(uid),
-                symbol=resolved_symbol or "",
+                symbol=res["symbol"] or "",
                 kind="realized_pnl",
                 amount=realized_dec,
                 ref=str(position_id),
             )
+    if res["closed_trade"]:
+        from marketdata.engine.journal import closed_trade_row
+        closed_trade_row(uid, position_id, res["symbol"], res["closed_trade"], now).save()
     # ---- end NEW ----
 
-    return {
-        "position_id": position_id,
-        "new_net": new_net,
-        "new_avg": new_avg,
-        "realized": realized,
-        "updated_at": now,
-    }
+    return {k: res[k] for k in ("position_id", "new_net", "new_avg", "realized", "updated_at")}
+
+
+def _stage_user_fills(p, uid, fills, state, mode, now):
+    """Stage one user's fills against `state` (pid -> hash) on MULTI `p`; returns (results, events)."""
+    results, events = [], []
+    for f in fills:
+        pid = f["position_id"]
+        lots = f["fill_lots"]
+        if lots is None:
+            # close whatever is left, as read in this batch
+            lots = -float(state[pid].get("net_lots") or 0)
+            if abs(lots) < 1e-12:
+                continue
+            if f.get("journal") is not None:
+                f["journal"].update({"side": "Sell" if lots < 0 else "Buy", "lots": str(abs(Decimal(str(lots))))})
+        res = _stage_fill(p, uid, pid, state[pid], lots, f["fill_price"],
+                          f["contract_size"], f["leverage"], mode, f.get("side"),
+                          f.get("symbol"), f.get("open_time"), now)
+        res["fill_lots"] = lots
+        # a later fill on the same position nets against this one's result
+        state[pid] = {
+            "net_lots": res["new_net"],
+            "avg_entry": res["new_avg"] if res["new_avg"] is not None else "",
+            "symbol": res["symbol"] if res["new_net"] else "",
+            "open_time": state[pid].get("open_time") or now,
+            "margin": float(state[pid].get("margin") or 0) + res["margin_delta"],
+            "realized_total": res["realized_total"] if res["new_net"] else 0.0,
+            "closed_lots": res["closed_lots"] if res["new_net"] else 0.0,
+        }
+        results.append(res)
+        events.append(f.get("journal"))
+
+    if results:
+        bump_positions_version(p, uid, *dict.fromkeys(res["position_id"] for res in results))
+        _stage_journal(
+            p, uid, results, events,
+            sum((Decimal(str(res["realized"] or 0)) for res in results), Decimal("0")),
+            sum(res["margin_delta"] for res in results),
+        )
+    return results, events
+
+
+def apply_fills_batch(uid: int | str, fills: List[Dict[str, Any]], mode: str = "netting") -> List[Dict[str, Any]]:
+    """
+    Net many fills for one user in two round trips: one pipelined read of every
+    position touched, one MULTI with all position/index writes, a single version
+    bump and the journal events. Each fill is a dict with position_id (None opens
+    a new position), fill_lots (signed; None closes the position in full),
+    fill_price, contract_size, leverage, side, symbol and journal (an event from
+    journal.new_fill_event). Fills that find nothing left to close are dropped
+    from the result.
+
+    The positions are WATCHed across the read and the MULTI as in
+    apply_fills_fanout, so a concurrent fill or close on one of them is retried
+    instead of overwritten; redis.WatchError if they keep changing.
+    """
+    r = get_redis()
+    if not fills:
+        return []
+
+    for f in fills:
+        if f.get("position_id") is None:
+            f["position_id"] = generate_position_id()
+        f["uid"] = uid
+    results, events = _fanout_watched(r, fills, mode, None)
+    for res in results:
+        res.pop("uid", None)
+
+    _book_sync(events)
+    return results
+
+
+def apply_fills_fanout(fills: List[Dict[str, Any]], mode: str = "netting",
+                       track: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    apply_fills_batch across many users: each fill also carries "uid". One
+    pipelined read for every position, one MULTI for all writes (a version bump
+    and risk/journal entries per user). With `track` (a set key) users whose
+    position is left open are added to it and users left flat removed, in the
+    same MULTI. Results carry "uid".
+
+    The positions are WATCHed from before the read, so a position changed in
+    between (e.g. the user closed it) aborts the MULTI instead of having a
+    stale net written back; the batch is re-read and retried, and split in two
+    by user when it keeps colliding with mark-to-market writes.
+    """
+    r = get_redis()
+    if not fills:
+        return []
+
+    for f in fills:
+        if f.get("position_id") is None:
+            f["position_id"] = generate_position_id()
+    results, events = _fanout_watched(r, fills, mode, track)
+    _book_sync(events)
+    return results
+
+
+def _fanout_watched(r, fills, mode, track):
+    uids = list(dict.fromkeys(f["uid"] for f in fills))
+    for _ in range(FANOUT_WATCH_RETRIES):
+        try:
+            return _fanout_once(r, fills, mode, track)
+        except redis.WatchError:
+            continue
+    if len(uids) == 1:
+        raise redis.WatchError(f"position of user {uids[0]} kept changing during the fan-out")
+    first = set(uids[:len(uids) // 2])
+    a = _fanout_watched(r, [f for f in fills if f["uid"] in first], mode, track)
+    b = _fanout_watched(r, [f for f in fills if f["uid"] not in first], mode, track)
+    return a[0] + b[0], a[1] + b[1]
+
+
+def _fanout_once(r, fills, mode, track):
+    """One WATCH / read / MULTI attempt; raises WatchError if a position changed meanwhile."""
+    now = int(time.time())
+    by_user: Dict[Any, List[Dict[str, Any]]] = {}
+    for f in fills:
+        by_user.setdefault(f["uid"], []).append(f)
+    refs = list(dict.fromkeys((f["uid"], f["position_id"]) for f in fills))
+
+    results, events = [], []
+    with r.pipeline() as p:
+        p.watch(*[k_pos(uid, pid) for uid, pid in refs])
+        # read on a separate connection so it is one round trip; the WATCH above covers it
+        with r.pipeline(transaction=False) as rp:
+            for uid, pid in refs:
+                rp.hgetall(k_pos(uid, pid))
+            rows = rp.execute()
+        state: Dict[Any, Dict[str, Any]] = {}
+        for (uid, pid), h in zip(refs, rows):
+            state.setdefault(uid, {})[pid] = h or {}
+
+        p.multi()
+        for uid, user_fills in by_user.items():
+            user_results, user_events = _stage_user_fills(p, uid, user_fills, state[uid], mode, now)
+            for res in user_results:
+                res["uid"] = uid
+                if track:
+                    (p.sadd if abs(float(res["new_net"] or 0)) > 1e-12 else p.srem)(track, uid)
+            results.extend(user_results)
+            events.extend(user_events)
+        if not results:
+            return [], []
+        p.execute()
+    return results, events
+
+
+def refresh_account_totals(uid: int | str) -> Tuple[Decimal, Decimal]:
+    """Re-aggregate used margin / unrealized P&L from Redis into UserAccount (one pipelined read)."""
+    r = get_redis()
+    position_ids = list(r.smembers(k_posidx(uid)) or ())
+    with r.pipeline(transaction=False) as p:
+        for pos_id in position_ids:
+            p.hmget(k_pos(uid, pos_id), "unreal_pnl", "margin")
+        rows = p.execute() if position_ids else []
+
+    total_unrealized_pnl = Decimal('0.0')
+    total_used_margin = Decimal('0.0')
+    for unreal, margin in rows:
+        total_unrealized_pnl += Decimal(str(unreal or 0))
+        total_used_margin += Decimal(str(margin or 0))
+
+    UserAccount.objects.filter(user_id=int(uid)).update(
+        unrealized_pnl=total_unrealized_pnl, used_margin=total_used_margin,
+    )
+    return total_used_margin, total_unrealized_pnl
 
 
 def mark_to_market(uid: int | str, position_id: str, mark: float,
@@ -185,8 +520,11 @@ def mark_to_market(uid: int | str, position_id: str, mark: float,
 
     net = float(pos.get("net_lots", 0) or 0)
     if abs(net) < Decimal('1e-12'):
-        with r.pipeline() as p:
+        # mark/pnl only change on ticks: they reach clients through the stream, and the
+        # positions version (?since=) is left to structural changes; posmark keeps ETags honest
+        with r.pipeline(transaction=False) as p:
             p.hset(key, mapping={"last_mark": mark, "unreal_pnl": 0.0, "margin": 0.0, "updated_at": now})
+            p.set(k_posmark(uid), now)
             p.execute()
         return {"unreal_pnl": 0.0, "margin": 0.0, "last_mark": mark, "updated_at": now, "user_updated": False}
 
@@ -199,13 +537,14 @@ def mark_to_market(uid: int | str, position_id: str, mark: float,
     margin = notional / max(1, lev)
 
     # Update position first
-    with r.pipeline() as p:
+    with r.pipeline(transaction=False) as p:
         p.hset(key, mapping={
             "last_mark": mark,
             "unreal_pnl": pnl,
             "margin": margin,
             "updated_at": now
         })
+        p.set(k_posmark(uid), now)
         p.execute()
 
     # Now update the aggregated UserAccount totals
@@ -231,6 +570,11 @@ def mark_to_market(uid: int | str, position_id: str, mark: float,
             account.used_margin = total_used_margin
             account.save(update_fields=['unrealized_pnl', 'used_margin'])
 
+        # Same totals for the pre-trade risk gate; its balance already holds realized
+        # P&L that UserAccount.balance only gets once the fill journal is persisted
+        from marketdata.engine.risk import set_risk_exposure
+        set_risk_exposure(r, user_id, total_used_margin, total_unrealized_pnl)
+
         return {
             "unreal_pnl": pnl, 
             "margin": margin, 
@@ -242,7 +586,7 @@ def mark_to_market(uid: int | str, position_id: str, mark: float,
         }
         
     except Exception as e:
-        print(f"mark_to_market: Error updating UserAccount for {uid}: {e}")
+        logger.warning("mark_to_market: error updating UserAccount for %s: %s", uid, e)
         return {
             "unreal_pnl": pnl, 
             "margin": margin, 
@@ -251,6 +595,33 @@ def mark_to_market(uid: int | str, position_id: str, mark: float,
             "user_updated": False
         }
 
+def _position_view(pos_id: str, fields: Dict[str, str]) -> Dict[str, Any]:
+    net_lots = float(fields.get("net_lots", 0))
+    return {
+        "id": pos_id,
+        "symbol": fields.get("symbol", ""),
+        "net_lots": net_lots,
+        "open_price": float(fields.get("avg_entry") or 0),
+        "unreal_pnl": float(fields.get("unreal_pnl", 0)),
+        "margin": float(fields.get("margin", 0)),
+        "mark": float(fields.get("last_mark", 0)),
+        "leverage": int(float(fields.get("leverage") or 0)),
+        "open_time": int(fields.get("open_time") or fields.get("updated_at", 0)),
+        # Automatically derive side for display
+        "side": "Sell" if net_lots < 0 else "Buy" if net_lots > 0 else "",
+        "ts": int(fields.get("updated_at", 0)),
+    }
+
+def positions_version(uid: int | str) -> int:
+    return int(get_redis().get(k_posver(uid)) or 0)
+
+def positions_etag(uid: int | str, version: Optional[int] = None) -> str:
+    """ETag of the snapshot: position version plus last mark time, so re-marked P&L is never a 304."""
+    ver, marked = get_redis().mget(k_posver(uid), k_posmark(uid))
+    if version is None:
+        version = int(ver or 0)
+    return f'"{version}.{marked or 0}"'
+
 def positions_snapshot(uid: int | str) -> List[Dict[str, Any]]:
     r = get_redis()
     position_ids = r.smembers(k_posidx(uid)) or set()
@@ -264,26 +635,64 @@ def positions_snapshot(uid: int | str) -> List[Dict[str, Any]]:
     for pos_id, fields in zip(position_ids, results):
         if not fields:
             continue
-        
-        net_lots = float(fields.get("net_lots", 0))
-        pos = {
-            "id": pos_id,
-            "symbol": fields.get("symbol", ""),
-            "net_lots": net_lots,
-            "open_price": float(fields.get("avg_entry", 0)),
-            "unreal_pnl": float(fields.get("unreal_pnl", 0)),
-            "margin": float(fields.get("margin", 0)),
-            "mark": float(fields.get("last_mark", 0)),
-            "open_time": int(fields.get("open_time") or fields.get("updated_at", 0)),
-            # Automatically derive side for display
-            "side": "Sell" if net_lots < 0 else "Buy" if net_lots > 0 else "",
-            "ts": int(fields.get("updated_at", 0)),
-        }
-        
-        positions.append(pos)
+        positions.append(_position_view(pos_id, fields))
     
     return positions
 
+def positions_for_symbol(uid: int | str, symbol: str) -> List[Dict[str, Any]]:
+    """
+    Open positions of one user on one symbol: one SMEMBERS plus one pipelined HGETALL batch.
+    Positions opened before the userpos index existed are indexed once by
+    `cache_positions --index-userpos`.
+    """
+    r = get_redis()
+    position_ids = list(r.smembers(k_userpos(uid, symbol.upper())) or ())
+    if not position_ids:
+        return []
+
+    with r.pipeline() as p:
+        for pos_id in position_ids:
+            p.hgetall(k_pos(uid, pos_id))
+        results = p.execute()
+
+    positions = []
+    for pos_id, fields in zip(position_ids, results):
+        if fields and abs(float(fields.get("net_lots", 0) or 0)) > 0:
+            positions.append(_position_view(pos_id, fields))
+    return positions
+
+def positions_delta(uid: int | str, since: int) -> Dict[str, Any]:
+    """
+    Positions changed after version `since`: open ones in "positions", ids that
+    were closed in "closed". Falls back to a full snapshot ("full": True) when
+    `since` predates the retained change log or comes from a reset counter.
+    """
+    r = get_redis()
+    with r.pipeline() as p:
+        p.get(k_posver(uid))
+        p.get(k_posfloor(uid))
+        p.zrangebyscore(k_poschg(uid), f"({int(since)}", "+inf")
+        p.smembers(k_posidx(uid))
+        version, floor, changed, open_ids = p.execute()
+
+    version = int(version or 0)
+    if since < int(floor or 0) or since > version:
+        return {"version": version, "full": True, "positions": positions_snapshot(uid), "closed": []}
+
+    with r.pipeline() as p:
+        for pos_id in changed:
+            p.hgetall(k_pos(uid, pos_id))
+        results = p.execute() if changed else []
+
+    positions, closed = [], []
+    for pos_id, fields in zip(changed, results):
+        if pos_id in open_ids and fields and abs(float(fields.get("net_lots", 0) or 0)) > 0:
+            positions.append(_position_view(pos_id, fields))
+        else:
+            closed.append(pos_id)
+
+    return {"version": version, "full": False, "positions": positions, "closed": closed}
+
 def exit_position(user_id, position_id, exit_price, mode="netting"):
     r = get_redis()
     key = k_pos(user_id, position_id)
@@ -300,55 +709,25 @@ def exit_position(user_id, position_id, exit_price, mode="netting"):
     side = "Sell" if net_lots > 0 else "Buy"
     opposite_lots = -net_lots  # to zero out net lots
 
-    # Apply fill netting and get realized info
+    # Apply fill netting; the Order/Fill rows and realized P&L go through the fill journal
+    from marketdata.engine.journal import new_fill_event
+    leverage = int(pos.get("leverage") or 500)
     res = apply_fill_netting(
         user_id, position_id,
         fill_lots=opposite_lots,
         fill_price=exit_price,
         contract_size=spec_for(symbol).contract_size,
-        leverage=int(pos.get("leverage")),
+        leverage=leverage,
         mode=mode,
         side=side,
         symbol=symbol,
-        open_time=int(pos.get("open_time") or time.time())
+        open_time=int(pos.get("open_time") or time.time()),
+        journal=new_fill_event(user_id, symbol, side, opposite_lots, exit_price, leverage),
     )
 
-    # Persist the fill with realized PnL
-    try:
-        Fill.objects.create(
-            userid=user_id,
-            symbol=symbol,
-            side=side,
-            lots=abs(opposite_lots),
-            price=exit_price,
-            realizedpnl=res.get("realized", 0),
-            positionid=position_id,
-            ts=int(time.time())
-        )
-    except Exception as e:
-        print(f"Error persisting Fill on exit_position: {e}")
-
     # Update aggregated UserAccount totals after closing
     try:
-        user_id = int(user_id)
-        account = UserAccount.objects.get(user_id=user_id)
-
-        position_ids = r.smembers(k_posidx(user_id)) or set()
-        total_unrealized_pnl = Decimal('0.0')
-        total_used_margin = Decimal('0.0')
-
-        for pos_id in position_ids:
-            pos = r.hgetall(k_pos(user_id, pos_id))
-            if pos and pos.get("unreal_pnl") is not None:
-                total_unrealized_pnl += Decimal(str(pos.get("unreal_pnl")))
-                total_used_margin += Decimal(str(pos.get("margin", "0")))
-
-        from django.db import transaction
-        with transaction.atomic():
-            account.unrealized_pnl = total_unrealized_pnl
-            account.used_margin = total_used_margin
-            account.save(update_fields=['unrealized_pnl', 'used_margin'])
-
+        refresh_account_totals(user_id)
     except Exception as e:
         print(f"exit_position: Error updating UserAccount for {user_id}: {e}")
 
@@ -0,0 +1,248 @@
+# marketdata/engine/risk.py
+"""
+Redis-resident pre-trade risk state.
+
+risk:{uid}     hash {balance, used_margin, unreal_pnl}; seeded from UserAccount on
+               demand and expires after RISK_STATE_TTL so balance edits made
+               elsewhere are picked up. Fills move balance (realized P&L) and
+               used_margin in their position MULTI; mark-to-market and the margin
+               updater only refresh used_margin/unreal_pnl, never the balance.
+riskres:{uid}  hash reservation_id -> "amount|expires_at_ms" for orders in flight.
+riskpend:{uid} hash fill event id -> realized P&L, written in the fill's MULTI and
+               dropped once the fill is booked; seeding adds what UserAccount.balance
+               does not hold yet, so a lagging persister can't overstate free margin.
+
+free = balance + unreal_pnl - used_margin - sum(live reservations), and the
+check-and-reserve runs as one Lua script so concurrent orders can't both spend
+the same free margin.
+"""
+import time
+import uuid
+from decimal import Decimal
+
+from marketdata.engine.redis_ops import get_redis
+
+RISK_STATE_TTL = 60          # seconds before risk:{uid} is re-seeded from the database
+RESERVATION_TTL_MS = 30_000  # a reservation not released by then stops counting
+PENDING_TTL = 7 * 86400      # unbooked realized P&L is forgotten after this
+
+def k_risk(uid) -> str:
+    return f"risk:{uid}"
+
+def k_riskres(uid) -> str:
+    return f"riskres:{uid}"
+
+def k_riskpend(uid) -> str:
+    return f"riskpend:{uid}"
+
+
+# KEYS: risk, riskres   ARGV: rid, amount, now_ms, expires_at_ms, reserve(0/1)
+# Returns {status, free_before}: status 1 = ok, 0 = insufficient, -1 = state not seeded
+_RESERVE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1, '0'}
+end
+local now = tonumber(ARGV[3])
+local reserved = 0
+local held = redis.call('HGETALL', KEYS[2])
+for i = 1, #held, 2 do
+    local amt, exp = string.match(held[i + 1], '^([^|]+)|(.+)$')
+    if tonumber(exp) < now then
+        redis.call('HDEL', KEYS[2], held[i])
+    else
+        reserved = reserved + tonumber(amt)
+    end
+end
+local s = redis.call('HMGET', KEYS[1], 'balance', 'used_margin', 'unreal_pnl')
+local free = tonumber(s[1] or '0') + tonumber(s[3] or '0') - tonumber(s[2] or '0') - reserved
+local amount = tonumber(ARGV[2])
+if free < amount then
+    return {0, tostring(free)}
+end
+if ARGV[5] == '1' then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2] .. '|' .. ARGV[4])
+    redis.call('PEXPIRE', KEYS[2], ARGV[4] - now + 1000)
+end
+return {1, tostring(free)}
+"""
+
+# KEYS: risk   ARGV: field, delta  - increment only when the state exists
+_INCR_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: risk   ARGV: used_margin, unreal_pnl  - refresh exposure only when the state exists
+_EXPOSURE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'used_margin', ARGV[1], 'unreal_pnl', ARGV[2])
+end
+return 0
+"""
+
+_scripts = {}
+
+def _script(name, src):
+    script = _scripts.get(name)
+    if script is None:
+        script = _scripts[name] = get_redis().register_script(src)
+    return script
+
+
+def set_risk_exposure(client, uid, used_margin, unreal_pnl) -> None:
+    """
+    Refresh used_margin/unreal_pnl of an existing risk state (queue on a pipeline
+    or run on a client). The balance is left alone: UserAccount.balance lags the
+    fill journal, while risk:{uid} already holds every realized P&L.
+    """
+    _script("exposure", _EXPOSURE_LUA)(keys=[k_risk(uid)], args=[str(used_margin), str(unreal_pnl)],
+                                       client=client)
+
+
+def incr_risk_field(client, uid, field: str, delta) -> None:
+    _script("incr", _INCR_LUA)(keys=[k_risk(uid)], args=[field, str(delta)], client=client)
+
+
+def stage_pending_realized(client, uid, event_id: str, realized) -> None:
+    """Queue, in the fill's MULTI, realized P&L the database has not booked yet."""
+    client.hset(k_riskpend(uid), event_id, str(realized))
+    client.expire(k_riskpend(uid), PENDING_TTL)
+
+
+def clear_pending_realized(events) -> None:
+    """Forget booked fill events (idempotent; run after the booking transaction commits)."""
+    by_user = {}
+    for e in events:
+        by_user.setdefault(e["user_id"], []).append(e["eid"])
+    if not by_user:
+        return
+    with get_redis().pipeline(transaction=False) as p:
+        for uid, eids in by_user.items():
+            p.hdel(k_riskpend(uid), *eids)
+        p.execute()
+
+
+def seed_risk_states(uids) -> set:
+    """
+    Seed risk:{uid} from UserAccount for many users (one query, one pipeline);
+    returns uids seeded. Realized P&L still in riskpend:{uid} is added unless its
+    Fill is already booked; balance and booked fills come from one statement, so
+    they are consistent with each other.
+    """
+    from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+    from django.db.models.functions import Coalesce
+    from marketdata.models import Fill, UserAccount
+
+    uids = [int(u) for u in uids]
+    r = get_redis()
+    with r.pipeline(transaction=False) as p:
+        for uid in uids:
+            p.hgetall(k_riskpend(uid))
+        pending = {uid: held for uid, held in zip(uids, p.execute()) if held}
+
+    accounts = UserAccount.objects.filter(user_id__in=uids)
+    eids = [eid for held in pending.values() for eid in held]
+    if eids:
+        booked = (
+            Fill.objects.filter(user_id=OuterRef("user_id"), event_id__in=eids)
+            .order_by().values("user_id").annotate(s=Sum("realized_pnl")).values("s")
+        )
+        accounts = accounts.annotate(booked=Coalesce(
+            Subquery(booked), Value(Decimal("0")),
+            output_field=DecimalField(max_digits=28, decimal_places=8),
+        ))
+    accounts = list(accounts.values("user_id", "balance", "used_margin", "unrealized_pnl",
+                                    *(("booked",) if eids else ())))
+    if not accounts:
+        return set()
+    with r.pipeline() as p:
+        for acc in accounts:
+            key = k_risk(acc["user_id"])
+            unbooked = sum((Decimal(v) for v in pending.get(acc["user_id"], {}).values()), Decimal("0"))
+            balance = acc["balance"] + unbooked - acc.get("booked", Decimal("0"))
+            # don't clobber fresher state written while we were reading the database
+            p.hsetnx(key, "balance", str(balance))
+            p.hsetnx(key, "used_margin", str(acc["used_margin"]))
+            p.hsetnx(key, "unreal_pnl", str(acc["unrealized_pnl"]))
+            p.expire(key, RISK_STATE_TTL)
+        p.execute()
+    return {acc["user_id"] for acc in accounts}
+
+
+def seed_risk_state(uid) -> bool:
+    return bool(seed_risk_states([uid]))
+
+
+def _run_reserve(uid, amount: Decimal, reserve: bool, rid: str = ""):
+    now = int(time.time() * 1000)
+    args = [rid, str(amount), now, now + RESERVATION_TTL_MS, "1" if reserve else "0"]
+    script = _script("reserve", _RESERVE_LUA)
+    status, free = script(keys=[k_risk(uid), k_riskres(uid)], args=args)
+    if int(status) == -1:
+        if not seed_risk_state(uid):
+            return None, Decimal("0")
+        status, free = script(keys=[k_risk(uid), k_riskres(uid)], args=args)
+    return int(status) == 1, Decimal(str(free))
+
+
+def check_margin(uid, amount: Decimal):
+    """Dry run: (ok, free_margin) without holding anything. ok is None if the account is missing."""
+    return _run_reserve(uid, amount, reserve=False)
+
+
+def reserve_margin(uid, amount: Decimal):
+    """Atomically check and hold `amount`: (ok, free_margin, reservation_id)."""
+    rid = uuid.uuid4().hex
+    ok, free = _run_reserve(uid, amount, reserve=True, rid=rid)
+    return ok, free, (rid if ok else None)
+
+
+def reserve_margin_many(uids, amount: Decimal) -> dict:
+    """
+    reserve_margin for many users in one pipelined round trip (plus one seeding
+    query for users without risk state); returns {uid: reservation_id} for the
+    users that had `amount` free.
+    """
+    uids = list(uids)
+    rids = {uid: uuid.uuid4().hex for uid in uids}
+    script = _script("reserve", _RESERVE_LUA)
+
+    def run(batch):
+        now = int(time.time() * 1000)
+        with get_redis().pipeline(transaction=False) as p:
+            for uid in batch:
+                script(keys=[k_risk(uid), k_riskres(uid)], client=p,
+                       args=[rids[uid], str(amount), now, now + RESERVATION_TTL_MS, "1"])
+            return {uid: int(status) for uid, (status, _free) in zip(batch, p.execute())}
+
+    status = run(uids) if uids else {}
+    unseeded = [uid for uid, st in status.items() if st == -1]
+    if unseeded:
+        seeded = seed_risk_states(unseeded)
+        status.update(run([uid for uid in unseeded if int(uid) in seeded]))
+    return {uid: rids[uid] for uid, st in status.items() if st == 1}
+
+
+def release_margins(reservations: dict) -> None:
+    """Drop {uid: reservation_id} reservations in one round trip."""
+    if not reservations:
+        return
+    with get_redis().pipeline(transaction=False) as p:
+        for uid, rid in reservations.items():
+            p.hdel(k_riskres(uid), rid)
+        p.execute()
+
+
+def release_margin(uid, reservation_id: str, used_delta=None) -> None:
+    """
+    Drop a reservation. Fills already move their margin into used_margin in the
+    position MULTI; `used_delta` is for callers that book margin outside it.
+    """
+    r = get_redis()
+    with r.pipeline() as p:
+        p.hdel(k_riskres(uid), reservation_id)
+        if used_delta:
+            incr_risk_field(p, uid, "used_margin", used_delta)
+        p.execute()
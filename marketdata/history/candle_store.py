@@ -0,0 +1,229 @@
+# marketdata/history/candle_store.py
+"""
+Append-only columnar candle history, one directory per (symbol, interval):
+
+    <CANDLE_STORE_DIR>/<SYMBOL>/<interval>/{time,open,high,low,close,volume}.bin
+
+Bars built locally from mid prices by the live aggregator (no volume) are kept
+apart under <CANDLE_STORE_DIR>/_synthetic/, so they never mix with upstream
+klines served by /api/candles.
+
+Each column is a flat native-endian array (int64 seconds for time, float64 for
+the rest), so a range query is a binary search on the memory-mapped time
+column followed by memoryview slices of the other columns - no row parsing.
+
+Only symbols in SPECS and intervals in INTERVAL_MAP get a series (the names
+become paths). Writers from several processes serialize on an flock of the
+series' `.lock` file, so the time column stays strictly increasing.
+"""
+import bisect
+import fcntl
+import mmap
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+COLUMNS = (
+    ("time", "q"),
+    ("open", "d"),
+    ("high", "d"),
+    ("low", "d"),
+    ("close", "d"),
+    ("volume", "d"),
+)
+ITEM_SIZE = 8
+MAX_SERIES = 256  # open series kept per process; least recently used ones are dropped
+
+_series = OrderedDict()
+_series_lock = threading.Lock()
+
+
+def is_valid_series(symbol: str, interval: str) -> bool:
+    from marketdata.contracts import SPECS
+    from marketdata.services.klines import INTERVAL_MAP
+    return isinstance(symbol, str) and symbol.upper() in SPECS and interval in INTERVAL_MAP
+
+
+def store_root() -> str:
+    root = getattr(settings, "CANDLE_STORE_DIR", None)
+    return root or os.path.join(str(settings.BASE_DIR), "var", "candles")
+
+
+def _to_bytes(values, fmt) -> bytes:
+    return array(fmt, values).tobytes()
+
+
+class CandleSeries:
+    """Memory-mapped OHLCV columns for one (symbol, interval)."""
+
+    def __init__(self, symbol: str, interval: str, root: str | None = None):
+        if not is_valid_series(symbol, interval):
+            raise ValueError(f"unknown candle series {symbol!r}/{interval!r}")
+        self.symbol = symbol.upper()
+        self.interval = interval
+        self.path = os.path.join(root or store_root(), self.symbol, interval)
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}  # column -> (byte size, memoryview)
+        with self._write_lock():
+            self._repair()
+
+    @contextmanager
+    def _write_lock(self):
+        """Thread lock plus an exclusive flock shared with every other process writing this series."""
+        with self._lock, open(os.path.join(self.path, ".lock"), "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def _file(self, col: str) -> str:
+        return os.path.join(self.path, f"{col}.bin")
+
+    def _size(self, col: str) -> int:
+        try:
+            return os.path.getsize(self._file(col))
+        except FileNotFoundError:
+            return 0
+
+    def _repair(self):
+        """Truncate all columns to the shortest one (a crash mid-append leaves them uneven)."""
+        n = min(self._size(col) for col, _ in COLUMNS) // ITEM_SIZE
+        for col, _ in COLUMNS:
+            if self._size(col) != n * ITEM_SIZE:
+                with open(self._file(col), "ab") as f:
+                    f.truncate(n * ITEM_SIZE)
+
+    def __len__(self) -> int:
+        return self._size("time") // ITEM_SIZE
+
+    def last_write(self) -> float:
+        """mtime of the close column; bumped by every append or forming-bar update."""
+        try:
+            return os.path.getmtime(self._file("close"))
+        except FileNotFoundError:
+            return 0.0
+
+    def _column(self, col: str, fmt: str, nbytes: int) -> memoryview:
+        cached = self._maps.get(col)
+        if cached and cached[0] == nbytes:
+            return cached[1]
+        with open(self._file(col), "rb") as f:
+            mm = mmap.mmap(f.fileno(), nbytes, access=mmap.ACCESS_READ)
+        mv = memoryview(mm).cast(fmt)
+        # old maps stay alive for as long as callers hold slices of them
+        self._maps[col] = (nbytes, mv)
+        return mv
+
+    def columns(self) -> dict:
+        """Zero-copy views over every column (empty arrays when the series is empty)."""
+        n = len(self)
+        if n == 0:
+            return {col: memoryview(array(fmt)) for col, fmt in COLUMNS}
+        with self._lock:
+            return {col: self._column(col, fmt, n * ITEM_SIZE) for col, fmt in COLUMNS}
+
+    def append(self, candles) -> int:
+        """
+        Append candles (dicts with time/open/high/low/close/volume), oldest first.
+        A candle with the same time as the last stored bar replaces it (forming
+        bar update); anything older than that is ignored. Returns bars written.
+        """
+        rows = sorted(candles, key=lambda c: int(c["time"]))
+        if not rows:
+            return 0
+
+        with self._write_lock():
+            # re-read under the lock: another process may have appended since
+            n = len(self)
+            last_time = None
+            if n:
+                with open(self._file("time"), "rb") as f:
+                    f.seek((n - 1) * ITEM_SIZE)
+                    last_time = array("q", f.read(ITEM_SIZE))[0]
+
+            replace = None
+            fresh = []
+            for c in rows:
+                t = int(c["time"])
+                if last_time is not None and t < last_time:
+                    continue
+                if last_time is not None and t == last_time:
+                    replace = c
+                    continue
+                if fresh and int(fresh[-1]["time"]) == t:
+                    fresh[-1] = c
+                else:
+                    fresh.append(c)
+
+            if replace is not None:
+                for col, fmt in COLUMNS:
+                    with open(self._file(col), "r+b") as f:
+                        f.seek((n - 1) * ITEM_SIZE)
+                        f.write(_to_bytes([replace.get(col, 0)], fmt))
+
+            if fresh:
+                # time is written last so a partially appended batch is never visible to readers
+                for col, fmt in COLUMNS[1:] + COLUMNS[:1]:
+                    with open(self._file(col), "ab") as f:
+                        f.write(_to_bytes([c.get(col, 0) for c in fresh], fmt))
+
+            return len(fresh) + (1 if replace is not None else 0)
+
+    def range(self, start: int | None = None, end: int | None = None) -> dict:
+        """Bars with start <= time <= end (seconds), as memoryview slices per column."""
+        cols = self.columns()
+        times = cols["time"]
+        lo = 0 if start is None else bisect.bisect_left(times, int(start))
+        hi = len(times) if end is None else bisect.bisect_right(times, int(end))
+        return {col: mv[lo:hi] for col, mv in cols.items()}
+
+    def tail(self, limit: int) -> dict:
+        """The most recent `limit` bars, as memoryview slices per column."""
+        cols = self.columns()
+        lo = max(0, len(cols["time"]) - int(limit))
+        return {col: mv[lo:] for col, mv in cols.items()}
+
+
+def to_rows(cols: dict) -> list:
+    """Materialize column slices into the /api/candles row format."""
+    return [
+        {"time": t, "open": o, "high": h, "low": l, "close": c, "volume": v}
+        for t, o, h, l, c, v in zip(
+            cols["time"], cols["open"], cols["high"],
+            cols["low"], cols["close"], cols["volume"],
+        )
+    ]
+
+
+def get_series(symbol: str, interval: str, synthetic: bool = False) -> CandleSeries:
+    """Shared series for a known (symbol, interval); ValueError for anything else."""
+    if not is_valid_series(symbol, interval):
+        raise ValueError(f"unknown candle series {symbol!r}/{interval!r}")
+    key = (symbol.upper(), interval, synthetic)
+    with _series_lock:
+        series = _series.get(key)
+        if series is None:
+            root = os.path.join(store_root(), "_synthetic") if synthetic else None
+            series = _series[key] = CandleSeries(symbol, interval, root=root)
+            while len(_series) > MAX_SERIES:
+                _series.popitem(last=False)
+        else:
+            _series.move_to_end(key)
+    return series
+
+
+def is_contiguous(cols: dict, step: int) -> bool:
+    """True if the bars in `cols` are consecutive `step`-second bars (no feed-downtime gap)."""
+    times = cols["time"]
+    return len(times) > 0 and times[-1] - times[0] == (len(times) - 1) * step
+
+
+def is_fresh(series: CandleSeries, max_age: float) -> bool:
+    return len(series) > 0 and time.time() - series.last_write() <= max_age
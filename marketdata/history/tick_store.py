@@ -0,0 +1,220 @@
+# marketdata/history/tick_store.py
+"""
+Compact on-disk tick history.
+
+Every normalized tick is one fixed 32-byte record
+
+    int64 ts_ms | float64 bid | float64 ask | uint16 symbol_id | 6 pad bytes
+
+appended to a daily per-symbol file <TICK_STORE_DIR>/<SYMBOL>/<YYYYMMDD>.ticks
+(UTC day). Range reads are a binary search over the memory-mapped file, so
+the ts column must never go backwards: the recorder clamps a tick older than
+the last one of its symbol to that timestamp, in memory and again against the
+file's last record under the append's flock (a restarted or second feed
+process). Within a process a buffer is popped and appended under one lock, so
+buffers for a file land in the order they were filled.
+"""
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+RECORD = struct.Struct("<qddH6x")
+_TS = struct.Struct("<q")
+
+# Stable ids written into each record: append new symbols, never renumber.
+SYMBOL_IDS = {
+    "EURUSD": 1, "GBPUSD": 2, "USDJPY": 3, "AUDUSD": 4, "USDCAD": 5,
+    "BTCUSDT": 6, "XAUUSD": 7, "XAGUSD": 8, "NZDUSD": 9,
+}
+
+FLUSH_RECORDS = 256   # flush a symbol's buffer once it holds this many records
+FLUSH_SECS = 1.0      # ... or when it is older than this
+
+
+def store_root() -> str:
+    root = getattr(settings, "TICK_STORE_DIR", None)
+    return root or os.path.join(str(settings.BASE_DIR), "var", "ticks")
+
+
+def _day(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).strftime("%Y%m%d")
+
+
+def tick_file(symbol: str, day: str, root: str | None = None) -> str:
+    return os.path.join(root or store_root(), symbol.upper(), f"{day}.ticks")
+
+
+class TickRecorder:
+    """Buffers ticks per (symbol, day) and appends them as fixed-size records."""
+
+    def __init__(self, root: str | None = None):
+        self.root = root
+        self._buffers = {}   # (symbol, day) -> bytearray
+        self._since = {}     # (symbol, day) -> monotonic time of first buffered record
+        self._last_ts = {}   # symbol -> newest ts recorded; older ticks are clamped to it
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # held from pop to write, so appends keep buffer order
+        self._flusher = None
+
+    def record(self, symbol: str, ts_ms: int, bid, ask):
+        symbol = symbol.upper()
+        sid = SYMBOL_IDS.get(symbol)
+        if sid is None:
+            return
+        ts_ms = int(ts_ms or time.time() * 1000)
+        bid = float(bid if bid is not None else ask or 0.0)
+        ask = float(ask if ask is not None else bid)
+
+        with self._lock:
+            # feed timestamps can arrive out of order; a sorted file is what range reads rely on
+            ts_ms = max(ts_ms, self._last_ts.get(symbol, ts_ms))
+            self._last_ts[symbol] = ts_ms
+            key = (symbol, _day(ts_ms))
+            buf = self._buffers.get(key)
+            if buf is None:
+                buf = self._buffers[key] = bytearray()
+                self._since[key] = time.monotonic()
+            buf += RECORD.pack(ts_ms, bid, ask, sid)
+            full = len(buf) >= FLUSH_RECORDS * RECORD.size
+
+        if full:
+            self.flush(key)
+        self._ensure_flusher()
+
+    def flush(self, only=None):
+        with self._write_lock:
+            with self._lock:
+                keys = [only] if only is not None else list(self._buffers)
+                pending = [(k, self._buffers.pop(k)) for k in keys if k in self._buffers]
+                for k, _ in pending:
+                    self._since.pop(k, None)
+
+            for (symbol, day), data in pending:
+                path = tick_file(symbol, day, self.root)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a+b") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        size = f.seek(0, os.SEEK_END)
+                        if size % RECORD.size:  # torn record from a crashed writer
+                            size -= size % RECORD.size
+                            f.truncate(size)
+                        if size:
+                            f.seek(size - RECORD.size)
+                            _clamp(data, _TS.unpack(f.read(_TS.size))[0])
+                        f.write(data)
+                        f.flush()
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_SECS)
+            now = time.monotonic()
+            with self._lock:
+                stale = [k for k, t in self._since.items() if now - t >= FLUSH_SECS]
+            for k in stale:
+                try:
+                    self.flush(k)
+                except Exception:
+                    pass
+
+
+def _clamp(data: bytearray, floor: int) -> None:
+    """Raise record timestamps in `data` below `floor` to it, in place."""
+    for off in range(0, len(data), RECORD.size):
+        if _TS.unpack_from(data, off)[0] >= floor:
+            break  # buffers are already in order
+        _TS.pack_into(data, off, floor)
+
+
+class _Timestamps:
+    """Sequence view of the ts column of an mmap'd tick file, for bisect."""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.n = len(buf) // RECORD.size
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return _TS.unpack_from(self.buf, i * RECORD.size)[0]
+
+
+def _days_between(start_ms: int, end_ms: int):
+    d = datetime.fromtimestamp(start_ms / 1000, tz=timezone.utc).date()
+    last = datetime.fromtimestamp(end_ms / 1000, tz=timezone.utc).date()
+    while d <= last:
+        yield d.strftime("%Y%m%d")
+        d += timedelta(days=1)
+
+
+def iter_ticks(symbol: str, start_ms: int, end_ms: int, root: str | None = None):
+    """Yield (ts_ms, bid, ask) for start_ms <= ts <= end_ms, oldest first."""
+    for day in _days_between(start_ms, end_ms):
+        path = tick_file(symbol, day, root)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        size -= size % RECORD.size  # ignore a torn trailing record
+        if not size:
+            continue
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            ts = _Timestamps(mm)
+            lo = bisect.bisect_left(ts, start_ms)
+            hi = bisect.bisect_right(ts, end_ms)
+            view = memoryview(mm)[lo * RECORD.size:hi * RECORD.size]
+            try:
+                for t, bid, ask, _sid in RECORD.iter_unpack(view):
+                    yield t, bid, ask
+            finally:
+                view.release()
+        finally:
+            mm.close()
+
+
+def read_ticks(symbol: str, start_ms: int, end_ms: int, limit: int | None = None,
+               root: str | None = None) -> list:
+    out = []
+    for t, bid, ask in iter_ticks(symbol, start_ms, end_ms, root):
+        out.append({"ts": t, "bid": bid, "ask": ask})
+        if limit and len(out) >= limit:
+            break
+    return out
+
+
+def iter_ticks_merged(symbols, start_ms: int, end_ms: int, root: str | None = None):
+    """Yield (ts_ms, symbol, bid, ask) across several symbols in timestamp order."""
+    def tagged(sym):
+        for t, bid, ask in iter_ticks(sym, start_ms, end_ms, root):
+            yield t, sym, bid, ask
+
+    return heapq.merge(*(tagged(s.upper()) for s in symbols), key=lambda rec: rec[0])
+
+
+def tick_at(symbol: str, ts_ms: int, lookback_ms: int = 60_000, root: str | None = None):
+    """Last recorded tick at or before ts_ms (within lookback), e.g. to audit a fill price."""
+    last = None
+    for t, bid, ask in iter_ticks(symbol, ts_ms - lookback_ms, ts_ms, root):
+        last = {"ts": t, "bid": bid, "ask": ask}
+    return last
+
+
+recorder = TickRecorder()
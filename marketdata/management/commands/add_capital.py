@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from decimal import Decimal
-from marketdata.models import UserAccount
+from django.db import transaction
+from django.db.models import F
+from marketdata.models import UserAccount, LedgerEntry
 
 class Command(BaseCommand):
     help = "Add capital to a user"
@@ -16,6 +18,9 @@ class Command(BaseCommand):
 
         user = User.objects.get(username=username)
         account, _ = UserAccount.objects.get_or_create(user=user)
-        account.balance += amount
-        account.save()
+        with transaction.atomic():
+            UserAccount.objects.filter(pk=account.pk).update(balance=F("balance") + amount)
+            # ledgered so point-in-time balances (services/balances.py) account for it
+            LedgerEntry.objects.create(user_id=user.id, kind="deposit" if amount >= 0 else "adj",
+                                       amount=amount, ref="add_capital")
         self.stdout.write(self.style.SUCCESS(f"Added {amount} capital to user {username}"))
@@ -0,0 +1,35 @@
+# marketdata/management/commands/apply_retention.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketdata.services.retention import apply_policy, policies
+
+
+class Command(BaseCommand):
+    help = ("Apply RETENTION_POLICIES: chunked deletes, downsampling and partition rotation "
+            "for the time-series tables; safe to run during trading hours")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10_000, help="Ids per DELETE statement")
+        parser.add_argument("--pause", type=float, default=0.05,
+                            help="Seconds to sleep between chunks, to leave room for writers")
+        parser.add_argument("--model", action="append", help="Only these policies, e.g. marketdata.PositionSnapshot")
+
+    def handle(self, *args, **opts):
+        selected = policies()
+        if opts["model"]:
+            wanted = {m.lower() for m in opts["model"]}
+            selected = [p for p in selected if p.model.lower() in wanted]
+
+        for policy in selected:
+            t0 = time.monotonic()
+            res = apply_policy(policy, chunk_size=opts["chunk_size"], pause=opts["pause"])
+            parts = ""
+            if res["partitions_dropped"] or res["partitions_created"]:
+                parts = (f", dropped partitions {res['partitions_dropped']}, "
+                         f"created {res['partitions_created']}")
+            self.stdout.write(self.style.SUCCESS(
+                f"{policy.model}: deleted {res['deleted']} rows older than {policy.keep_days}d, "
+                f"downsampled {res['downsampled']}{parts} in {time.monotonic() - t0:.1f}s"
+            ))
@@ -0,0 +1,104 @@
+# marketdata/management/commands/backfill_closed_trades.py
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum, Max
+
+from marketdata.contracts import spec_for
+from marketdata.engine.redis_ops import get_redis, k_posidx
+from marketdata.models import ClosedTrade, Fill, LedgerEntry, Order
+from marketdata.models_admintrades import AdminBroadcastTrade
+
+Q6 = Decimal("0.000001")
+
+
+class Command(BaseCommand):
+    help = "Build ClosedTrade rows for positions closed before the table existed (from realized_pnl ledger rows)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=1000, help="Positions per query batch")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **opts):
+        batch = opts["batch"]
+        done = set(ClosedTrade.objects.values_list("user_id", "position_id"))
+        groups = (
+            LedgerEntry.objects
+            .filter(kind="realized_pnl")
+            .exclude(ref__isnull=True).exclude(ref="")
+            .values("user_id", "ref", "symbol")
+            .annotate(realized=Sum("amount"), last_ts=Max("ts"))
+            .order_by("last_ts")
+        )
+        pending = [g for g in groups.iterator(chunk_size=batch) if (g["user_id"], g["ref"]) not in done]
+
+        created = skipped = 0
+        r = get_redis()
+        for i in range(0, len(pending), batch):
+            chunk = pending[i:i + batch]
+
+            # partial closes of positions that are still open are not closed trades yet
+            with r.pipeline(transaction=False) as p:
+                for g in chunk:
+                    p.sismember(k_posidx(g["user_id"]), g["ref"])
+                still_open = p.execute()
+            chunk = [g for g, is_open in zip(chunk, still_open) if not is_open]
+
+            refs = [g["ref"] for g in chunk]
+            first_order, last_fill = {}, {}
+            for o in Order.objects.filter(position_id__in=refs).order_by("created_at", "id"):
+                first_order.setdefault(o.position_id, o)
+            for f in (Fill.objects.filter(order__position_id__in=refs)
+                      .order_by("ts", "id").values("id", "price", "order__position_id")):
+                last_fill[f["order__position_id"]] = f
+            admin_trades = {
+                str(t.ref): t for t in AdminBroadcastTrade.objects.filter(ref__in=[
+                    ref for ref in refs if ref not in first_order and len(ref) == 36
+                ])
+            }
+
+            rows = []
+            for g in chunk:
+                ref = g["ref"]
+                opened_at, fill_id = None, None
+                if ref in first_order:
+                    o = first_order[ref]
+                    side, lots, entry, opened_at = o.side, o.lots, o.price, o.created_at
+                    fill = last_fill.get(ref)
+                    fill_id = fill["id"] if fill else None
+                elif ref in admin_trades:
+                    t = admin_trades[ref]
+                    side, lots, entry, opened_at = t.side, t.lots, t.entry_price, t.opened_at
+                else:
+                    skipped += 1
+                    continue
+                if not lots or entry is None:
+                    skipped += 1
+                    continue
+
+                direction = 1 if side == "Buy" else -1
+                try:
+                    contract = Decimal(str(spec_for(g["symbol"]).contract_size))
+                except Exception:
+                    contract = Decimal("1")
+                exit_price = entry + g["realized"] / (contract * lots * direction)
+                rows.append(ClosedTrade(
+                    user_id=g["user_id"],
+                    position_id=ref,
+                    symbol=g["symbol"] or "",
+                    side=side,
+                    lots=lots,
+                    entry_price=entry,
+                    exit_price=exit_price.quantize(Q6),
+                    realized_pnl=g["realized"],
+                    opened_at=opened_at,
+                    closed_at=g["last_ts"],
+                    close_fill_id=fill_id,
+                ))
+
+            if not opts["dry_run"]:
+                ClosedTrade.objects.bulk_create(rows, batch_size=batch)
+            created += len(rows)
+
+        verb = "Would create" if opts["dry_run"] else "Created"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {created} closed trades ({skipped} skipped)."))
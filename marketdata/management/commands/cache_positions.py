@@ -1,14 +1,49 @@
+import time
 import uuid
+from decimal import Decimal
+
 from django.core.management.base import BaseCommand
-from marketdata.engine.redis_ops import get_redis, k_pos, k_posidx, k_symidx
-from marketdata.models import PositionSnapshot  # Adjust to your actual model import path
+from marketdata.contracts import spec_for, SPECS
+from marketdata.engine.redis_ops import (
+    get_redis, k_pos, k_posidx, k_symidx, k_userpos, bump_positions_version, _apply_fill_math,
+)
+from marketdata.models import PositionSnapshot, PositionCheckpoint, Fill, ClosedTrade, UserAccount  # Adjust to your actual model import path
+
+PIPELINE_CMDS = 10_000
+
+# Index one position only while its hash still exists, so a close racing the
+# backfill can't leave a stale userpos/symidx entry behind.
+_INDEX_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('SADD', KEYS[3], ARGV[2])
+    return 1
+end
+return 0
+"""
 
 
 class Command(BaseCommand):
     help = "Populate Redis cache with all current positions"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true",
+                            help="Rebuild open positions from the fill history, keeping original position ids")
+        parser.add_argument("--clear", action="store_true",
+                            help="With --rebuild: delete existing pos/posidx/userpos/symidx keys first")
+        parser.add_argument("--source", choices=("fills", "checkpoint"), default="fills",
+                            help="With --rebuild: replay the fill history (exact) or load the last "
+                                 "run_position_checkpointer pass (fast, as of that pass)")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Server-side cursor chunk size")
+        parser.add_argument("--index-userpos", action="store_true",
+                            help="One-off: add positions opened before the per-symbol index to userpos/symidx")
+
     def handle(self, *args, **options):
         r = get_redis()
+        if options["rebuild"]:
+            return self._rebuild(r, options)
+        if options["index_userpos"]:
+            return self._index_userpos(r)
 
         count = 0
         for pos in PositionSnapshot.objects.all():
@@ -28,10 +63,184 @@ class Command(BaseCommand):
 
             # Add this position id to user position index
             r.sadd(k_posidx(uid), position_id)
+            r.sadd(k_userpos(uid, pos.symbol), position_id)
 
             # Add user id to symbol index
             r.sadd(k_symidx(pos.symbol), uid)
+            bump_positions_version(r, uid, position_id)
 
             count += 1
 
         self.stdout.write(self.style.SUCCESS(f"Cached {count} positions in Redis."))
+
+    # ---- --index-userpos ----
+
+    def _index_userpos(self, r):
+        """
+        Walk posidx:* and add every open position to userpos:{uid}:{symbol} and
+        its user to symidx:{symbol}. Only adds, so it is safe to re-run and to
+        run next to live trading.
+        """
+        index = r.register_script(_INDEX_LUA)
+        indexed = users = 0
+        for key in r.scan_iter(match="posidx:*", count=1000):
+            uid = key.split(":", 1)[1]
+            position_ids = list(r.smembers(key) or ())
+            if not position_ids:
+                continue
+            with r.pipeline(transaction=False) as p:
+                for pid in position_ids:
+                    p.hget(k_pos(uid, pid), "symbol")
+                symbols = p.execute()
+            with r.pipeline(transaction=False) as p:
+                for pid, sym in zip(position_ids, symbols):
+                    if sym:
+                        index(keys=[k_pos(uid, pid), k_userpos(uid, sym.upper()), k_symidx(sym.upper())],
+                              args=[pid, uid], client=p)
+                indexed += sum(p.execute())
+            users += 1
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} positions for {users} users."))
+
+    # ---- --rebuild ----
+
+    def _open_positions(self, chunk_size):
+        """
+        Replay fills position by position (one ordered server-side cursor) and
+        yield (position_id, state) for those still open. Positions that already
+        have a ClosedTrade row are skipped in SQL.
+        """
+        fills = (
+            Fill.objects
+            .filter(order__position_id__isnull=False)
+            .exclude(order__position_id__in=ClosedTrade.objects.values("position_id"))
+            .order_by("order__position_id", "ts", "id")
+            .values_list("order__position_id", "user_id", "symbol", "side", "lots", "price",
+                         "ts", "order__leverage")
+            .iterator(chunk_size=chunk_size)
+        )
+
+        current, st = None, None
+        for pid, uid, symbol, side, lots, price, ts, leverage in fills:
+            if pid != current:
+                if st and abs(st["net_lots"]) > 1e-12:
+                    yield current, st
+                current = pid
+                st = {"user_id": uid, "symbol": symbol.upper(), "net_lots": 0.0, "avg_entry": None,
+                      "open_time": int(ts.timestamp()), "leverage": int(leverage or 500),
+                      "realized_total": 0.0, "closed_lots": 0.0, "updated_at": int(ts.timestamp()),
+                      "contract_size": spec_for(symbol).contract_size}
+            q = float(lots) if side == "Buy" else -float(lots)
+            L = st["net_lots"]
+            if L and (L > 0) != (q > 0):
+                st["closed_lots"] += min(abs(q), abs(L))
+            new_net, new_avg, realized = _apply_fill_math(L, st["avg_entry"], q, float(price), st["contract_size"])
+            st["net_lots"], st["avg_entry"] = float(new_net), new_avg
+            st["realized_total"] += float(realized or 0)
+            st["updated_at"] = int(ts.timestamp())
+            if abs(st["net_lots"]) < 1e-12:
+                # flat mid-history; a later fill on the same id starts a fresh position
+                st.update(avg_entry=None, realized_total=0.0, closed_lots=0.0, open_time=None)
+            elif st["open_time"] is None:
+                st["open_time"] = int(ts.timestamp())
+        if st and abs(st["net_lots"]) > 1e-12:
+            yield current, st
+
+    def _checkpointed_positions(self, chunk_size):
+        """Same (position_id, state) shape as _open_positions, from PositionCheckpoint."""
+        for cp in PositionCheckpoint.objects.order_by("user_id", "position_id").iterator(chunk_size=chunk_size):
+            try:
+                cs = float(spec_for(cp.symbol).contract_size)
+            except Exception:
+                cs = 1.0
+            yield cp.position_id, {
+                "user_id": cp.user_id,
+                "symbol": cp.symbol,
+                "net_lots": float(cp.net_lots),
+                "avg_entry": float(cp.avg_entry),
+                "open_time": cp.open_time,
+                "leverage": cp.leverage,
+                "realized_total": float(cp.realized_total),
+                "closed_lots": float(cp.closed_lots),
+                "updated_at": cp.updated_at or int(cp.checkpointed_at.timestamp()),
+                "contract_size": cs,
+            }
+
+    def _clear(self, r):
+        n = 0
+        for pattern in ("pos:*", "posidx:*", "userpos:*", "symidx:*"):
+            batch = []
+            for key in r.scan_iter(match=pattern, count=5000):
+                batch.append(key)
+                if len(batch) >= 5000:
+                    n += r.unlink(*batch)
+                    batch = []
+            if batch:
+                n += r.unlink(*batch)
+        return n
+
+    def _rebuild(self, r, options):
+        started = time.monotonic()
+        if options["clear"]:
+            self.stdout.write(f"Removed {self._clear(r)} existing position keys.")
+
+        # value positions at the last known marks (if Redis still has them), else at entry
+        symbols = list(SPECS)
+        marks = {sym: float(m) for sym, m in zip(symbols, r.mget([f"mark:{s}" for s in symbols]))
+                 if m is not None}
+
+        totals = {}     # uid -> [used_margin, unreal]
+        touched = {}    # uid -> [position ids]
+        count = 0
+        now = int(time.time())
+        p = r.pipeline(transaction=False)
+        source = self._checkpointed_positions if options["source"] == "checkpoint" else self._open_positions
+        for pid, st in source(options["chunk_size"]):
+            uid, sym, net, avg = st["user_id"], st["symbol"], st["net_lots"], st["avg_entry"]
+            cs, lev = st["contract_size"], st["leverage"]
+            mark = marks.get(sym, avg)
+            margin = abs(net * cs * mark) / max(1, lev)
+            unreal = (mark - avg) * cs * net
+
+            p.hset(k_pos(uid, pid), mapping={
+                "net_lots": net,
+                "avg_entry": avg,
+                "updated_at": now,
+                "mode": "netting",
+                "side": "Buy" if net > 0 else "Sell",
+                "symbol": sym,
+                "open_time": st["open_time"] or st["updated_at"],
+                "leverage": lev,
+                "margin": margin,
+                "unreal_pnl": unreal,
+                "last_mark": mark,
+                "realized_total": st["realized_total"],
+                "closed_lots": st["closed_lots"],
+            })
+            p.sadd(k_posidx(uid), pid)
+            p.sadd(k_userpos(uid, sym), pid)
+            p.sadd(k_symidx(sym), uid)
+
+            t = totals.setdefault(uid, [Decimal("0"), Decimal("0")])
+            t[0] += Decimal(str(margin))
+            t[1] += Decimal(str(unreal))
+            touched.setdefault(uid, []).append(pid)
+            count += 1
+            if len(p) >= PIPELINE_CMDS:
+                p.execute()
+
+        for uid, pids in touched.items():
+            bump_positions_version(p, uid, *pids)
+            if len(p) >= PIPELINE_CMDS:
+                p.execute()
+        p.execute()
+
+        # account totals: one bulk UPDATE per chunk; accounts without open positions go to zero
+        accounts = list(UserAccount.objects.only("id", "user_id", "used_margin", "unrealized_pnl"))
+        for acc in accounts:
+            used, unreal = totals.get(acc.user_id, (Decimal("0"), Decimal("0")))
+            acc.used_margin, acc.unrealized_pnl = used, unreal
+        UserAccount.objects.bulk_update(accounts, ["used_margin", "unrealized_pnl"], batch_size=2000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {count} open positions for {len(touched)} users in {time.monotonic() - started:.1f}s."
+        ))
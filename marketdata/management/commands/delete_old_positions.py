@@ -1,9 +1,11 @@
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand
 from django.utils.timezone import now
-from datetime import timedelta
+
 from marketdata.models import PositionSnapshot
-from django.utils.timezone import make_aware
-import datetime
+from marketdata.services.retention import delete_before
+
 
 class Command(BaseCommand):
     help = "Delete PositionSnapshot records older than specified days (default 7)"
@@ -15,15 +17,16 @@ class Command(BaseCommand):
             default=7,
             help='Delete positions older than this many days (default: 7)',
         )
+        parser.add_argument('--chunk-size', type=int, default=10_000, help='Ids per DELETE statement')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to sleep between chunks')
 
     def handle(self, *args, **options):
         days = options['days']
-        cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days)
-        cutoff_date = make_aware(cutoff_date)  # Make timezone aware datetime
-        
-        qs = PositionSnapshot.objects.filter(ts__lt=cutoff_date)
-        count, _ = qs.delete()
+        cutoff_date = now() - timedelta(days=days)
+
+        count = delete_before(PositionSnapshot, "ts", cutoff_date,
+                              chunk_size=options['chunk_size'], pause=options['pause'])
 
         self.stdout.write(self.style.SUCCESS(
             f"Deleted {count} position snapshots older than {days} days."
-        ))
\ No newline at end of file
+        ))
@@ -0,0 +1,170 @@
+# marketdata/management/commands/reconcile_accounts.py
+import json, sys, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from marketdata.engine.redis_ops import get_redis, k_pos, k_posidx
+from marketdata.models import UserAccount
+from marketdata.services.balances import ledger_balances, balance_at
+
+ZERO = Decimal("0")
+
+
+def _dec(v) -> Decimal:
+    try:
+        return Decimal(str(v)) if v not in (None, "") else ZERO
+    except Exception:
+        return ZERO
+
+
+class Command(BaseCommand):
+    help = ("Compare Redis position totals and ledger-derived balances with UserAccount for every account; "
+            "writes one JSON line per discrepancy plus a summary line")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=1000, help="Accounts per batch")
+        parser.add_argument("--workers", type=int, default=8, help="Concurrent batches")
+        parser.add_argument("--tolerance", type=str, default="0.01", help="Absolute difference to ignore")
+        parser.add_argument("--output", default="-", help="JSON lines file (default stdout)")
+        parser.add_argument("--user", type=int, action="append", help="Only these user ids (repeatable)")
+        parser.add_argument("--repair", action="store_true",
+                            help="Write Redis totals into UserAccount and drop stale position index entries")
+        parser.add_argument("--repair-balance", action="store_true",
+                            help="Also reset UserAccount.balance to the ledger-derived balance")
+
+    # ---- one batch ----
+
+    def _check_batch(self, user_ids, tol, repair, repair_balance):
+        try:
+            return self._check_batch_inner(user_ids, tol, repair, repair_balance)
+        finally:
+            connection.close()  # worker threads get their own DB connection
+
+    def _check_batch_inner(self, user_ids, tol, repair, repair_balance):
+        r = get_redis()
+        with r.pipeline(transaction=False) as p:
+            for uid in user_ids:
+                p.smembers(k_posidx(uid))
+            indexes = p.execute()
+
+        refs = [(uid, pid) for uid, ids in zip(user_ids, indexes) for pid in (ids or ())]
+        with r.pipeline(transaction=False) as p:
+            for uid, pid in refs:
+                p.hmget(k_pos(uid, pid), "net_lots", "margin", "unreal_pnl")
+            rows = p.execute() if refs else []
+
+        redis_totals = {uid: [ZERO, ZERO, 0] for uid in user_ids}   # used_margin, unreal, positions
+        stale = []
+        for (uid, pid), (net, margin, unreal) in zip(refs, rows):
+            if net is None or abs(float(net or 0)) < 1e-12:
+                stale.append((uid, pid))
+                continue
+            t = redis_totals[uid]
+            t[0] += _dec(margin)
+            t[1] += _dec(unreal)
+            t[2] += 1
+
+        accounts = {
+            a["user_id"]: a for a in
+            UserAccount.objects.filter(user_id__in=user_ids)
+            .values("user_id", "balance", "used_margin", "unrealized_pnl")
+        }
+        ledger = ledger_balances(user_ids)
+
+        issues = []
+        fix_totals = []
+        fix_balance = []
+        for uid in user_ids:
+            acc = accounts.get(uid)
+            if acc is None:
+                issues.append({"user_id": uid, "field": "account", "issue": "missing_account"})
+                continue
+            used, unreal, npos = redis_totals[uid]
+            needs_fix = False
+            for field, redis_val, db_val in (
+                ("used_margin", used, acc["used_margin"]),
+                ("unrealized_pnl", unreal, acc["unrealized_pnl"]),
+            ):
+                if abs(redis_val - db_val) > tol:
+                    issues.append({"user_id": uid, "field": field, "redis": str(redis_val),
+                                   "db": str(db_val), "diff": str(redis_val - db_val), "positions": npos})
+                    needs_fix = True
+            if needs_fix:
+                fix_totals.append(UserAccount(user_id=uid, used_margin=used, unrealized_pnl=unreal))
+
+            expected = ledger[uid]
+            if expected is not None and abs(expected - acc["balance"]) > tol:
+                issues.append({"user_id": uid, "field": "balance", "ledger": str(expected),
+                               "db": str(acc["balance"]), "diff": str(expected - acc["balance"])})
+                fix_balance.append(uid)
+
+        for uid, pid in stale:
+            issues.append({"user_id": uid, "field": "posidx", "issue": "stale_index_entry", "position_id": pid})
+
+        repaired = 0
+        if repair:
+            for a in fix_totals:
+                repaired += UserAccount.objects.filter(user_id=a.user_id).update(
+                    used_margin=a.used_margin, unrealized_pnl=a.unrealized_pnl)
+            if stale:
+                with r.pipeline(transaction=False) as p:
+                    for uid, pid in stale:
+                        p.srem(k_posidx(uid), pid)
+                    p.execute()
+                repaired += len(stale)
+        if repair_balance:
+            from django.utils import timezone
+            for uid in fix_balance:
+                # re-derive under the row lock; the batch read can race a fill being booked
+                with transaction.atomic():
+                    acc = UserAccount.objects.select_for_update().get(user_id=uid)
+                    expected = balance_at(uid, timezone.now())
+                    if expected is not None and abs(expected - acc.balance) > tol:
+                        acc.balance = expected
+                        acc.save(update_fields=["balance"])
+                        repaired += 1
+
+        return len(user_ids), issues, repaired
+
+    # ---- driver ----
+
+    def handle(self, *args, **opts):
+        tol = Decimal(opts["tolerance"])
+        out = sys.stdout if opts["output"] == "-" else open(opts["output"], "w")
+        started = time.monotonic()
+
+        users = UserAccount.objects.order_by("user_id").values_list("user_id", flat=True)
+        if opts["user"]:
+            users = users.filter(user_id__in=opts["user"])
+        ids = list(users.iterator(chunk_size=10_000))
+        batches = [ids[i:i + opts["batch"]] for i in range(0, len(ids), opts["batch"])]
+
+        checked = repaired = 0
+        counts = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, opts["workers"])) as pool:
+                futures = [
+                    pool.submit(self._check_batch, b, tol, opts["repair"], opts["repair_balance"])
+                    for b in batches
+                ]
+                for fut in as_completed(futures):
+                    n, issues, fixed = fut.result()
+                    checked += n
+                    repaired += fixed
+                    for issue in issues:
+                        counts[issue["field"]] = counts.get(issue["field"], 0) + 1
+                        out.write(json.dumps(issue) + "\n")
+
+            out.write(json.dumps({"summary": {
+                "accounts": checked,
+                "discrepancies": sum(counts.values()),
+                "by_field": counts,
+                "repaired": repaired,
+                "elapsed_s": round(time.monotonic() - started, 2),
+            }}) + "\n")
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,216 @@
+import json, time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from marketdata.contracts import spec_for
+from marketdata.engine.redis_ops import (
+    get_redis, k_pos, k_posidx, k_symidx, k_userpos, bump_positions_version,
+)
+from marketdata.history.tick_store import SYMBOL_IDS, iter_ticks_merged, tick_at
+from marketdata.models import UserAccount
+
+ENGINE_STATS_KEY = "engine:stats"
+REPLAY_USER_PREFIX = "replay_user_"
+
+
+def k_replay_ticks(symbol: str) -> str:
+    """Replay tick channel; only an engine started with --replay subscribes to it, never the live one."""
+    return f"replay:ticks:{symbol}"
+
+
+def k_replay_mark(symbol: str) -> str:
+    """Last replayed mid; kept apart from the live mark:{sym} the feed maintains."""
+    return f"replay:mark:{symbol}"
+
+
+def _parse_ts(value: str) -> int:
+    """Epoch milliseconds or an ISO-8601 datetime (UTC if naive) -> epoch ms."""
+    if value.isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+class Command(BaseCommand):
+    help = ("Replay recorded ticks onto replay:ticks:* at real-time, N x or max speed and report "
+            "throughput/lag of an engine started with run_positions_engine --replay")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", required=True, help="Epoch ms or ISO datetime (UTC)")
+        parser.add_argument("--end", required=True, help="Epoch ms or ISO datetime (UTC)")
+        parser.add_argument("--symbols", default=",".join(SYMBOL_IDS), help="Comma-separated symbols to replay")
+        parser.add_argument("--speed", type=float, default=1.0,
+                            help="Playback multiplier (1 = real time, 10 = 10x); 0 = as fast as possible")
+        parser.add_argument("--users", type=int, default=0, help="Synthetic users to open positions for")
+        parser.add_argument("--positions-per-user", type=int, default=1)
+        parser.add_argument("--lots", type=float, default=0.1)
+        parser.add_argument("--leverage", type=int, default=500)
+        parser.add_argument("--keep-positions", action="store_true",
+                            help="Leave synthetic positions in Redis after the run")
+        parser.add_argument("--report-every", type=float, default=5.0, help="Seconds between progress lines")
+        parser.add_argument("--i-know-this-is-live", action="store_true", dest="force_live",
+                            help="Run even though REPLAY_TICKS_ALLOWED is not set; a --replay engine marks "
+                                 "every open position on the replayed symbols, real users' included")
+
+    # ---- synthetic population ----
+
+    def _replay_users(self, n):
+        names = [f"{REPLAY_USER_PREFIX}{i}" for i in range(n)]
+        existing = set(User.objects.filter(username__in=names).values_list("username", flat=True))
+        User.objects.bulk_create(
+            [User(username=name, is_active=False) for name in names if name not in existing],
+            batch_size=1000,
+        )
+        uids = list(User.objects.filter(username__in=names).values_list("id", flat=True))
+        have = set(UserAccount.objects.filter(user_id__in=uids).values_list("user_id", flat=True))
+        UserAccount.objects.bulk_create(
+            [UserAccount(user_id=uid, balance=1_000_000) for uid in uids if uid not in have],
+            batch_size=1000,
+        )
+        return uids
+
+    def _open_positions(self, r, uids, symbols, per_user, lots, leverage, start_ms):
+        now = int(time.time())
+        entry = {}
+        for sym in symbols:
+            t = tick_at(sym, start_ms, lookback_ms=24 * 3600 * 1000)
+            if t is None:
+                raise CommandError(f"No recorded {sym} tick in the 24h before --start to open positions at")
+            entry[sym] = (t["bid"] + t["ask"]) / 2.0
+
+        opened = []
+        with r.pipeline(transaction=False) as p:
+            for n, uid in enumerate(uids):
+                for j in range(per_user):
+                    sym = symbols[(n * per_user + j) % len(symbols)]
+                    net = lots if j % 2 == 0 else -lots
+                    pid = f"replay-{uid}-{j}"
+                    p.hset(k_pos(uid, pid), mapping={
+                        "net_lots": net,
+                        "avg_entry": entry[sym],
+                        "updated_at": now,
+                        "mode": "netting",
+                        "side": "Buy" if net > 0 else "Sell",
+                        "symbol": sym,
+                        "open_time": now,
+                        "leverage": leverage,
+                    })
+                    p.sadd(k_posidx(uid), pid)
+                    p.sadd(k_userpos(uid, sym), pid)
+                    p.sadd(k_symidx(sym), uid)
+                    bump_positions_version(p, uid, pid)
+                    opened.append((uid, pid, sym))
+                if len(p) >= 5000:
+                    p.execute()
+            p.execute()
+        return opened
+
+    def _close_positions(self, r, opened):
+        with r.pipeline(transaction=False) as p:
+            for uid, pid, sym in opened:
+                p.delete(k_pos(uid, pid))
+                p.srem(k_posidx(uid), pid)
+                p.srem(k_userpos(uid, sym), pid)
+                bump_positions_version(p, uid, pid)
+            for uid, sym in {(uid, sym) for uid, _, sym in opened}:
+                p.srem(k_symidx(sym), uid)
+            p.execute()
+
+    # ---- replay ----
+
+    def _engine_stats(self, r):
+        s = r.hgetall(ENGINE_STATS_KEY) or {}
+        return {
+            "ticks": int(s.get("ticks", 0) or 0),
+            "lag_sum_ms": float(s.get("lag_sum_ms", 0) or 0),
+            "lag_count": int(s.get("lag_count", 0) or 0),
+            "last_lag_ms": float(s.get("last_lag_ms", 0) or 0),
+        }
+
+    def handle(self, *args, **opts):
+        if not (getattr(settings, "REPLAY_TICKS_ALLOWED", False) or opts["force_live"]):
+            raise CommandError(
+                "Replaying ticks rewrites P&L, margin and risk state of every position on the replayed "
+                "symbols. Set REPLAY_TICKS_ALLOWED on a load-test deployment or pass --i-know-this-is-live."
+            )
+        start_ms, end_ms = _parse_ts(opts["start"]), _parse_ts(opts["end"])
+        if end_ms <= start_ms:
+            raise CommandError("--end must be after --start")
+        symbols = [s.strip().upper() for s in opts["symbols"].split(",") if s.strip()]
+        for sym in symbols:
+            spec_for(sym)  # KeyError for unknown symbols
+        speed = opts["speed"]
+
+        r = get_redis()
+        opened = []
+        if opts["users"] > 0:
+            uids = self._replay_users(opts["users"])
+            opened = self._open_positions(
+                r, uids, symbols, opts["positions_per_user"], opts["lots"], opts["leverage"], start_ms
+            )
+            self.stdout.write(f"Opened {len(opened)} synthetic positions for {len(uids)} users.")
+
+        base = self._engine_stats(r)
+        sent = 0
+        wall0 = time.monotonic()
+        last_report = wall0
+        t0 = None
+
+        try:
+            with r.pipeline(transaction=False) as p:
+                for ts_ms, sym, bid, ask in iter_ticks_merged(symbols, start_ms, end_ms):
+                    if t0 is None:
+                        t0 = ts_ms
+                    if speed > 0:
+                        delay = wall0 + (ts_ms - t0) / 1000.0 / speed - time.monotonic()
+                        if delay > 0:
+                            p.execute()
+                            time.sleep(delay)
+
+                    mid = (bid + ask) / 2.0
+                    p.publish(k_replay_ticks(sym), json.dumps({
+                        "symbol": sym,
+                        "mid": mid,
+                        "ts": ts_ms // 1000,
+                        "sent_ms": int(time.time() * 1000),
+                    }))
+                    p.set(k_replay_mark(sym), mid)
+                    sent += 1
+                    if len(p) >= 200:
+                        p.execute()
+
+                    now = time.monotonic()
+                    if now - last_report >= opts["report_every"]:
+                        p.execute()
+                        self._report(r, base, sent, now - wall0)
+                        last_report = now
+                p.execute()
+        finally:
+            elapsed = time.monotonic() - wall0
+            # let the engine drain what it has queued before the final reading
+            time.sleep(1.0)
+            self._report(r, base, sent, elapsed, final=True)
+            if opened and not opts["keep_positions"]:
+                self._close_positions(r, opened)
+                self.stdout.write(f"Removed {len(opened)} synthetic positions.")
+
+    def _report(self, r, base, sent, elapsed, final=False):
+        stats = self._engine_stats(r)
+        processed = stats["ticks"] - base["ticks"]
+        lag_n = stats["lag_count"] - base["lag_count"]
+        avg_lag = (stats["lag_sum_ms"] - base["lag_sum_ms"]) / lag_n if lag_n else 0.0
+        elapsed = max(elapsed, 1e-9)
+        line = (
+            f"published={sent} ({sent / elapsed:,.0f}/s)  "
+            f"engine_processed={processed} ({processed / elapsed:,.0f}/s)  "
+            f"engine_lag_ms avg={avg_lag:.1f} last={stats['last_lag_ms']:.1f}"
+        )
+        if final:
+            self.stdout.write(self.style.SUCCESS(f"Replay finished in {elapsed:.1f}s: {line}"))
+        else:
+            self.stdout.write(line)
@@ -0,0 +1,30 @@
+# marketdata/management/commands/requeue_dead_fills.py
+import json
+
+from django.core.management.base import BaseCommand
+
+from marketdata.engine.journal import DEAD_LETTER_STREAM, requeue_dead_letters
+from marketdata.engine.redis_ops import get_redis
+
+
+class Command(BaseCommand):
+    help = "List or requeue fill events dead-lettered by run_fill_persister (journal:fills:dead)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", help="Dead-letter stream ids to requeue (default: all)")
+        parser.add_argument("--list", action="store_true", help="Only print the dead-lettered events")
+        parser.add_argument("--count", type=int, default=1000, help="Max events per run without ids")
+
+    def handle(self, *args, **opts):
+        r = get_redis()
+        if opts["list"]:
+            for sid, fields in r.xrange(DEAD_LETTER_STREAM, count=opts["count"]):
+                ev = json.loads(fields["data"])
+                self.stdout.write(
+                    f"{sid} eid={ev.get('eid')} user={ev.get('user_id')} {ev.get('side')} "
+                    f"{ev.get('lots')} {ev.get('symbol')} @ {ev.get('price')}: {fields.get('error', '')}"
+                )
+            return
+        moved = requeue_dead_letters(r, ids=opts["ids"], count=opts["count"])
+        left = r.xlen(DEAD_LETTER_STREAM)
+        self.stdout.write(self.style.SUCCESS(f"Requeued {moved} fill event(s); {left} left in {DEAD_LETTER_STREAM}."))
@@ -0,0 +1,126 @@
+# marketdata/management/commands/run_fill_persister.py
+import json, os, socket, time
+
+from django.core.management.base import BaseCommand
+from redis import from_url
+from redis.exceptions import ResponseError
+
+from marketdata.engine.journal import (
+    JOURNAL_STREAM, JOURNAL_GROUP, DEAD_LETTER_STREAM, MAX_DELIVERIES,
+    decode_entries, is_transient, persist_fill_events, trim_journal,
+)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+
+RECLAIM_IDLE_MS = 60_000   # take over entries another persister read but never acked
+TRIM_EVERY_SECS = 60
+
+
+class Command(BaseCommand):
+    help = "Drain the fill journal (journal:fills) into Order/Fill/PositionSnapshot/LedgerEntry in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500, help="Max events per database transaction")
+        parser.add_argument("--block-ms", type=int, default=1000, help="XREADGROUP block timeout")
+        parser.add_argument("--consumer", default=None, help="Consumer name (default host-pid)")
+
+    def _ensure_group(self, r):
+        try:
+            r.xgroup_create(JOURNAL_STREAM, JOURNAL_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _persist(self, r, entries):
+        if not entries:
+            return
+        decoded = decode_entries(entries)
+        failed = set()
+        try:
+            self._booked += persist_fill_events([ev for _, ev in decoded])
+        except Exception as e:
+            if is_transient(e):
+                # database unreachable: leave the whole batch pending for the reclaim pass
+                self.stderr.write(f"database unavailable, {len(entries)} fill events left pending: {e}")
+                return
+            # book what can be booked one event at a time; the rest stays pending
+            for sid, ev in decoded:
+                try:
+                    self._booked += persist_fill_events([ev])
+                except Exception as e:
+                    if not is_transient(e) and self._dead_letter(r, sid, ev, e):
+                        continue
+                    failed.add(sid)
+                    self.stderr.write(f"fill event {sid} failed, left pending: {e}")
+        # ack everything else we saw, including empty (deleted) entries
+        done = [sid for sid, _ in entries if sid not in failed]
+        if done:
+            r.xack(JOURNAL_STREAM, JOURNAL_GROUP, *done)
+
+    def _dead_letter(self, r, sid, event, error) -> bool:
+        """
+        Move an entry delivered MAX_DELIVERIES times to the dead-letter stream; True if moved.
+        Only called for non-transient errors; `requeue_dead_fills` replays what lands there.
+        """
+        info = r.xpending_range(JOURNAL_STREAM, JOURNAL_GROUP, min=sid, max=sid, count=1)
+        if not info or info[0]["times_delivered"] < MAX_DELIVERIES:
+            return False
+        r.xadd(DEAD_LETTER_STREAM, {
+            "data": json.dumps(event, default=str),
+            "stream_id": sid,
+            "error": f"{type(error).__name__}: {error}",
+        })
+        self.stderr.write(f"fill event {sid} dead-lettered after {info[0]['times_delivered']} attempts: {error}")
+        return True
+
+    def handle(self, *args, **opts):
+        r = from_url(REDIS_URL, decode_responses=True)
+        consumer = opts["consumer"] or f"{socket.gethostname()}-{os.getpid()}"
+        batch = opts["batch"]
+        self._ensure_group(r)
+        self._booked = 0
+
+        self.stdout.write(self.style.SUCCESS(f"Fill persister started as {consumer}."))
+
+        # our own unacked entries from a previous run come first
+        while True:
+            resp = r.xreadgroup(JOURNAL_GROUP, consumer, {JOURNAL_STREAM: "0"}, count=batch)
+            entries = resp[0][1] if resp else []
+            if not entries:
+                break
+            self._persist(r, entries)
+
+        last_reclaim = 0.0
+        last_trim = 0.0
+        last_report = time.monotonic()
+        while True:
+            try:
+                now = time.monotonic()
+                if now - last_reclaim >= RECLAIM_IDLE_MS / 1000:
+                    _next, claimed, *_ = r.xautoclaim(
+                        JOURNAL_STREAM, JOURNAL_GROUP, consumer, RECLAIM_IDLE_MS, "0-0", count=batch
+                    )
+                    self._persist(r, claimed)
+                    last_reclaim = now
+
+                resp = r.xreadgroup(
+                    JOURNAL_GROUP, consumer, {JOURNAL_STREAM: ">"},
+                    count=batch, block=opts["block_ms"],
+                )
+                if resp:
+                    self._persist(r, resp[0][1])
+
+                if now - last_trim >= TRIM_EVERY_SECS:
+                    trim_journal(r)
+                    last_trim = now
+
+                if now - last_report >= 60:
+                    self.stdout.write(f"booked {self._booked} fills")
+                    last_report = now
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                self.stderr.write(f"persister error: {e}")
+                time.sleep(1.0)
+
+        self.stdout.write(self.style.WARNING("Fill persister stopped."))
@@ -0,0 +1,32 @@
+# marketdata/management/commands/run_jobs.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from marketdata.services import jobs
+
+
+class Command(BaseCommand):
+    help = "Worker for BackgroundJob rows (admin trade applications etc.); run one or more in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+
+    def handle(self, *args, **opts):
+        worker = jobs.worker_name()
+        self.stdout.write(self.style.SUCCESS(f"Job worker {worker} started."))
+        while True:
+            close_old_connections()
+            job = jobs.claim(worker)
+            if job is None:
+                if opts["once"]:
+                    return
+                time.sleep(opts["poll"])
+                continue
+            t0 = time.monotonic()
+            jobs.run(job)
+            self.stdout.write(f"job #{job.id} {job.kind}: {job.status} "
+                              f"({job.progress_done}/{job.progress_total or '?'}) in {time.monotonic() - t0:.1f}s"
+                              + (f" - {job.error}" if job.status != "done" and job.error else ""))
@@ -12,11 +12,14 @@ from asgiref.sync import async_to_sync
 
 from marketdata.models import UserAccount
 from marketdata.engine.redis_ops import k_posidx, k_pos
+from marketdata.engine.risk import k_risk, set_risk_exposure
+from marketdata.engine.capital import capital_delta, capital_view, k_capseq
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
 
 SEND_COOLDOWN_SECS = 2.0        # throttle websocket pushes per user
 SLEEP_BETWEEN_PASSES = 0.25     # main loop sleep
+FULL_REFRESH_SECS = 30.0        # push every capital field at least this often
 
 
 class Command(BaseCommand):
@@ -29,6 +32,8 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS("Margin updater started (no recompute)."))
 
         last_push_at: dict[str, float] = {}
+        last_sent: dict[str, dict] = {}   # capital last pushed per user, for deltas
+        last_full: dict[str, float] = {}  # time of the last all-fields push per user
 
         try:
             while True:
@@ -78,26 +83,37 @@ class Command(BaseCommand):
                             acc.used_margin = total_used_margin
                             acc.save(update_fields=["unrealized_pnl", "used_margin"])
 
-                            # Compute (do not assign) equity/free for the payload
-                            equity = (acc.balance or Decimal("0")) + acc.unrealized_pnl
-                            free_margin = equity - acc.used_margin
-
-                            capital_payload = {
-                                "balance": float(acc.balance),
-                                "equity": float(equity),
-                                "used_margin": float(acc.used_margin),
-                                "free_margin": float(free_margin),
-                                "unrealized_pnl": float(acc.unrealized_pnl),
-                            }
-
-                        # --- Push to user websocket group ---
-                        async_to_sync(ch_layer.group_send)(
-                            f"user_{uid}",
-                            {
-                                "type": "capital_update",
-                                "capital": capital_payload,
-                            },
-                        )
+                            # refresh the pre-trade risk exposure from the same numbers, reading
+                            # what capital snapshots were served from until now in the same MULTI;
+                            # its balance is left alone, acc.balance lags the fill journal
+                            with r.pipeline() as p:
+                                p.hmget(k_risk(uid), "balance", "used_margin", "unreal_pnl")
+                                set_risk_exposure(p, uid, acc.used_margin, acc.unrealized_pnl)
+                                hot = p.execute()[0]
+
+                            # equity/free are derived for the payload, never stored
+                            capital_payload = capital_view(acc.balance, acc.used_margin, acc.unrealized_pnl)
+                            free_margin = (acc.balance or Decimal("0")) + acc.unrealized_pnl - acc.used_margin
+
+                        # --- Push only changed fields, numbered by capseq:{uid} ---
+                        # against both what was last pushed and what a snapshot may have shown
+                        # (fills move risk:{uid} between passes), plus a periodic full refresh
+                        changed = capital_delta(last_sent.get(uid), capital_payload)
+                        if hot[0] is not None:
+                            changed.update(capital_delta(capital_view(*hot), capital_payload))
+                        if now - last_full.get(uid, 0.0) >= FULL_REFRESH_SECS:
+                            changed = dict(capital_payload)
+                            last_full[uid] = now
+                        if changed:
+                            async_to_sync(ch_layer.group_send)(
+                                f"user_{uid}",
+                                {
+                                    "type": "capital_update",
+                                    "seq": r.incr(k_capseq(uid)),
+                                    "capital": changed,
+                                },
+                            )
+                            last_sent[uid] = capital_payload
                         last_push_at[uid] = now
 
                         # Optional: margin call alert
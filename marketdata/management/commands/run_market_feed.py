@@ -0,0 +1,26 @@
+# marketdata/management/commands/run_market_feed.py
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketdata.consumers import FEED_ALIVE_KEY, FEED_ALIVE_TTL, r, start_alltick_ws
+
+
+class Command(BaseCommand):
+    help = ("Alltick feed: publish ticks and marks, record tick history and build live candles. "
+            "Run exactly one instance; ASGI workers only relay what it publishes.")
+
+    def _keep_alive(self):
+        """Tell ASGI workers a feed process is running, so none starts its own."""
+        while True:
+            try:
+                r.set(FEED_ALIVE_KEY, 1, ex=FEED_ALIVE_TTL)
+            except Exception as e:
+                self.stderr.write(f"feed heartbeat failed: {e}")
+            time.sleep(FEED_ALIVE_TTL / 3)
+
+    def handle(self, *args, **opts):
+        threading.Thread(target=self._keep_alive, daemon=True).start()
+        self.stdout.write(self.style.SUCCESS("Market feed started."))
+        start_alltick_ws()
@@ -0,0 +1,145 @@
+# marketdata/management/commands/run_position_checkpointer.py
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from marketdata.engine.redis_ops import get_redis, k_pos, k_posidx
+from marketdata.models import ClosedTrade, PositionCheckpoint, PositionSnapshot
+
+SCAN_COUNT = 1000
+# a pass that sees fewer than this share of the previous pass's positions (or none)
+# looks like an emptied Redis: only checkpoints of positions confirmed closed are dropped
+MIN_PRUNE_RATIO = 0.5
+UPDATE_FIELDS = [
+    "user_id", "symbol", "net_lots", "avg_entry", "leverage", "margin", "unreal_pnl", "mark",
+    "realized_total", "closed_lots", "open_time", "updated_at", "checkpointed_at",
+]
+
+
+def _dec(v, places="0.000001"):
+    try:
+        return Decimal(str(v)).quantize(Decimal(places)) if v not in (None, "", "None") else None
+    except InvalidOperation:
+        return None
+
+
+def _int(v):
+    try:
+        return int(float(v)) if v not in (None, "") else None
+    except ValueError:
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Periodically copy every open Redis position into PositionCheckpoint (one upsert transaction per pass); "
+            "cache_positions --rebuild --source checkpoint restores from it")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=30.0, help="Seconds between passes; 0 = run once")
+        parser.add_argument("--history", action="store_true",
+                            help="Also append a PositionSnapshot row per open position each pass")
+        parser.add_argument("--batch", type=int, default=2000, help="Rows per INSERT statement")
+
+    def _scan(self, r):
+        """All open positions: SCAN posidx:*, then pipelined SMEMBERS and HGETALL per page."""
+        uids = []
+        for key in r.scan_iter(match="posidx:*", count=SCAN_COUNT):
+            uids.append(key.split(":", 1)[1])
+            if len(uids) >= SCAN_COUNT:
+                yield from self._read_users(r, uids)
+                uids = []
+        if uids:
+            yield from self._read_users(r, uids)
+
+    def _read_users(self, r, uids):
+        with r.pipeline(transaction=False) as p:
+            for uid in uids:
+                p.smembers(k_posidx(uid))
+            indexes = p.execute()
+        refs = [(uid, pid) for uid, ids in zip(uids, indexes) for pid in (ids or ())]
+        if not refs:
+            return
+        with r.pipeline(transaction=False) as p:
+            for uid, pid in refs:
+                p.hgetall(k_pos(uid, pid))
+            hashes = p.execute()
+        for (uid, pid), h in zip(refs, hashes):
+            if h and abs(float(h.get("net_lots") or 0)) > 1e-12 and h.get("symbol"):
+                yield uid, pid, h
+
+    def _pass(self, r, history, batch):
+        started = timezone.now()
+        rows, snaps = [], []
+        for uid, pid, h in self._scan(r):
+            avg = _dec(h.get("avg_entry")) or Decimal("0")
+            row = PositionCheckpoint(
+                position_id=pid,
+                user_id=int(uid),
+                symbol=h["symbol"],
+                net_lots=_dec(h.get("net_lots")),
+                avg_entry=avg,
+                leverage=_int(h.get("leverage")) or 500,
+                margin=_dec(h.get("margin"), "0.00000001") or Decimal("0"),
+                unreal_pnl=_dec(h.get("unreal_pnl"), "0.00000001") or Decimal("0"),
+                mark=_dec(h.get("last_mark")),
+                realized_total=_dec(h.get("realized_total"), "0.00000001") or Decimal("0"),
+                closed_lots=_dec(h.get("closed_lots")) or Decimal("0"),
+                open_time=_int(h.get("open_time")),
+                updated_at=_int(h.get("updated_at")),
+                checkpointed_at=started,
+            )
+            rows.append(row)
+            if history:
+                snaps.append(PositionSnapshot(
+                    user_id=row.user_id, position_id=pid, symbol=row.symbol, net_lots=row.net_lots,
+                    avg_entry=avg, unreal_pnl=row.unreal_pnl, margin=row.margin, mark=row.mark or avg,
+                ))
+
+        with transaction.atomic():
+            PositionCheckpoint.objects.bulk_create(
+                rows, batch_size=batch, update_conflicts=True,
+                unique_fields=["position_id"], update_fields=UPDATE_FIELDS,
+            )
+            removed = self._prune(started, len(rows))
+            if snaps:
+                PositionSnapshot.objects.bulk_create(snaps, batch_size=batch)
+        return len(rows), removed
+
+    def _prune(self, started, seen) -> int:
+        """
+        Drop checkpoints not seen in this pass. Those with a ClosedTrade after the
+        last checkpoint are always dropped; the rest only when the pass is not
+        suspiciously small, since they are the recovery source if Redis lost data.
+        """
+        unseen = PositionCheckpoint.objects.filter(checkpointed_at__lt=started)
+        healthy = seen > 0 and seen >= self._last_seen * MIN_PRUNE_RATIO
+        if healthy:
+            self._last_seen = seen
+        else:
+            self.stderr.write(f"pass saw {seen} positions (previously {self._last_seen}); "
+                              f"keeping checkpoints of positions not confirmed closed")
+            unseen = unseen.filter(Exists(ClosedTrade.objects.filter(
+                position_id=OuterRef("position_id"), closed_at__gte=OuterRef("checkpointed_at"),
+            )))
+        removed, _ = unseen.delete()
+        return removed
+
+    def handle(self, *args, **opts):
+        r = get_redis()
+        self._last_seen = PositionCheckpoint.objects.count()
+        self.stdout.write(self.style.SUCCESS("Position checkpointer started."))
+        while True:
+            t0 = time.monotonic()
+            try:
+                n, removed = self._pass(r, opts["history"], opts["batch"])
+                self.stdout.write(f"checkpointed {n} positions, dropped {removed} closed "
+                                  f"in {time.monotonic() - t0:.2f}s")
+            except Exception as e:
+                self.stderr.write(f"checkpoint pass failed: {e}")
+            if opts["interval"] <= 0:
+                break
+            time.sleep(max(0.0, opts["interval"] - (time.monotonic() - t0)))
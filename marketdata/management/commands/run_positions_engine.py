@@ -4,24 +4,62 @@ from redis import from_url
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from marketdata.engine.redis_ops import (
-    get_redis, k_symidx, mark_to_market, k_pos, k_posidx
+    get_redis, k_symidx, mark_to_market, k_pos, k_userpos
 )
 from marketdata.contracts import spec_for
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
 
+ENGINE_STATS_KEY = "engine:stats"
+STATS_FLUSH_SECS = 1.0
+
 class Command(BaseCommand):
     help = "Run positions engine: subscribe ticks:* and mark positions to market"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--replay", action="store_true",
+                            help="Load-test mode: consume replay:ticks:* from replay_ticks instead of the live ticks:*")
+
+    def _tick_done(self, r, tick):
+        """Count processed ticks and, for replayed ticks carrying sent_ms, publish-to-done lag."""
+        st = self._stats
+        st["ticks"] += 1
+        sent_ms = tick.get("sent_ms")
+        if sent_ms:
+            lag = time.time() * 1000 - float(sent_ms)
+            st["lag_sum_ms"] += lag
+            st["lag_count"] += 1
+            st["last_lag_ms"] = lag
+
+        now = time.monotonic()
+        if now - self._stats_flushed_at < STATS_FLUSH_SECS:
+            return
+        try:
+            with r.pipeline(transaction=False) as p:
+                p.hincrby(ENGINE_STATS_KEY, "ticks", st["ticks"])
+                if st["lag_count"]:
+                    p.hincrbyfloat(ENGINE_STATS_KEY, "lag_sum_ms", st["lag_sum_ms"])
+                    p.hincrby(ENGINE_STATS_KEY, "lag_count", st["lag_count"])
+                    p.hset(ENGINE_STATS_KEY, "last_lag_ms", st["last_lag_ms"])
+                p.execute()
+        except Exception:
+            pass
+        self._stats = {"ticks": 0, "lag_sum_ms": 0.0, "lag_count": 0, "last_lag_ms": 0.0}
+        self._stats_flushed_at = now
+
     def handle(self, *args, **opts):
         r = from_url(REDIS_URL, decode_responses=True)
         ps = r.pubsub()
-        ps.psubscribe("ticks:*")
+        ps.psubscribe("replay:ticks:*" if opts["replay"] else "ticks:*")
 
         ch_layer = get_channel_layer()
-        self.stdout.write(self.style.SUCCESS("Positions engine started."))
+        self.stdout.write(self.style.SUCCESS(
+            "Positions engine started (replay ticks)." if opts["replay"] else "Positions engine started."
+        ))
 
         last_send = {}
+        self._stats = {"ticks": 0, "lag_sum_ms": 0.0, "lag_count": 0, "last_lag_ms": 0.0}
+        self._stats_flushed_at = time.monotonic()
 
         for msg in ps.listen():
             if msg["type"] not in ("message", "pmessage"):
@@ -39,11 +77,13 @@ class Command(BaseCommand):
             uids = r.smembers(k_symidx(symbol)) or set()
             
             if not uids:
+                self._tick_done(r, tick)
                 continue
 
             for uid in uids:
                 # lev = spec.leverage_max
-                position_ids = r.smembers(k_posidx(uid)) or set()
+                # userpos index holds only this symbol's positions
+                position_ids = r.smembers(k_userpos(uid, symbol)) or set()
 
                 for position_id in position_ids:
                     pos_fields = r.hgetall(k_pos(uid, position_id))
@@ -64,7 +104,7 @@ class Command(BaseCommand):
                             "id": position_id,
                             "symbol": symbol,
                             "mark": res.get("last_mark"),
-                            "open_price": float(pos_fields.get("avg_entry", 0)),
+                            "open_price": float(pos_fields.get("avg_entry") or 0),
                             "unreal_pnl": res.get("unreal_pnl"),
                             "margin": res.get("margin"),
                             "open_time": int(pos_fields.get("open_time") or pos_fields.get("updated_at", 0)),
@@ -84,6 +124,8 @@ class Command(BaseCommand):
                         
                         last_send[key] = now
 
+            self._tick_done(r, tick)
+
         self.stderr.write("Positions engine stopped.")
 
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0011_alter_alltickconfig_base_ws_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='leverage',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-19 11:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0012_order_event_id_order_leverage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClosedTrade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('position_id', models.CharField(db_index=True, max_length=64)),
+                ('symbol', models.CharField(max_length=32)),
+                ('side', models.CharField(max_length=4)),
+                ('lots', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('entry_price', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('exit_price', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('realized_pnl', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('opened_at', models.DateTimeField(blank=True, null=True)),
+                ('closed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('close_fill_id', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', 'closed_at'], name='closedtrade_user_closed')],
+            },
+        ),
+    ]
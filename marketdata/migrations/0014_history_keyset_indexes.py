@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0013_closedtrade'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='closedtrade',
+            name='closedtrade_user_closed',
+        ),
+        migrations.AddIndex(
+            model_name='closedtrade',
+            index=models.Index(fields=['user_id', 'closed_at', 'id'], name='closedtrade_user_closed_id'),
+        ),
+        migrations.AddIndex(
+            model_name='fill',
+            index=models.Index(fields=['user_id', 'ts', 'id'], name='fill_user_ts_id'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_id', 'created_at', 'id'], name='order_user_created_id'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0014_history_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('ledger_id', models.BigIntegerField()),
+                ('ts', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', 'ts'], name='balancecheckpoint_user_ts')],
+                'constraints': [models.UniqueConstraint(fields=('user_id', 'ledger_id'), name='balancecheckpoint_user_ledger')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['user_id', 'id'], name='ledger_user_id'),
+        ),
+    ]
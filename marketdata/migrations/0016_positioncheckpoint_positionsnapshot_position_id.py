@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0015_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='positionsnapshot',
+            name='position_id',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name='PositionCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position_id', models.CharField(max_length=64, unique=True)),
+                ('user_id', models.IntegerField(db_index=True)),
+                ('symbol', models.CharField(max_length=32)),
+                ('net_lots', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('avg_entry', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('leverage', models.IntegerField(default=500)),
+                ('margin', models.DecimalField(decimal_places=8, default=0, max_digits=28)),
+                ('unreal_pnl', models.DecimalField(decimal_places=8, default=0, max_digits=28)),
+                ('mark', models.DecimalField(blank=True, decimal_places=6, max_digits=20, null=True)),
+                ('realized_total', models.DecimalField(decimal_places=8, default=0, max_digits=28)),
+                ('closed_lots', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('open_time', models.BigIntegerField(blank=True, null=True)),
+                ('updated_at', models.BigIntegerField(blank=True, null=True)),
+                ('checkpointed_at', models.DateTimeField()),
+            ],
+        ),
+    ]
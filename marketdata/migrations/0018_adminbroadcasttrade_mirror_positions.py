@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0017_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adminbroadcasttrade',
+            name='mirror_positions',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0018_adminbroadcasttrade_mirror_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fill',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
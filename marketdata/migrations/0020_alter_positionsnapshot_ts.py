@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0019_fill_event_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='positionsnapshot',
+            name='ts',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketdata', '0020_alter_positionsnapshot_ts'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='backgroundjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ('queued', 'running'))), fields=('key',), name='backgroundjob_active_key'),
+        ),
+    ]
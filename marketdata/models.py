@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from .models_admintrades import *
 
 
@@ -13,9 +14,14 @@ class Order(models.Model):
     type = models.CharField(max_length=16, default="market")  # market/limit/stop
     status = models.CharField(max_length=16, default="filled")  # new/open/filled/canceled/partially_filled
     client_id = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # idempotency
-    created_at = models.DateTimeField(auto_now_add=True)
+    leverage = models.IntegerField(null=True, blank=True)
+    event_id = models.CharField(max_length=32, null=True, blank=True, unique=True)  # fill journal event
+    created_at = models.DateTimeField(default=timezone.now, editable=False)  # journal: time of the fill
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["user_id", "created_at", "id"], name="order_user_created_id")]
+
 class Fill(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="fills")
     user_id = models.IntegerField(db_index=True)
@@ -24,25 +30,157 @@ class Fill(models.Model):
     lots = models.DecimalField(max_digits=20, decimal_places=6)
     price = models.DecimalField(max_digits=20, decimal_places=6)
     realized_pnl = models.DecimalField(max_digits=28, decimal_places=8, default=0)
-    ts = models.DateTimeField(auto_now_add=True)
+    ts = models.DateTimeField(default=timezone.now, editable=False)  # journal: time of the fill
+    event_id = models.CharField(max_length=32, null=True, blank=True, unique=True)  # fill journal event
+
+    class Meta:
+        indexes = [models.Index(fields=["user_id", "ts", "id"], name="fill_user_ts_id")]
+
+class LedgerEntryQuerySet(models.QuerySet):
+    def delete_with_reversal(self, chunk_size: int = 1000) -> int:
+        """
+        Delete the rows and take their balance effect back out of UserAccount in
+        bulk: per chunk one GROUP BY user_id, one balance UPDATE for all users
+        (services.balances.bulk_apply_balance_deltas) and one DELETE, instead of
+        the per-row locked save done by the pre_delete signal (which a raw
+        delete does not fire). Balance checkpoints at or after a deleted row are
+        dropped, so they get rebuilt from the remaining ledger.
+        Returns rows deleted.
+        """
+        from django.db import connections, transaction
+        from marketdata.services.balances import LEDGER_EFFECT, bulk_apply_balance_deltas
+
+        ids = list(self.order_by("id").values_list("id", flat=True))
+        table = connections[self.db].ops.quote_name(self.model._meta.db_table)
+        deleted = 0
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            with transaction.atomic(using=self.db):
+                effects = (
+                    LedgerEntry.objects.using(self.db)
+                    .filter(id__in=chunk)
+                    .order_by()
+                    .values("user_id")
+                    .annotate(effect=models.Sum(LEDGER_EFFECT), first_id=models.Min("id"))
+                )
+                deltas, first = {}, {}
+                for row in effects:
+                    deltas[row["user_id"]] = -row["effect"]
+                    first[row["user_id"]] = row["first_id"]
+                bulk_apply_balance_deltas(deltas, using=self.db)
+                if first:
+                    stale = models.Q()
+                    for uid, first_id in first.items():
+                        stale |= models.Q(user_id=uid, ledger_id__gte=first_id)
+                    BalanceCheckpoint.objects.using(self.db).filter(stale).delete()
+                with connections[self.db].cursor() as cur:
+                    cur.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+                    deleted += cur.rowcount
+        return deleted
+
 
 class LedgerEntry(models.Model):
+    objects = LedgerEntryQuerySet.as_manager()
+
     user_id = models.IntegerField(db_index=True)
     symbol = models.CharField(max_length=32, null=True, blank=True)
     kind = models.CharField(max_length=32)  # realized_pnl, fee, deposit, withdrawal, adj
     amount = models.DecimalField(max_digits=28, decimal_places=8)
     ref = models.CharField(max_length=64, null=True, blank=True)
-    ts = models.DateTimeField(auto_now_add=True)
+    ts = models.DateTimeField(default=timezone.now, editable=False)  # journal: time of the fill
+
+    class Meta:
+        indexes = [models.Index(fields=["user_id", "id"], name="ledger_user_id")]
+
+class BalanceCheckpoint(models.Model):
+    """User's ledger balance after ledger row `ledger_id` (0 = opening balance); see services/balances.py."""
+    user_id = models.IntegerField()
+    ledger_id = models.BigIntegerField()
+    ts = models.DateTimeField()
+    balance = models.DecimalField(max_digits=28, decimal_places=8)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user_id", "ledger_id"], name="balancecheckpoint_user_ledger")]
+        indexes = [models.Index(fields=["user_id", "ts"], name="balancecheckpoint_user_ts")]
 
 class PositionSnapshot(models.Model):
     user_id = models.IntegerField(db_index=True)
+    position_id = models.CharField(max_length=64, null=True, blank=True, db_index=True)
     symbol = models.CharField(max_length=32, db_index=True)
     net_lots = models.DecimalField(max_digits=20, decimal_places=6)
     avg_entry = models.DecimalField(max_digits=20, decimal_places=6)
     unreal_pnl = models.DecimalField(max_digits=28, decimal_places=8)
     margin = models.DecimalField(max_digits=28, decimal_places=8)
     mark = models.DecimalField(max_digits=20, decimal_places=6)
-    ts = models.DateTimeField(auto_now_add=True)
+    ts = models.DateTimeField(default=timezone.now, editable=False, db_index=True)  # retention cutoff lookups
+
+
+class ClosedTrade(models.Model):
+    """One row per position that went flat; what the order history pages read."""
+    user_id = models.IntegerField()
+    position_id = models.CharField(max_length=64, db_index=True)
+    symbol = models.CharField(max_length=32)
+    side = models.CharField(max_length=4)  # Buy/Sell of the position, not the closing fill
+    lots = models.DecimalField(max_digits=20, decimal_places=6)
+    entry_price = models.DecimalField(max_digits=20, decimal_places=6)
+    exit_price = models.DecimalField(max_digits=20, decimal_places=6)
+    realized_pnl = models.DecimalField(max_digits=28, decimal_places=8)
+    opened_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(default=timezone.now)
+    close_fill_id = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["user_id", "closed_at", "id"], name="closedtrade_user_closed_id")]
+
+
+class PositionCheckpoint(models.Model):
+    """Latest durable copy of an open Redis position, upserted by run_position_checkpointer."""
+    position_id = models.CharField(max_length=64, unique=True)
+    user_id = models.IntegerField(db_index=True)
+    symbol = models.CharField(max_length=32)
+    net_lots = models.DecimalField(max_digits=20, decimal_places=6)
+    avg_entry = models.DecimalField(max_digits=20, decimal_places=6)
+    leverage = models.IntegerField(default=500)
+    margin = models.DecimalField(max_digits=28, decimal_places=8, default=0)
+    unreal_pnl = models.DecimalField(max_digits=28, decimal_places=8, default=0)
+    mark = models.DecimalField(max_digits=20, decimal_places=6, null=True, blank=True)
+    realized_total = models.DecimalField(max_digits=28, decimal_places=8, default=0)
+    closed_lots = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    open_time = models.BigIntegerField(null=True, blank=True)   # epoch seconds, as in Redis
+    updated_at = models.BigIntegerField(null=True, blank=True)  # epoch seconds of the Redis write
+    checkpointed_at = models.DateTimeField()
+
+
+class BackgroundJob(models.Model):
+    """Queued unit of admin work run by `run_jobs`; handlers live in services/jobs.py."""
+    STATUS_CHOICES = (("queued", "Queued"), ("running", "Running"), ("done", "Done"), ("failed", "Failed"))
+
+    kind = models.CharField(max_length=64)
+    key = models.CharField(max_length=128, db_index=True)  # one unfinished job per key
+    payload = models.JSONField(default=dict, blank=True)   # handler input plus its resume cursor
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="queued")
+    progress_done = models.IntegerField(default=0)
+    progress_total = models.IntegerField(null=True, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=128, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    run_after = models.DateTimeField(null=True, blank=True)  # deferred job: not claimed before this
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "id"], name="backgroundjob_status_id")]
+        constraints = [
+            models.UniqueConstraint(fields=["key"], condition=models.Q(status__in=("queued", "running")),
+                                    name="backgroundjob_active_key"),
+        ]
+
+    def __str__(self):
+        return f"Job #{self.id} {self.kind} {self.status}"
 
 
 class UserAccount(models.Model):
@@ -29,6 +29,9 @@ class AdminBroadcastTrade(models.Model):
     closed_at = models.DateTimeField(null=True, blank=True)
     notes = models.TextField(blank=True, default="")
 
+    # open a real position per group member while live, closed in bulk at exit
+    mirror_positions = models.BooleanField(default=False)
+
     # idempotency guard when applying capital
     applied_to_user_ids = models.JSONField(default=list, blank=True)
 
@@ -0,0 +1,108 @@
+# marketdata/pagination.py
+import base64
+import json
+from datetime import datetime, time, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Newest-first keyset pagination on (view.keyset_field, id).
+
+    The cursor is the (timestamp, id) of the last row served, so every page is
+    an index range scan on (user_id, <keyset_field>, id) no matter how deep the
+    client pages. Response: {"next": url | null, "results": [...]}.
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+
+    def _page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "must be an integer"})
+        return max(1, min(size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(value, pk) -> str:
+        raw = json.dumps([value.isoformat(), pk]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            value, pk = json.loads(raw)
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError
+            return value, int(pk)
+        except (ValueError, TypeError):
+            raise ValidationError({"cursor": "invalid cursor"})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        field = getattr(view, "keyset_field", "ts")
+        self.request = request
+        self.field = field
+        limit = self._page_size(request)
+
+        queryset = queryset.order_by(f"-{field}", "-id")
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(**{f"{field}__lt": value}) | Q(**{field: value, "id__lt": pk}))
+
+        rows = list(queryset[:limit + 1])
+        self.has_next = len(rows) > limit
+        rows = rows[:limit]
+        self.last = rows[-1] if rows else None
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next or self.last is None:
+            return None
+        cursor = self.encode_cursor(getattr(self.last, self.field), self.last.pk)
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+def _parse_bound(value: str, end: bool):
+    """ISO date or datetime -> aware datetime; a bare date covers the whole day."""
+    error = ValidationError({"end" if end else "start": "expected an ISO date or datetime"})
+    try:
+        # well-formed but impossible values (2024-13-45) raise ValueError
+        dt = parse_datetime(value)
+        d = parse_date(value) if dt is None else None
+    except ValueError:
+        raise error
+    if dt is None:
+        if d is None:
+            raise error
+        dt = datetime.combine(d, time.max if end else time.min)
+    if timezone.is_naive(dt):
+        dt = dt.replace(tzinfo=dt_timezone.utc)
+    return dt
+
+
+def filter_history(queryset, request, field: str):
+    """Optional ?symbol=, ?start=, ?end= (ISO date/datetime, inclusive) filters."""
+    params = request.query_params
+    symbol = params.get("symbol")
+    if symbol:
+        queryset = queryset.filter(symbol=symbol.upper())
+    if params.get("start"):
+        queryset = queryset.filter(**{f"{field}__gte": _parse_bound(params["start"], end=False)})
+    if params.get("end"):
+        queryset = queryset.filter(**{f"{field}__lte": _parse_bound(params["end"], end=True)})
+    return queryset
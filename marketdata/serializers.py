@@ -1,6 +1,6 @@
 # backend/marketdata/serializers.py
 from rest_framework import serializers
-from .models import Order, Fill
+from .models import Order, Fill, ClosedTrade
 from marketdata.models import WithdrawalRequest, UserAccount
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -14,11 +14,18 @@ class FillSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class ClosedTradeSerializer(serializers.Serializer):
-    pos_id = serializers.CharField(source="ref")
-    symbol = serializers.CharField()
-    realized = serializers.DecimalField(max_digits=20, decimal_places=6)
-    last_ts = serializers.DateTimeField()
+class ClosedTradeSerializer(serializers.ModelSerializer):
+    # pos_id / realized / last_ts keep the shape the history page already reads
+    pos_id = serializers.CharField(source="position_id")
+    realized = serializers.DecimalField(source="realized_pnl", max_digits=20, decimal_places=6)
+    last_ts = serializers.DateTimeField(source="closed_at")
+
+    class Meta:
+        model = ClosedTrade
+        fields = [
+            "id", "pos_id", "symbol", "side", "lots", "entry_price", "exit_price",
+            "realized", "opened_at", "closed_at", "last_ts",
+        ]
 
 
 class WithdrawalRequestCreateSerializer(serializers.ModelSerializer):
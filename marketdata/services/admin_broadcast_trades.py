@@ -6,8 +6,9 @@ from django.contrib.auth import get_user_model
 from django.db.models import F
 
 from marketdata.contracts import spec_for
-from marketdata.models_admintrades import AdminBroadcastTrade, AdminTradeApplication
-from marketdata.models import LedgerEntry, UserAccount  # adjust if your names differ
+from marketdata.models_admintrades import AdminBroadcastTrade, AdminTradeApplication, UserTradeGroup
+from marketdata.models import LedgerEntry, UserAccount, ClosedTrade  # adjust if your names differ
+from marketdata.services.balances import bulk_apply_balance_deltas
 
 User = get_user_model()
 
@@ -16,20 +17,7 @@ User = get_user_model()
 FX_DEFAULT_CONTRACT = Decimal("100000")  # 1 lot = 100k base units (e.g., EURUSD)
 GOLD_DEFAULT_CONTRACT = Decimal("100")   # common XAUUSD contract size
 INDEX_DEFAULT_CONTRACT = Decimal("1")    # fallback for indices/CFDs if unknown
-
-
-def _apply_capital_delta(user_id: int, delta: Decimal):
-    """
-    Atomically apply realized PnL to the user's account.
-    Free margin increases by the same delta if used margin is unchanged.
-    """
-    # lock row to avoid race conditions with other updates
-    acc = UserAccount.objects.select_for_update().get(user_id=user_id)
-    UserAccount.objects.filter(pk=acc.pk).update(
-        balance=F("balance") + delta,
-        # equity=F("equity") + delta,
-        # free_margin=F("free_margin") + delta,
-    )
+APPLY_CHUNK = 1000                       # users per bulk insert / balance UPDATE
 
 
 def _contract_multiplier(symbol: str) -> Decimal:
@@ -65,78 +53,268 @@ def _required_margin(lots: Decimal, entry_price: Decimal, contract: Decimal, lev
     notional = lots * contract * entry_price
     return (notional / Decimal(leverage)).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
 
-def _get_free_margin(user_id: int) -> Decimal:
-    # Lock row for consistency
-    acc = UserAccount.objects.select_for_update().get(user_id=user_id)
-    return Decimal(acc.free_margin)
-
 # ---------- main -------------------------------------------------------------
 
+def _is_complete(trade) -> bool:
+    return bool(trade.entry_price and trade.exit_price and trade.lots and trade.side and trade.symbol)
+
+
+def _terms(trade):
+    entry = Decimal(trade.entry_price)
+    exit_ = Decimal(trade.exit_price)
+    lots = Decimal(trade.lots)
+    lev = int(trade.leverage or 500)
+    contract = _contract_multiplier(trade.symbol)
+    realized_per_user = _quantize_ledger(_pnl_amount(trade.side, entry, exit_, lots, contract))
+    req_margin = _required_margin(lots, entry, contract, lev)
+    return entry, exit_, lots, realized_per_user, req_margin
+
+
+def _candidates(trade):
+    """Accounts of everyone in the trade's groups not applied yet, by user_id."""
+    members = (
+        UserTradeGroup.users.through.objects
+        .filter(usertradegroup__trades=trade)
+        .values("user_id")
+    )
+    return (
+        UserAccount.objects
+        .filter(user_id__in=members)
+        .exclude(user_id__in=AdminTradeApplication.objects.filter(trade=trade).values("user_id"))
+        .order_by("user_id")
+    )
+
+
+def count_admin_trade_candidates(trade_id: int) -> int:
+    return _candidates(AdminBroadcastTrade.objects.get(id=trade_id)).count()
+
+
 @transaction.atomic
+def apply_admin_trade_chunk(trade_id: int, after_user_id: int = 0, limit: int = APPLY_CHUNK) -> dict:
+    """
+    Apply a closed trade to the next `limit` candidate users after `after_user_id`
+    in one transaction. One query picks and locks their accounts with the
+    free-margin check, then the chunk is booked with bulk inserts and a single
+    balance UPDATE. Already-applied users are excluded by their
+    AdminTradeApplication row, so re-running a chunk never books twice.
+    Returns {"applied", "skipped", "last_user_id", "finished"}.
+    """
+    trade = AdminBroadcastTrade.objects.select_for_update().get(id=trade_id)
+    if not _is_complete(trade):
+        return {"applied": 0, "skipped": 0, "last_user_id": after_user_id, "finished": True}
+
+    entry, exit_, lots, realized_per_user, req_margin = _terms(trade)
+    now = timezone.now()
+
+    ids = list(
+        _candidates(trade).filter(user_id__gt=after_user_id)
+        .values_list("user_id", flat=True)[:limit]
+    )
+    if not ids:
+        return {"applied": 0, "skipped": 0, "last_user_id": after_user_id, "finished": True}
+
+    # capital check on the locked rows; free margin = balance + unrealized - used
+    eligible = list(
+        UserAccount.objects
+        .filter(user_id__in=ids)
+        .order_by("user_id")
+        .select_for_update()
+        .annotate(free=F("balance") + F("unrealized_pnl") - F("used_margin"))
+        .filter(free__gte=req_margin)
+        .values_list("user_id", flat=True)
+    )
+    ref = str(trade.ref)          # cast in case ref is UUIDField
+    closed_at = trade.closed_at or now
+
+    # same kind as existing realized rows so frontend history shows it
+    LedgerEntry.objects.bulk_create([
+        LedgerEntry(user_id=uid, amount=realized_per_user, kind="realized_pnl",
+                    ref=ref, symbol=trade.symbol, ts=now)
+        for uid in eligible
+    ])
+    bulk_apply_balance_deltas({uid: realized_per_user for uid in eligible}, chunk_size=limit)
+    # order history reads closed trades
+    ClosedTrade.objects.bulk_create([
+        ClosedTrade(user_id=uid, position_id=ref, symbol=trade.symbol, side=trade.side, lots=lots,
+                    entry_price=entry, exit_price=exit_, realized_pnl=realized_per_user,
+                    opened_at=trade.opened_at, closed_at=closed_at)
+        for uid in eligible
+    ])
+    # audit rows (also the idempotency guard)
+    AdminTradeApplication.objects.bulk_create([
+        AdminTradeApplication(trade=trade, user_id=uid, realized=realized_per_user) for uid in eligible
+    ])
+
+    if eligible:
+        trade.applied_to_user_ids = list(trade.applied_to_user_ids) + eligible
+        trade.save(update_fields=["applied_to_user_ids"])
+
+    return {"applied": len(eligible), "skipped": len(ids) - len(eligible),
+            "last_user_id": ids[-1], "finished": len(ids) < limit}
+
+
+def finish_admin_trade(trade_id: int):
+    """Mark a trade closed once every chunk has been applied."""
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    if not trade.closed_at:
+        trade.closed_at = timezone.now()
+    trade.status = "closed"
+    trade.save(update_fields=["status", "closed_at"])
+
+
 def apply_closed_admin_trade_on_save(trade_id: int):
     """
     When an AdminBroadcastTrade is saved with both entry and exit filled,
     apply immediately to all users in its groups if they have enough free margin.
     No realtime; just ledger + audit. Skips users without capital.
+    Runs every chunk inline; the admin queues it as a BackgroundJob instead
+    (see services/jobs.py).
     """
-    trade = AdminBroadcastTrade.objects.select_for_update().get(id=trade_id)
-
-    # Must be fully specified
-    if not (trade.entry_price and trade.exit_price and trade.lots and trade.side and trade.symbol):
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    if not _is_complete(trade):
         return {"applied": 0, "skipped": 0}
 
-    # ensure final status
-    if trade.status not in ("closed", "live", "draft"):
-        trade.status = "closed"
+    applied = skipped = 0
+    after = 0
+    while True:
+        res = apply_admin_trade_chunk(trade_id, after_user_id=after)
+        applied += res["applied"]
+        skipped += res["skipped"]
+        after = res["last_user_id"]
+        if res["finished"]:
+            break
+    finish_admin_trade(trade_id)
+    return {"applied": applied, "skipped": skipped}
+
+
+# ---------- live mirroring ---------------------------------------------------
+# With mirror_positions set, going live opens a real netting position (id =
+# trade.ref) for every group member with enough free margin, so the positions
+# engine marks it every tick and it counts against margin; the exit closes them
+# all at exit_price. Fills go through the fill journal like user orders, which
+# books the realized P&L, ledger rows and ClosedTrade history. mirror:{ref} is
+# the set of users holding an open mirrored position.
+
+def k_mirror(ref) -> str:
+    return f"mirror:{ref}"
+
+
+def _mirror_fill(trade, uid, lots, price, side, contract, lev):
+    from marketdata.engine.journal import new_fill_event
+
+    return {
+        "uid": uid,
+        "position_id": str(trade.ref),
+        "fill_lots": lots,
+        "fill_price": float(price),
+        "contract_size": float(contract),
+        "leverage": lev,
+        "side": side,
+        "symbol": trade.symbol.upper(),
+        "open_time": int(trade.opened_at.timestamp()) if trade.opened_at else None,
+        "journal": new_fill_event(uid, trade.symbol, side, abs(lots) if lots else trade.lots, price, lev,
+                                  order_type="admin_mirror"),
+    }
+
+
+def open_mirror_chunk(trade_id: int, after_user_id: int = 0, limit: int = APPLY_CHUNK) -> dict:
+    """
+    Open mirrored positions for the next `limit` candidate users after
+    `after_user_id`: one pipelined membership read, one pipelined margin
+    reservation through the pre-trade risk gate (engine/risk.py) and one MULTI
+    for every position. Users already mirrored are skipped, so a chunk can be
+    re-run. A trade that already has its exit opens nothing: its close job would
+    not see positions opened after it started.
+    Returns {"opened", "skipped", "last_user_id", "finished"}.
+    """
+    from marketdata.engine.redis_ops import apply_fills_fanout, get_redis
+    from marketdata.engine.risk import release_margins, reserve_margin_many
+
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    if trade.exit_price or trade.status == "closed":
+        return {"opened": 0, "skipped": 0, "last_user_id": after_user_id, "finished": True}
+    if not (trade.entry_price and trade.lots and trade.side and trade.symbol):
+        return {"opened": 0, "skipped": 0, "last_user_id": after_user_id, "finished": True}
 
     entry = Decimal(trade.entry_price)
-    exit_ = Decimal(trade.exit_price)
     lots = Decimal(trade.lots)
     lev = int(trade.leverage or 500)
     contract = _contract_multiplier(trade.symbol)
-    now = timezone.now()
-
-    pnl_raw = _pnl_amount(trade.side, entry, exit_, lots, contract)
-    realized_per_user = _quantize_ledger(pnl_raw)
     req_margin = _required_margin(lots, entry, contract, lev)
 
-    user_ids = {u.id for g in trade.groups.all() for u in g.users.all()}
-    applied = skipped = 0
+    ids = list(
+        _candidates(trade).filter(user_id__gt=after_user_id)
+        .values_list("user_id", flat=True)[:limit]
+    )
+    if not ids:
+        return {"opened": 0, "skipped": 0, "last_user_id": after_user_id, "finished": True}
 
-    for uid in user_ids:
-        # idempotency
-        if uid in trade.applied_to_user_ids:
-            continue
-
-        # capital check
-        free_margin = _get_free_margin(uid)
-        if free_margin < req_margin:
-            skipped += 1
-            continue
-
-        # ✅ write same kind as existing realized rows so frontend history shows it
-        LedgerEntry.objects.create(
-            user_id=uid,
-            amount=realized_per_user,   # positive = profit, negative = loss
-            kind="realized_pnl",
-            ref=str(trade.ref),         # cast in case ref is UUIDField
-            symbol=trade.symbol,
-            ts=now,
-        )
-
-        _apply_capital_delta(uid, realized_per_user)
-
-        # audit row
-        AdminTradeApplication.objects.create(
-            trade=trade, user_id=uid, realized=realized_per_user
-        )
-
-        trade.applied_to_user_ids.append(uid)
-        applied += 1
+    r = get_redis()
+    key = k_mirror(trade.ref)
+    with r.pipeline(transaction=False) as p:
+        for uid in ids:
+            p.sismember(key, uid)
+        mirrored = p.execute()
+    todo = [uid for uid, done in zip(ids, mirrored) if not done]
 
-    if not trade.closed_at:
-        trade.closed_at = now
-    trade.status = "closed"
-    trade.save(update_fields=["applied_to_user_ids", "status", "closed_at"])
+    # same check-and-hold as user orders, so concurrent orders can't spend the margin too
+    reservations = reserve_margin_many(todo, req_margin)
+    signed = float(lots) if trade.side == "Buy" else -float(lots)
+    fills = [
+        _mirror_fill(trade, uid, signed, entry, trade.side, contract, lev)
+        for uid in todo if uid in reservations
+    ]
+    try:
+        results = apply_fills_fanout(fills, track=key)
+    finally:
+        # the fills moved their margin into risk:{uid} used_margin
+        release_margins(reservations)
+    return {"opened": len(results), "skipped": len(ids) - len(results),
+            "last_user_id": ids[-1], "finished": len(ids) < limit}
 
-    return {"applied": applied, "skipped": skipped}
+
+def close_mirror_page(trade_id: int, cursor: int = 0, count: int = APPLY_CHUNK) -> dict:
+    """
+    Close one SSCAN page of mirrored positions at exit_price in one MULTI and
+    record an AdminTradeApplication per user closed. Positions the user already
+    closed are skipped, so a page can be re-run.
+    Returns {"closed", "realized", "cursor", "finished"}.
+    """
+    from marketdata.engine.redis_ops import apply_fills_fanout, get_redis
+
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    exit_ = Decimal(trade.exit_price)
+    lev = int(trade.leverage or 500)
+    contract = _contract_multiplier(trade.symbol)
+    closing_side = "Sell" if trade.side == "Buy" else "Buy"
+
+    key = k_mirror(trade.ref)
+    cursor, members = get_redis().sscan(key, cursor, count=count)
+    fills = [_mirror_fill(trade, int(uid), None, exit_, closing_side, contract, lev) for uid in members]
+    results = apply_fills_fanout(fills, track=key)
+
+    apps_rows = [
+        AdminTradeApplication(trade=trade, user_id=res["uid"],
+                              realized=Decimal(str(res["realized"] or 0)).quantize(Decimal("0.000001")))
+        for res in results
+    ]
+    with transaction.atomic():
+        AdminTradeApplication.objects.bulk_create(apps_rows, ignore_conflicts=True)
+        if results:
+            locked = AdminBroadcastTrade.objects.select_for_update().get(id=trade_id)
+            seen = set(locked.applied_to_user_ids)
+            locked.applied_to_user_ids = list(locked.applied_to_user_ids) + [
+                res["uid"] for res in results if res["uid"] not in seen
+            ]
+            locked.save(update_fields=["applied_to_user_ids"])
+
+    return {"closed": len(results), "realized": float(sum(a.realized for a in apps_rows)),
+            "cursor": int(cursor), "finished": int(cursor) == 0}
+
+
+def finish_mirror_close(trade_id: int):
+    from marketdata.engine.redis_ops import get_redis
+
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    get_redis().delete(k_mirror(trade.ref))
+    finish_admin_trade(trade_id)
@@ -0,0 +1,198 @@
+# marketdata/services/balances.py
+"""
+Point-in-time ledger balances.
+
+A BalanceCheckpoint stores a user's balance as of one ledger id, so the
+balance at time T is the latest checkpoint at or before T plus the ledger rows
+after it (a short tail), instead of a sum over the user's whole ledger.
+
+The first checkpoint of an account is an "opening" row at ledger id 0: the
+part of today's balance that no ledger row explains (capital added before
+deposits were ledgered).
+"""
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import Case, Count, DecimalField, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Lower, Trim
+from django.db.models.lookups import In
+
+from marketdata.models import BalanceCheckpoint, LedgerEntry, UserAccount
+
+ZERO = Decimal("0")
+OPENING_TS = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_AMOUNT = DecimalField(max_digits=28, decimal_places=8)
+
+# Signed balance effect of a ledger row; mirrors signals._effect_on_balance,
+# including its case- and whitespace-insensitive match on kind
+LEDGER_EFFECT = Case(
+    When(In(Trim(Lower("kind")), ["withdrawal", "fee"]), then=-F("amount")),
+    default=F("amount"),
+    output_field=_AMOUNT,
+)
+
+
+def _ledger_total(qs) -> Decimal:
+    return qs.aggregate(t=Coalesce(Sum(LEDGER_EFFECT), Value(ZERO), output_field=_AMOUNT))["t"]
+
+
+def checkpoint_before(user_id: int, at: datetime):
+    return (
+        BalanceCheckpoint.objects
+        .filter(user_id=user_id, ts__lte=at)
+        .order_by("-ts", "-ledger_id")
+        .first()
+    )
+
+
+def balance_at(user_id: int, at: datetime) -> Decimal | None:
+    """
+    Ledger balance after every entry with ts <= at, or None for a user never
+    checkpointed (opening balance unknown until checkpoint_balances has run).
+    """
+    cp = checkpoint_before(user_id, at)
+    if cp is None:
+        # the opening checkpoint is dated 1970, so none before `at` means none at all
+        return None
+    tail = LedgerEntry.objects.filter(user_id=user_id, ts__lte=at, id__gt=cp.ledger_id)
+    return cp.balance + _ledger_total(tail)
+
+
+def _last_checkpoint_id():
+    return Subquery(
+        BalanceCheckpoint.objects
+        .filter(user_id=OuterRef("user_id"))
+        .order_by("-ledger_id")
+        .values("ledger_id")[:1]
+    )
+
+
+def _ledger_total_subquery():
+    return Subquery(
+        LedgerEntry.objects
+        .filter(user_id=OuterRef("user_id"))
+        .order_by()
+        .values("user_id")
+        .annotate(t=Sum(LEDGER_EFFECT))
+        .values("t")[:1],
+        output_field=_AMOUNT,
+    )
+
+
+def checkpoint_users(user_ids, upto_id: int, min_entries: int = 1) -> int:
+    """
+    Checkpoint a batch of users at ledger id `upto_id`: one query for the
+    opening rows of users never checkpointed, one aggregate for everyone's
+    ledger since their last checkpoint, one bulk insert. Returns rows written.
+    """
+    user_ids = list(user_ids)
+    have = set(
+        BalanceCheckpoint.objects.filter(user_id__in=user_ids)
+        .values_list("user_id", flat=True).distinct()
+    )
+
+    rows = []
+    fresh = [uid for uid in user_ids if uid not in have]
+    if fresh:
+        # balance and ledger total read in one statement, so they agree
+        for acc in (UserAccount.objects.filter(user_id__in=fresh)
+                    .annotate(ledger_total=Coalesce(_ledger_total_subquery(), Value(ZERO),
+                                                    output_field=_AMOUNT))
+                    .values("user_id", "balance", "ledger_total")):
+            rows.append(BalanceCheckpoint(
+                user_id=acc["user_id"], ledger_id=0, ts=OPENING_TS,
+                balance=acc["balance"] - acc["ledger_total"],
+            ))
+    opening = {cp.user_id: cp.balance for cp in rows}
+
+    last = {}
+    if have:
+        latest = (BalanceCheckpoint.objects.filter(user_id__in=have)
+                  .filter(ledger_id=_last_checkpoint_id())
+                  .values("user_id", "balance"))
+        last = {cp["user_id"]: cp["balance"] for cp in latest}
+
+    tails = (
+        LedgerEntry.objects
+        .filter(user_id__in=user_ids, id__lte=upto_id)
+        .annotate(since=Coalesce(_last_checkpoint_id(), Value(0)))
+        .filter(id__gt=F("since"))
+        .order_by()
+        .values("user_id")
+        .annotate(delta=Sum(LEDGER_EFFECT), n=Count("id"), last_id=Max("id"), last_ts=Max("ts"))
+    )
+    for t in tails:
+        uid = t["user_id"]
+        if t["n"] < min_entries:
+            continue
+        base = last[uid] if uid in last else opening.get(uid, ZERO)
+        rows.append(BalanceCheckpoint(
+            user_id=uid, ledger_id=t["last_id"], ts=t["last_ts"], balance=base + t["delta"],
+        ))
+
+    BalanceCheckpoint.objects.bulk_create(rows, ignore_conflicts=True)
+    return len(rows)
+
+
+def ledger_balances(user_ids) -> dict:
+    """
+    Current ledger-derived balance per user (latest checkpoint + ledger since),
+    for a batch of users in two queries. Users never checkpointed map to None:
+    their opening balance is unknown until checkpoint_balances has run.
+    """
+    user_ids = list(user_ids)
+    base = {
+        cp["user_id"]: (cp["ledger_id"], cp["balance"]) for cp in
+        BalanceCheckpoint.objects.filter(user_id__in=user_ids)
+        .filter(ledger_id=_last_checkpoint_id())
+        .values("user_id", "ledger_id", "balance")
+    }
+    out = {uid: (base[uid][1] if uid in base else None) for uid in user_ids}
+    if not base:
+        return out
+
+    tails = (
+        LedgerEntry.objects
+        .filter(user_id__in=list(base))
+        .annotate(since=_last_checkpoint_id())
+        .filter(id__gt=F("since"))
+        .order_by()
+        .values("user_id")
+        .annotate(delta=Sum(LEDGER_EFFECT))
+    )
+    for t in tails:
+        out[t["user_id"]] += t["delta"]
+    return out
+
+
+def bulk_apply_balance_deltas(deltas: dict, chunk_size: int = 1000, using: str = "default") -> int:
+    """
+    Add {user_id: delta} to UserAccount.balance with one
+    UPDATE ... FROM (VALUES ...) per chunk (per-row F() updates off PostgreSQL)
+    on database `using`. Returns accounts updated.
+    """
+    items = sorted((int(uid), Decimal(d)) for uid, d in deltas.items() if d)
+    if not items:
+        return 0
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return sum(
+            UserAccount.objects.using(using).filter(user_id=uid).update(balance=F("balance") + d)
+            for uid, d in items
+        )
+
+    table = connection.ops.quote_name(UserAccount._meta.db_table)
+    updated = 0
+    for i in range(0, len(items), chunk_size):
+        chunk = items[i:i + chunk_size]
+        values = ", ".join(["(%s, %s::numeric)"] * len(chunk))
+        params = [x for row in chunk for x in row]
+        with connection.cursor() as cur:
+            cur.execute(
+                f"UPDATE {table} AS a SET balance = a.balance + v.delta "
+                f"FROM (VALUES {values}) AS v(user_id, delta) WHERE a.user_id = v.user_id",
+                params,
+            )
+            updated += cur.rowcount
+    return updated
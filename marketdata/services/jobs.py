@@ -0,0 +1,238 @@
+# marketdata/services/jobs.py
+"""
+Database-backed background jobs.
+
+enqueue() stores a BackgroundJob and returns at once; `run_jobs` workers claim
+queued jobs with SELECT ... FOR UPDATE SKIP LOCKED and call the handler
+registered for the job's kind. Handlers work in chunks and call job.save()
+with their resume cursor in `payload` inside the same transaction as each
+chunk, so a job whose worker died (stale heartbeat) is picked up again and
+continues after the last committed chunk. A failed run is retried after a
+doubling backoff, and a job started MAX_ATTEMPTS times (failures and lost
+workers alike) is marked failed. A handler that cannot start yet raises Defer:
+the job goes back to the queue with `run_after` set instead of holding a worker.
+"""
+import os
+import socket
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from marketdata.models import BackgroundJob
+
+ACTIVE = ("queued", "running")
+STALE_AFTER = timedelta(minutes=5)   # running job without a heartbeat this long is reclaimed
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECS = 10              # first retry delay after a failure, doubled per attempt
+CLOSE_DEFER_SECS = 5                 # re-check interval for a mirror close waiting on its open
+
+HANDLERS = {}
+
+
+class Defer(Exception):
+    """Raised by a handler to be re-queued after `seconds` without using up an attempt."""
+
+    def __init__(self, seconds: float, reason: str = ""):
+        super().__init__(reason)
+        self.seconds = seconds
+
+
+def handler(kind: str):
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue(kind: str, key: str, payload: dict, total: int | None = None) -> tuple:
+    """
+    Queue a job unless one with the same key is still queued/running; returns (job, created).
+    The partial unique constraint on active keys decides concurrent enqueues.
+    """
+    while True:
+        existing = BackgroundJob.objects.filter(key=key, status__in=ACTIVE).order_by("id").first()
+        if existing:
+            return existing, False
+        try:
+            with transaction.atomic():
+                job = BackgroundJob.objects.create(kind=kind, key=key, payload=payload, progress_total=total)
+            return job, True
+        except IntegrityError:
+            continue  # a concurrent enqueue created it first; return that one
+
+
+def claim(worker: str):
+    """
+    Take the oldest runnable job (queued, or running with a stale heartbeat) or None.
+    A job that has already been started MAX_ATTEMPTS times is marked failed instead,
+    so one whose chunk keeps killing its worker can't be reclaimed forever.
+    """
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                BackgroundJob.objects.select_for_update(skip_locked=True)
+                .filter(Q(run_after__isnull=True) | Q(run_after__lte=now), status="queued")
+                .order_by("id")
+                .first()
+            ) or (
+                BackgroundJob.objects.select_for_update(skip_locked=True)
+                .filter(status="running", heartbeat_at__lt=now - STALE_AFTER)
+                .order_by("id")
+                .first()
+            )
+            if job is None:
+                return None
+            if job.attempts >= MAX_ATTEMPTS:
+                job.status = "failed"
+                job.finished_at = now
+                job.error = job.error or f"worker lost {job.attempts} times (last: {job.worker})"
+                job.save(update_fields=["status", "finished_at", "error"])
+                continue
+            job.status = "running"
+            job.worker = worker
+            job.attempts += 1
+            job.started_at = job.started_at or now
+            job.heartbeat_at = now
+            job.save(update_fields=["status", "worker", "attempts", "started_at", "heartbeat_at"])
+            return job
+
+
+def run(job: BackgroundJob) -> None:
+    """Run a claimed job to completion, recording success or failure on the row."""
+    fn = HANDLERS.get(job.kind)
+    try:
+        if fn is None:
+            raise LookupError(f"no handler for job kind {job.kind!r}")
+        fn(job)
+    except Defer as d:
+        job.status = "queued"
+        job.attempts -= 1
+        job.run_after = timezone.now() + timedelta(seconds=d.seconds)
+        job.error = str(d)
+        job.save(update_fields=["status", "attempts", "run_after", "error"])
+        return
+    except Exception as e:
+        job.error = f"{type(e).__name__}: {e}"
+        # transient failures go back to the queue after a backoff; the cursor in
+        # payload keeps finished chunks
+        now = timezone.now()
+        if job.attempts < MAX_ATTEMPTS and fn is not None:
+            job.status = "queued"
+            job.run_after = now + timedelta(seconds=RETRY_BACKOFF_SECS * 2 ** (job.attempts - 1))
+        else:
+            job.status = "failed"
+            job.finished_at = now
+        job.save(update_fields=["error", "status", "run_after", "finished_at"])
+        return
+    job.status = "done"
+    job.finished_at = job.heartbeat_at = timezone.now()
+    job.save(update_fields=["status", "finished_at", "heartbeat_at"])
+
+
+# ---- handlers ----
+
+@handler("admin_trade_apply")
+def apply_admin_trade(job: BackgroundJob) -> None:
+    """payload: {"trade_id", "after_user_id"}; result: totals plus the last chunks."""
+    from marketdata.services.admin_broadcast_trades import apply_admin_trade_chunk, finish_admin_trade
+
+    trade_id = job.payload["trade_id"]
+    while True:
+        with transaction.atomic():
+            res = apply_admin_trade_chunk(trade_id, after_user_id=job.payload.get("after_user_id", 0))
+            job.payload["after_user_id"] = res["last_user_id"]
+            job.progress_done += res["applied"] + res["skipped"]
+            job.result["applied"] = job.result.get("applied", 0) + res["applied"]
+            job.result["skipped"] = job.result.get("skipped", 0) + res["skipped"]
+            job.result["chunks"] = (job.result.get("chunks", []) + [
+                {"applied": res["applied"], "skipped": res["skipped"], "last_user_id": res["last_user_id"]}
+            ])[-20:]
+            job.heartbeat_at = timezone.now()
+            job.save(update_fields=["payload", "progress_done", "result", "heartbeat_at"])
+        if res["finished"]:
+            break
+    finish_admin_trade(trade_id)
+
+
+@handler("admin_trade_mirror_open")
+def open_admin_trade_mirror(job: BackgroundJob) -> None:
+    """payload: {"trade_id", "after_user_id"}; result: opened/skipped totals."""
+    from marketdata.services.admin_broadcast_trades import open_mirror_chunk
+
+    trade_id = job.payload["trade_id"]
+    while True:
+        res = open_mirror_chunk(trade_id, after_user_id=job.payload.get("after_user_id", 0))
+        job.payload["after_user_id"] = res["last_user_id"]
+        job.progress_done += res["opened"] + res["skipped"]
+        job.result["opened"] = job.result.get("opened", 0) + res["opened"]
+        job.result["skipped"] = job.result.get("skipped", 0) + res["skipped"]
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=["payload", "progress_done", "result", "heartbeat_at"])
+        if res["finished"]:
+            break
+
+
+@handler("admin_trade_mirror_close")
+def close_admin_trade_mirror(job: BackgroundJob) -> None:
+    """payload: {"trade_id", "cursor"} (SSCAN cursor of mirror:{ref}); result: closed/realized totals."""
+    from marketdata.services.admin_broadcast_trades import close_mirror_page, finish_mirror_close
+
+    trade_id = job.payload["trade_id"]
+    # an exit saved while the open is still fanning out runs once it has finished;
+    # deferring frees this worker, so a stale open job can still be reclaimed
+    if BackgroundJob.objects.filter(key=f"admin_trade_open:{trade_id}", status__in=ACTIVE).exists():
+        raise Defer(CLOSE_DEFER_SECS, "waiting for the mirror open job to finish")
+    while True:
+        res = close_mirror_page(trade_id, cursor=job.payload.get("cursor", 0))
+        job.payload["cursor"] = res["cursor"]
+        job.progress_done += res["closed"]
+        job.result["closed"] = job.result.get("closed", 0) + res["closed"]
+        job.result["realized"] = job.result.get("realized", 0) + res["realized"]
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=["payload", "progress_done", "result", "heartbeat_at"])
+        if res["finished"]:
+            break
+    finish_mirror_close(trade_id)
+
+
+def enqueue_admin_trade_apply(trade_id: int) -> tuple:
+    """
+    Queue the exit of a trade: close its mirrored positions, or apply P&L to balances.
+    Mirrored trades always take the close path, even before mirror:{ref} exists: the
+    open job may still be queued, and the close job waits for it (see Defer above).
+    """
+    from marketdata.models_admintrades import AdminBroadcastTrade
+    from marketdata.services.admin_broadcast_trades import count_admin_trade_candidates
+
+    trade = AdminBroadcastTrade.objects.get(id=trade_id)
+    if trade.mirror_positions:
+        from marketdata.engine.redis_ops import get_redis
+        from marketdata.services.admin_broadcast_trades import k_mirror
+
+        return enqueue(
+            "admin_trade_mirror_close", f"admin_trade_close:{trade_id}",
+            {"trade_id": trade_id, "cursor": 0},
+            total=get_redis().scard(k_mirror(trade.ref)),
+        )
+    return enqueue(
+        "admin_trade_apply", f"admin_trade_apply:{trade_id}",
+        {"trade_id": trade_id, "after_user_id": 0},
+        total=count_admin_trade_candidates(trade_id),
+    )
+
+
+def enqueue_admin_trade_mirror_open(trade_id: int) -> tuple:
+    from marketdata.services.admin_broadcast_trades import count_admin_trade_candidates
+
+    return enqueue(
+        "admin_trade_mirror_open", f"admin_trade_open:{trade_id}",
+        {"trade_id": trade_id, "after_user_id": 0},
+        total=count_admin_trade_candidates(trade_id),
+    )
@@ -0,0 +1,141 @@
+# marketdata/services/klines.py
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+# Map interval to Alltick kline_type
+INTERVAL_MAP = {
+    "1m": 1, "5m": 2, "15m": 3, "30m": 4,
+    "1h": 5, "4h": 6, "1d": 7,
+}
+
+# How long a cached kline list stays fresh, per interval (seconds).
+# Short intervals expire quickly so the forming bar keeps moving; daily bars barely change.
+INTERVAL_TTL = {
+    "1m": 2, "5m": 5, "15m": 10, "30m": 15,
+    "1h": 30, "4h": 60, "1d": 300,
+}
+DEFAULT_TTL = 5
+
+REQUEST_TIMEOUT = 10
+MAX_CACHE_ENTRIES = 512
+
+_session = None
+_session_lock = threading.Lock()
+
+_lock = threading.Lock()
+_cache = {}      # (symbol, interval, limit) -> (expires_at, candles)
+_inflight = {}   # (symbol, interval, limit) -> _Flight
+
+
+class _Flight:
+    """One upstream call that concurrent identical misses wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_session() -> requests.Session:
+    """Process-wide keep-alive session so chart loads reuse TCP+TLS connections."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+
+def _fetch_upstream(symbol: str, interval: str, limit: int) -> list:
+    query = {
+        "trace": "candles_req",
+        "data": {
+            "code": symbol,
+            "kline_type": INTERVAL_MAP.get(interval, 1),
+            "kline_timestamp_end": 0,
+            "query_kline_num": limit,
+            "adjust_type": 0
+        }
+    }
+
+    url = f"{settings.ALLTICK_BASE_REST}/kline?token={settings.ALLTICK_API_KEY}&query=" \
+          + requests.utils.quote(json.dumps(query))
+
+    r = get_session().get(url, timeout=REQUEST_TIMEOUT)
+    j = r.json()
+
+    kline_list = j.get("data", {}).get("kline_list", [])
+
+    return [
+        {
+            "time": int(item["timestamp"]),  # already seconds
+            "open": float(item["open_price"]),
+            "high": float(item["high_price"]),
+            "low": float(item["low_price"]),
+            "close": float(item["close_price"]),
+            "volume": float(item.get("volume", 0)),
+        }
+        for item in kline_list
+    ]
+
+
+def _store(key, candles, ttl):
+    now = time.monotonic()
+    if len(_cache) >= MAX_CACHE_ENTRIES:
+        for k in [k for k, (exp, _) in _cache.items() if exp <= now]:
+            del _cache[k]
+        if len(_cache) >= MAX_CACHE_ENTRIES:
+            # still full of live entries: drop the one closest to expiry
+            del _cache[min(_cache, key=lambda k: _cache[k][0])]
+    _cache[key] = (now + ttl, candles)
+
+
+def fetch_klines(symbol: str, interval: str, limit: int) -> list:
+    """
+    Return OHLCV candles for (symbol, interval, limit).
+
+    Served from an in-process TTL cache; concurrent misses for the same key
+    share a single upstream request instead of each calling Alltick.
+    The returned list is shared between callers and must not be mutated.
+    """
+    key = (symbol.upper(), interval, int(limit))
+    ttl = INTERVAL_TTL.get(interval, DEFAULT_TTL)
+
+    with _lock:
+        hit = _cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(REQUEST_TIMEOUT + 1):
+            raise TimeoutError(f"kline fetch for {key} timed out")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        candles = _fetch_upstream(*key)
+        flight.result = candles
+        with _lock:
+            _store(key, candles, ttl)
+        return candles
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        flight.done.set()
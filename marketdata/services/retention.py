@@ -0,0 +1,228 @@
+# marketdata/services/retention.py
+"""
+Retention for the append-only time-series tables.
+
+Rows are deleted with raw `DELETE ... WHERE id BETWEEN lo AND hi` statements of
+bounded size, each in its own short transaction, so no statement holds locks
+long enough to stall the writers (the fill persister, the snapshot/checkpoint
+jobs). Ids grow with the timestamp on these tables, so the id range below the
+cutoff is bounded by two index lookups: the table's first id (primary key)
+and the id of the newest row before the cutoff (an index on the policy field,
+e.g. PositionSnapshot.ts; configured policies need one on their field too).
+
+Downsampling keeps one row (the latest) per group and time bucket for rows
+older than `downsample_after`, e.g. hourly snapshots per position after a day.
+
+Tables that were converted to time-range partitioned tables (a manual
+migration, see BACKEND.md) get whole partitions dropped instead, and
+partitions for the coming months created ahead of time.
+"""
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    model: str                          # "app_label.ModelName"
+    field: str = "ts"
+    keep_days: int = 7                  # rows older than this are deleted
+    downsample_after_hours: int = 0     # 0 = no downsampling
+    bucket: str = "hour"                # Trunc kind for downsampling
+    group_by: tuple = ("user_id", "symbol")
+
+
+# PositionSnapshot is the only table pruned by default: fills and ledger rows
+# are the audit trail and only expire if a deployment configures it.
+DEFAULT_POLICIES = (
+    RetentionPolicy("marketdata.PositionSnapshot", keep_days=7, downsample_after_hours=24,
+                    group_by=("user_id", "position_id", "symbol")),
+)
+
+
+def policies() -> list:
+    """settings.RETENTION_POLICIES (list of dicts with RetentionPolicy fields) or the defaults."""
+    configured = getattr(settings, "RETENTION_POLICIES", None)
+    if configured is None:
+        return list(DEFAULT_POLICIES)
+    return [p if isinstance(p, RetentionPolicy) else RetentionPolicy(**{
+        **p, "group_by": tuple(p.get("group_by", RetentionPolicy.group_by)),
+    }) for p in configured]
+
+
+def _id_range(model, field, before):
+    """
+    (first id, id of the newest row with field < before), or None. A row that
+    committed out of id order is left for the next pass, as with downsampling.
+    """
+    hi = (model.objects.filter(**{f"{field}__lt": before})
+          .order_by(f"-{field}").values_list("id", flat=True).first())
+    if hi is None:
+        return None
+    lo = model.objects.order_by("id").values_list("id", flat=True).first()
+    return lo, hi
+
+
+def _chunks(lo, hi, size):
+    start = lo
+    while start <= hi:
+        yield start, min(start + size - 1, hi)
+        start += size
+
+
+def delete_before(model, field, before, chunk_size=10_000, pause=0.0) -> int:
+    """Delete rows with field < before in id-range chunks; returns rows deleted."""
+    bounds = _id_range(model, field, before)
+    if bounds is None:
+        return 0
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.get_field(field).column)
+    sql = f"DELETE FROM {table} WHERE id BETWEEN %s AND %s AND {column} < %s"
+
+    deleted = 0
+    for lo, hi in _chunks(*bounds, chunk_size):
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(sql, [lo, hi, before])
+            deleted += cur.rowcount
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def downsample(model, field, before, bucket="hour", group_by=("user_id", "symbol"),
+               chunk_size=10_000, pause=0.0) -> int:
+    """
+    Keep only the latest row per (group_by, bucket) among rows with field < before.
+    Groups are formed per id chunk, so a bucket straddling two chunks keeps one
+    row in each until the next pass; repeated passes converge.
+    """
+    bounds = _id_range(model, field, before)
+    if bounds is None:
+        return 0
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.get_field(field).column)
+
+    deleted = 0
+    for lo, hi in _chunks(*bounds, chunk_size):
+        keep = (
+            model.objects
+            .filter(id__gte=lo, id__lte=hi, **{f"{field}__lt": before})
+            .annotate(_bucket=Trunc(field, bucket))
+            .order_by()
+            .values(*group_by, "_bucket")
+            .annotate(_keep=Max("id"))
+            .values("_keep")
+        )
+        keep_sql, keep_params = keep.query.sql_with_params()
+        sql = (f"DELETE FROM {table} WHERE id BETWEEN %s AND %s AND {column} < %s "
+               f"AND id NOT IN ({keep_sql})")
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(sql, [lo, hi, before, *keep_params])
+            deleted += cur.rowcount
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+# ---- partitions (PostgreSQL, tables already partitioned by range on the policy field) ----
+
+def is_partitioned(model) -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cur:
+        cur.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s", [model._meta.db_table],
+        )
+        return cur.fetchone() is not None
+
+
+def _month_start(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(dt: datetime) -> datetime:
+    return _month_start(dt + timedelta(days=32))
+
+
+def _partition_name(table: str, start: datetime) -> str:
+    return f"{table}_p{start:%Y%m}"
+
+
+def ensure_partitions(model, months_ahead=2) -> list:
+    """Create monthly partitions from this month through `months_ahead`; returns names created."""
+    table = model._meta.db_table
+    created = []
+    start = _month_start(timezone.now())
+    for _ in range(months_ahead + 1):
+        end = _next_month(start)
+        name = _partition_name(table, start)
+        with connection.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s)", [name])
+            if cur.fetchone()[0] is None:
+                cur.execute(
+                    f"CREATE TABLE {connection.ops.quote_name(name)} PARTITION OF "
+                    f"{connection.ops.quote_name(table)} FOR VALUES FROM (%s) TO (%s)",
+                    [start, end],
+                )
+                created.append(name)
+        start = end
+    return created
+
+
+def drop_partitions_before(model, before) -> list:
+    """Detach and drop monthly partitions that end at or before `before`; returns names dropped."""
+    table = model._meta.db_table
+    with connection.cursor() as cur:
+        cur.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s", [table],
+        )
+        names = [row[0] for row in cur.fetchall()]
+
+    dropped = []
+    prefix = f"{table}_p"
+    for name in sorted(names):
+        suffix = name[len(prefix):] if name.startswith(prefix) else ""
+        try:
+            start = datetime.strptime(suffix, "%Y%m").replace(tzinfo=before.tzinfo)
+        except ValueError:
+            continue  # not one of ours (default partition etc.)
+        if _next_month(start) > before:
+            continue
+        with connection.cursor() as cur:
+            cur.execute(f"ALTER TABLE {connection.ops.quote_name(table)} "
+                        f"DETACH PARTITION {connection.ops.quote_name(name)}")
+            cur.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+        dropped.append(name)
+    return dropped
+
+
+def apply_policy(policy: RetentionPolicy, chunk_size=10_000, pause=0.0, now=None) -> dict:
+    """Run one policy; returns counts for reporting."""
+    model = apps.get_model(policy.model)
+    now = now or timezone.now()
+    cutoff = now - timedelta(days=policy.keep_days)
+    out = {"model": policy.model, "deleted": 0, "downsampled": 0,
+           "partitions_dropped": [], "partitions_created": []}
+
+    if is_partitioned(model):
+        out["partitions_dropped"] = drop_partitions_before(model, cutoff)
+        out["partitions_created"] = ensure_partitions(model)
+    # rows in the partition that straddles the cutoff (or all rows, unpartitioned)
+    out["deleted"] = delete_before(model, policy.field, cutoff, chunk_size, pause)
+
+    if policy.downsample_after_hours:
+        out["downsampled"] = downsample(
+            model, policy.field, now - timedelta(hours=policy.downsample_after_hours),
+            bucket=policy.bucket, group_by=policy.group_by, chunk_size=chunk_size, pause=pause,
+        )
+    return out
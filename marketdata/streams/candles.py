@@ -0,0 +1,152 @@
+# marketdata/streams/candles.py
+"""
+Live candle bars built from the tick stream.
+
+The aggregator runs wherever the feed runs, once: in `run_market_feed`, or by
+default in the first ASGI worker with a quote/candle client (see
+consumers._ensure_feed). Closed and forming bars reach clients through the
+channel layer, and the forming bar is mirrored to Redis so any worker can hand
+it to a newly connected CandleConsumer. Bars are built from mid prices with no volume,
+so closed ones are persisted as synthetic series, apart from upstream klines.
+"""
+import json
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+INTERVAL_SECONDS = {
+    "1m": 60, "5m": 300, "15m": 900, "30m": 1800,
+    "1h": 3600, "4h": 14400, "1d": 86400,
+}
+
+# Forming-bar pushes per (symbol, interval) are conflated to at most one per this many seconds
+PUSH_INTERVAL = 0.25
+
+
+def k_forming(symbol: str, interval: str) -> str:
+    return f"candle:forming:{symbol.upper()}:{interval}"
+
+
+def candle_group(symbol: str, interval: str) -> str:
+    return f"candles_{symbol.upper()}_{interval}"
+
+
+class CandleAggregator:
+    """
+    Builds OHLC bars from the live tick stream and pushes them to
+    `candles_{symbol}_{interval}` groups: the forming bar (conflated) while it
+    moves, and a `final` event once a tick lands in the next bucket.
+    """
+
+    def __init__(self, push_interval: float = PUSH_INTERVAL):
+        self.push_interval = push_interval
+        self._bars = {}       # (symbol, interval) -> bar dict
+        self._partial = set() # bars that started mid-bucket (aggregator came up late)
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._layer = None
+
+    def _send(self, symbol, interval, bar, final):
+        if self._layer is None:
+            self._layer = get_channel_layer()
+        try:
+            async_to_sync(self._layer.group_send)(
+                candle_group(symbol, interval),
+                {
+                    "type": "candle.update",
+                    "candle": {"symbol": symbol, "interval": interval, "final": final, **bar},
+                },
+            )
+        except Exception:
+            pass
+
+    def _persist(self, symbol, interval, bar):
+        if not getattr(settings, "CANDLE_STORE_ENABLED", True):
+            return
+        try:
+            from marketdata.history.candle_store import get_series
+            get_series(symbol, interval, synthetic=True).append([bar])
+        except Exception:
+            pass
+
+    def on_tick(self, symbol: str, price: float, ts: int | None = None):
+        ts = int(ts or time.time())
+        closed = []
+        with self._lock:
+            for interval, secs in INTERVAL_SECONDS.items():
+                key = (symbol, interval)
+                start = ts - ts % secs
+                bar = self._bars.get(key)
+                if bar is not None and start < bar["time"]:
+                    continue  # late tick for an already closed bucket
+                if bar is None or start > bar["time"]:
+                    if bar is not None:
+                        closed.append((interval, bar, key in self._partial))
+                        self._partial.discard(key)
+                    else:
+                        self._partial.add(key)
+                    self._bars[key] = {
+                        "time": start, "open": price, "high": price,
+                        "low": price, "close": price, "volume": 0.0,
+                    }
+                else:
+                    bar["high"] = max(bar["high"], price)
+                    bar["low"] = min(bar["low"], price)
+                    bar["close"] = price
+                self._dirty.add(key)
+
+        for interval, bar, partial in closed:
+            self._send(symbol, interval, bar, final=True)
+            if not partial:
+                self._persist(symbol, interval, bar)
+
+        self._ensure_flusher()
+
+    def current(self, symbol: str, interval: str):
+        with self._lock:
+            bar = self._bars.get((symbol.upper(), interval))
+            return dict(bar) if bar else None
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.push_interval)
+            with self._lock:
+                pending = [(k, dict(self._bars[k])) for k in self._dirty if k in self._bars]
+                self._dirty.clear()
+            for (symbol, interval), bar in pending:
+                self._send(symbol, interval, bar, final=False)
+            self._share(pending)
+
+    def _share(self, pending):
+        if not pending:
+            return
+        try:
+            from marketdata.engine.redis_ops import get_redis
+            pipe = get_redis().pipeline(transaction=False)
+            for (symbol, interval), bar in pending:
+                pipe.set(k_forming(symbol, interval), json.dumps(bar), ex=INTERVAL_SECONDS[interval] * 2)
+            pipe.execute()
+        except Exception:
+            pass
+
+
+def forming_bar(symbol: str, interval: str):
+    """The forming bar as last shared by the market feed process, or None."""
+    from marketdata.engine.redis_ops import get_redis
+    try:
+        raw = get_redis().get(k_forming(symbol, interval))
+    except Exception:
+        return None
+    return json.loads(raw) if raw else None
+
+
+aggregator = CandleAggregator()
@@ -0,0 +1,76 @@
+# marketdata/streams/position_frames.py
+"""
+Per-connection encoding of positions_update frames.
+
+The positions engine publishes one full position dict per tick; what goes on
+the wire depends on the `encoding` the client picked (?encoding= on the
+WebSocket URL or a {"type": "set_encoding"} message):
+
+full   the dict as published (default, unchanged behaviour)
+delta  static fields (symbol, side, net_lots, open_price, open_time) once as
+       `position_meta`, then `positions_update` with the id and only the
+       numeric fields that changed
+tuple  like delta, but `position_meta` assigns a small integer handle `k` and
+       ticks are {"t": "p", "d": [k, mark, unreal_pnl, margin, ts]} with null
+       for an unchanged value
+
+Frames without a position id (batch/fill notifications) pass through as-is.
+"""
+
+ENCODINGS = ("full", "delta", "tuple")
+STATIC_FIELDS = ("symbol", "side", "net_lots", "open_price", "open_time")
+TICK_FIELDS = ("mark", "unreal_pnl", "margin", "ts")
+
+
+class PositionFrameEncoder:
+    def __init__(self, encoding: str = "full"):
+        self.encoding = encoding if encoding in ENCODINGS else "full"
+        self.static = {}    # position id -> static field values last sent
+        self.values = {}    # position id -> tick field values last sent
+        self.handles = {}   # position id -> k (tuple encoding)
+
+    def reset(self, encoding: str | None = None):
+        if encoding in ENCODINGS:
+            self.encoding = encoding
+        self.static.clear()
+        self.values.clear()
+        self.handles.clear()
+
+    def _meta(self, pid, data) -> dict:
+        static = {f: data.get(f) for f in STATIC_FIELDS}
+        self.static[pid] = static
+        self.values[pid] = {f: data.get(f) for f in TICK_FIELDS}
+        meta = {"id": pid, **static, **self.values[pid]}
+        if self.encoding == "tuple":
+            meta["k"] = self.handles.setdefault(pid, len(self.handles) + 1)
+        return {"type": "position_meta", "data": meta}
+
+    def seed(self, positions: list) -> list:
+        """Register a positions_snapshot as already sent; tuple mode adds each position's `k`."""
+        if self.encoding == "full":
+            return positions
+        out = []
+        for pos in positions:
+            meta = self._meta(pos["id"], pos)["data"]
+            out.append({**pos, "k": meta["k"]} if "k" in meta else pos)
+        return out
+
+    def encode(self, data: dict) -> list:
+        """Frames to send for one published positions_update payload."""
+        pid = data.get("id") if isinstance(data, dict) else None
+        if self.encoding == "full" or pid is None:
+            return [{"type": "positions_update", "data": data}]
+
+        static = {f: data.get(f) for f in STATIC_FIELDS}
+        if self.static.get(pid) != static:
+            return [self._meta(pid, data)]
+
+        last = self.values[pid]
+        changed = {f: data.get(f) for f in TICK_FIELDS if data.get(f) != last.get(f)}
+        if not changed:
+            return []
+        last.update(changed)
+
+        if self.encoding == "tuple":
+            return [{"t": "p", "d": [self.handles[pid], *(changed.get(f) for f in TICK_FIELDS)]}]
+        return [{"type": "positions_update", "data": {"id": pid, **changed}}]
@@ -2,8 +2,29 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from marketdata.engine.redis_ops import positions_snapshot
+from marketdata.engine.capital import capital_view
+from marketdata.engine.redis_async import capital_snapshot, positions_snapshot_versioned
 from channels.db import database_sync_to_async
+from urllib.parse import parse_qs
+
+from marketdata.streams.position_frames import PositionFrameEncoder
+
+
+@database_sync_to_async
+def _db_capital(user_id):
+    """Capital from UserAccount; only used while risk:{uid} isn't seeded."""
+    from marketdata.models import UserAccount
+    acc = UserAccount.objects.filter(user_id=user_id).values("balance", "used_margin", "unrealized_pnl").first()
+    if acc is None:
+        return None
+    return capital_view(acc["balance"], acc["used_margin"], acc["unrealized_pnl"])
+
+
+async def _capital_snapshot(uid):
+    seq, capital = await capital_snapshot(uid)
+    if capital is None:
+        capital = await _db_capital(uid)
+    return seq, capital
 
 
 class UserStream(AsyncJsonWebsocketConsumer):
@@ -16,16 +37,36 @@ class UserStream(AsyncJsonWebsocketConsumer):
         self.group = f"user_{self.uid}"
         await self.channel_layer.group_add(self.group, self.channel_name)
         await self.accept()
-        snap = positions_snapshot(self.uid)
-        await self.send_json({"type": "positions_snapshot", "data": snap})
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.frames = PositionFrameEncoder((query.get("encoding") or ["full"])[0])
+        await self.send_positions_snapshot()
+        await self.send_capital_snapshot()
+
+    async def send_positions_snapshot(self):
+        # awaited on the shared async pool; a sync Redis call here would stall the loop
+        version, snap = await positions_snapshot_versioned(self.uid)
+        await self.send_json({"type": "positions_snapshot", "data": self.frames.seed(snap), "version": version,
+                              "encoding": self.frames.encoding})
+
+    async def send_capital_snapshot(self):
+        seq, capital = await _capital_snapshot(self.uid)
+        if capital is not None:
+            await self.send_json({"type": "capital_snapshot", "seq": seq, "data": capital})
+
+    async def receive_json(self, content, **kwargs):
+        # a client that missed a capital_update seq asks for a fresh snapshot
+        if not isinstance(content, dict):
+            return
+        if content.get("type") == "capital_resync":
+            await self.send_capital_snapshot()
+        elif content.get("type") == "set_encoding":
+            # handles and "already sent" state restart from a fresh snapshot
+            self.frames.reset(content.get("encoding"))
+            await self.send_positions_snapshot()
 
     async def disconnect(self, code):
         await self.channel_layer.group_discard(self.group, self.channel_name)
 
-    # positions engine will send to this handler name
-    async def positions_update(self, event):
-        await self.send_json({"type": "positions_update", "data": event["data"]})
-
     # ✅ Fix 1: Add missing handler for margin_alert (error source)
     async def margin_alert(self, event):
         await self.send_json({
@@ -33,19 +74,19 @@ class UserStream(AsyncJsonWebsocketConsumer):
             "data": event.get("data", {}),
         })
 
-    # ✅ Fix 2: Add handler for capital updates
+    # ✅ Fix 2: Add handler for capital updates (changed fields only, numbered by seq)
     async def capital_update(self, event):
         await self.send_json({
             "type": "capital_update",
+            "seq": event.get("seq"),
             "data": event.get("data", event.get("capital", {})),
         })
 
-    # ✅ Fix 3: Add handler for live position updates
+    # ✅ Fix 3: Add handler for live position updates (positions engine sends here),
+    # re-encoded for this connection
     async def positions_update(self, event):
-        await self.send_json({
-            "type": "positions_update",
-            "data": event.get("data", {}),
-        })
+        for frame in self.frames.encode(event.get("data", {})):
+            await self.send_json(frame)
 
     # ✅ Optional: fallback for unknown message types
     async def default(self, event):
@@ -57,39 +98,36 @@ class UserStream(AsyncJsonWebsocketConsumer):
 
 
 class CapitalConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Legacy `ws/user/capital/` endpoint: the same capital stream as UserStream,
+    re-sent as full `{type:"capital", ...}` objects. New clients should use the
+    capital messages on `ws/user/stream/` instead of a second socket.
+    """
     async def connect(self):
         user = self.scope.get("user")
         if not user or user.is_anonymous:
             await self.close()
             return
         self.uid = str(user.id)
-        self.group = f"user_capital_{self.uid}"
+        self.group = f"user_{self.uid}"
         await self.channel_layer.group_add(self.group, self.channel_name)
         await self.accept()
 
-        # Optionally send current capital on connect
-        capital = await self.get_current_capital(self.uid)
-        await self.send_json({"type": "capital", **capital})
+        _, capital = await _capital_snapshot(self.uid)
+        self.capital = capital or {}
+        await self.send_json({"type": "capital", **self.capital})
 
     async def disconnect(self, code):
-        
-        await self.channel_layer.group_discard(self.group, self.channel_name)
+        if hasattr(self, "group"):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
 
     async def capital_update(self, event):
-   
-        await self.send_json({"type": "capital", **event["capital"]})
-
-
-    @database_sync_to_async
-    def get_current_capital(self, user_id):
-        from marketdata.models import UserAccount
-        acc = UserAccount.objects.get(user_id=user_id)
-        equity = acc.balance + acc.unrealized_pnl  # no 'equity' field
-        print(f"[CAPITAL CONSUMER FETCH] user={user_id} balance={acc.balance} equity={equity} used_margin={acc.used_margin} free_margin={acc.free_margin}")
-
-        return {
-            "balance": float(acc.balance),
-            "equity": float(equity),
-            "used_margin": float(acc.used_margin),
-            "free_margin": float(acc.free_margin),  # access the property
-        }
\ No newline at end of file
+        self.capital.update(event.get("capital", {}))
+        await self.send_json({"type": "capital", **self.capital})
+
+    # other user_{uid} traffic is for UserStream
+    async def positions_update(self, event):
+        pass
+
+    async def margin_alert(self, event):
+        pass
@@ -1,3 +1,1229 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from marketdata.models import (
+    BackgroundJob, BalanceCheckpoint, ClosedTrade, Fill, LedgerEntry, Order, PositionCheckpoint,
+    PositionSnapshot, UserAccount,
+)
+
+
+def _redis_available() -> bool:
+    try:
+        from marketdata.engine.redis_ops import get_redis
+        return bool(get_redis().ping())
+    except Exception:
+        return False
+
+
+REDIS_UP = _redis_available()
+
+
+# ---- on-disk candle and tick history (history/candle_store.py, history/tick_store.py) ----
+
+class _TempDirMixin:
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+
+def _bar(t, close, volume=0.0):
+    return {"time": t, "open": close, "high": close, "low": close, "close": close, "volume": volume}
+
+
+class CandleStoreTests(_TempDirMixin, SimpleTestCase):
+    def test_append_replace_and_ignore_older(self):
+        from marketdata.history.candle_store import CandleSeries, to_rows
+        s = CandleSeries("eurusd", "1m", root=self.root)
+        self.assertEqual(s.append([_bar(120, 1.2), _bar(60, 1.1)]), 2)
+        self.assertEqual(s.append([_bar(120, 1.25), _bar(0, 1.0), _bar(180, 1.3)]), 2)
+
+        rows = to_rows(s.range())
+        self.assertEqual([r["time"] for r in rows], [60, 120, 180])
+        self.assertEqual(rows[1]["close"], 1.25)
+        self.assertEqual([r["time"] for r in to_rows(s.tail(2))], [120, 180])
+        self.assertEqual([r["time"] for r in to_rows(s.range(100, 150))], [120])
+
+    def test_reopen_reads_existing_series(self):
+        from marketdata.history.candle_store import CandleSeries
+        CandleSeries("EURUSD", "5m", root=self.root).append([_bar(300, 1.1), _bar(600, 1.2)])
+        self.assertEqual(len(CandleSeries("EURUSD", "5m", root=self.root)), 2)
+
+    def test_rejects_unknown_symbol_and_interval(self):
+        from marketdata.history.candle_store import CandleSeries, get_series, is_valid_series
+        self.assertTrue(is_valid_series("eurusd", "1h"))
+        for symbol, interval in (("../../etc", "1m"), ("EURUSD", "../x"), ("NOPE", "1m"), ("EURUSD", "2m")):
+            self.assertFalse(is_valid_series(symbol, interval))
+            with self.assertRaises(ValueError):
+                get_series(symbol, interval)
+            with self.assertRaises(ValueError):
+                CandleSeries(symbol, interval, root=self.root)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_series_cache_is_bounded(self):
+        from marketdata.history import candle_store
+        with override_settings(CANDLE_STORE_DIR=self.root), \
+                mock.patch.object(candle_store, "MAX_SERIES", 2), \
+                mock.patch.object(candle_store, "_series", candle_store.OrderedDict()):
+            for interval in ("1m", "5m", "15m"):
+                candle_store.get_series("EURUSD", interval)
+            self.assertEqual(list(candle_store._series), [("EURUSD", "5m", False), ("EURUSD", "15m", False)])
+
+    def test_synthetic_bars_kept_apart(self):
+        from marketdata.history.candle_store import get_series
+        with override_settings(CANDLE_STORE_DIR=self.root):
+            get_series("GBPUSD", "1m", synthetic=True).append([_bar(60, 1.3)])
+            self.assertEqual(len(get_series("GBPUSD", "1m")), 0)
+            self.assertEqual(len(get_series("GBPUSD", "1m", synthetic=True)), 1)
+
+
+class CandleViewTests(SimpleTestCase):
+    def _get(self, series):
+        with mock.patch("marketdata.views.get_series", return_value=series), \
+                mock.patch("marketdata.views.is_fresh", return_value=True), \
+                mock.patch("marketdata.views.fetch_klines", return_value=[_bar(0, 1.0)]) as fetch:
+            resp = self.client.get("/api/candles?symbol=EURUSD&interval=1m&limit=3")
+        return resp, fetch
+
+    def test_contiguous_tail_is_served_from_store(self):
+        import json
+        from marketdata.history.candle_store import CandleSeries
+        with tempfile.TemporaryDirectory() as root:
+            series = CandleSeries("EURUSD", "1m", root=root)
+            series.append([_bar(t, 1.1) for t in (0, 60, 120, 180)])
+            resp, fetch = self._get(series)
+        fetch.assert_not_called()
+        self.assertEqual([row["time"] for row in json.loads(resp.content)], [60, 120, 180])
+
+    def test_gap_in_tail_falls_back_to_upstream(self):
+        from marketdata.history.candle_store import CandleSeries
+        with tempfile.TemporaryDirectory() as root:
+            series = CandleSeries("EURUSD", "1m", root=root)
+            series.append([_bar(t, 1.1) for t in (0, 60, 600, 660)])  # feed was down in between
+            resp, fetch = self._get(series)
+        self.assertEqual(resp.status_code, 200)
+        fetch.assert_called_once_with("EURUSD", "1m", 3)
+
+    def test_unknown_series_is_rejected(self):
+        for query in ("symbol=../../tmp&interval=1m", "symbol=EURUSD&interval=..%2Fx"):
+            with mock.patch("marketdata.views.get_series") as get_series:
+                resp = self.client.get(f"/api/candles?{query}")
+            self.assertEqual(resp.status_code, 400)
+            get_series.assert_not_called()
+
+
+# ---- market feed placement (consumers._ensure_feed) ----
+
+class EnsureFeedTests(SimpleTestCase):
+    def _ensure(self, alive, **settings):
+        from marketdata import consumers
+        with override_settings(**settings), \
+                mock.patch.object(consumers, "_symbol_threads", {}), \
+                mock.patch.object(consumers, "_feed_missing_logged", 0.0), \
+                mock.patch.object(consumers, "r") as r, \
+                mock.patch.object(consumers.threading, "Thread") as thread:
+            r.exists.return_value = alive
+            with self.assertLogs("marketdata.consumers", "WARNING") as logs:
+                consumers.logger.warning("probe")
+                consumers._ensure_feed()
+            return thread.called, logs.output[1:]
+
+    def test_default_starts_feed_in_worker(self):
+        started, logs = self._ensure(alive=False)
+        self.assertTrue(started)
+        self.assertIn("inside this ASGI worker", logs[0])
+
+    def test_running_feed_process_wins(self):
+        self.assertEqual(self._ensure(alive=True), (False, []))
+
+    def test_missing_feed_process_is_logged(self):
+        started, logs = self._ensure(alive=False, MARKET_FEED_IN_WORKERS=False)
+        self.assertFalse(started)
+        self.assertIn("no run_market_feed process", logs[0])
+
+
+# ---- tick history (history/tick_store.py) ----
+
+class TickStoreTests(_TempDirMixin, SimpleTestCase):
+    def test_record_flush_and_read_range(self):
+        from marketdata.history.tick_store import TickRecorder, read_ticks, tick_at
+        rec = TickRecorder(root=self.root)
+        base = 1_700_000_000_000
+        for i in range(5):
+            rec.record("EURUSD", base + i * 1000, 1.1 + i / 1000, 1.1002 + i / 1000)
+            if i == 2:
+                rec.flush()
+        rec.record("NOPE", base, 1, 1)  # unknown symbols are not recorded
+        rec.flush()
+
+        ticks = read_ticks("EURUSD", base + 1000, base + 3000, root=self.root)
+        self.assertEqual([t["ts"] for t in ticks], [base + 1000, base + 2000, base + 3000])
+        self.assertAlmostEqual(ticks[0]["bid"], 1.101)
+        self.assertEqual(read_ticks("EURUSD", base, base + 10_000, limit=2, root=self.root)[-1]["ts"],
+                         base + 1000)
+        self.assertEqual(tick_at("EURUSD", base + 2500, root=self.root)["ts"], base + 2000)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "NOPE")))
+
+    def test_flush_keeps_buffer_order_per_file(self):
+        from marketdata.history.tick_store import TickRecorder, read_ticks
+        rec = TickRecorder(root=self.root)
+        base = 1_700_000_000_000
+        for i in range(600):  # crosses the record-triggered flush threshold twice
+            rec.record("GBPUSD", base + i, 1.3, 1.3)
+        rec.flush()
+        ts = [t["ts"] for t in read_ticks("GBPUSD", base, base + 600, root=self.root)]
+        self.assertEqual(ts, sorted(ts))
+        self.assertEqual(len(ts), 600)
+
+    def test_out_of_order_ticks_are_clamped(self):
+        from marketdata.history.tick_store import TickRecorder, read_ticks
+        base = 1_700_000_000_000
+        rec = TickRecorder(root=self.root)
+        for offset, bid in ((0, 1.1), (3000, 1.3), (2000, 1.2)):
+            rec.record("EURUSD", base + offset, bid, bid)
+        rec.flush()
+        # a restarted recorder only knows the file's last record
+        late = TickRecorder(root=self.root)
+        late.record("EURUSD", base + 1000, 1.15, 1.15)
+        late.flush()
+
+        ticks = read_ticks("EURUSD", base, base + 5000, root=self.root)
+        self.assertEqual([t["ts"] - base for t in ticks], [0, 3000, 3000, 3000])
+        self.assertEqual([t["bid"] for t in ticks], [1.1, 1.3, 1.2, 1.15])
+        self.assertEqual(len(read_ticks("EURUSD", base + 2500, base + 3500, root=self.root)), 3)
+
+
+# ---- tick replay (replay_ticks) ----
+
+class ReplayTicksGuardTests(SimpleTestCase):
+    def test_refuses_without_setting_or_flag(self):
+        from django.core.management import CommandError, call_command
+        with mock.patch("marketdata.management.commands.replay_ticks.get_redis") as get_redis:
+            with self.assertRaisesMessage(CommandError, "REPLAY_TICKS_ALLOWED"):
+                call_command("replay_ticks", "--start", "0", "--end", "1000")
+        get_redis.assert_not_called()
+
+    def test_publishes_on_replay_channel(self):
+        from marketdata.management.commands import replay_ticks
+        self.assertEqual(replay_ticks.k_replay_ticks("EURUSD"), "replay:ticks:EURUSD")
+
+
+# ---- versioned positions snapshot (PositionsSnapshotView) ----
+
+@skipUnless(REDIS_UP, "needs Redis at REDIS_URL")
+class PositionsSnapshotETagTests(TestCase):
+    def setUp(self):
+        from marketdata.engine.redis_ops import get_redis, k_posmark, k_posver
+        self.user = User.objects.create_user("etag_user", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.r = get_redis()
+        self.k_posmark = k_posmark(self.user.id)
+        keys = [k_posver(self.user.id), self.k_posmark]
+        self.r.delete(*keys)
+        self.addCleanup(self.r.delete, *keys)
+        self.r.set(k_posver(self.user.id), 7)
+
+    def test_etag_moves_with_marks(self):
+        first = self.client.get("/api/positions/snapshot")
+        self.assertEqual(first.status_code, 200)
+        etag = first["ETag"]
+        self.assertEqual(self.client.get("/api/positions/snapshot", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.r.set(self.k_posmark, 1_700_000_000)  # a tick re-marked a position
+        again = self.client.get("/api/positions/snapshot", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again["ETag"], '"7.1700000000"')
+
+
+# ---- per-user per-symbol position index (engine/redis_ops.py, cache_positions) ----
+
+@skipUnless(REDIS_UP, "needs Redis at REDIS_URL")
+class UserposBackfillTests(SimpleTestCase):
+    UID = 900_000_001
+
+    def setUp(self):
+        from marketdata.engine.redis_ops import get_redis, k_pos, k_posidx, k_symidx, k_userpos
+        self.r = get_redis()
+        self.keys = [k_pos(self.UID, "legacy"), k_pos(self.UID, "gone"), k_posidx(self.UID),
+                     k_userpos(self.UID, "EURUSD")]
+        self.r.delete(*self.keys)
+        self.addCleanup(self.r.delete, *self.keys)
+        self.addCleanup(self.r.srem, k_symidx("EURUSD"), self.UID)
+        # opened before the index: only in posidx; "gone" was closed but left in posidx
+        self.r.hset(k_pos(self.UID, "legacy"), mapping={"symbol": "EURUSD", "net_lots": 1, "avg_entry": 1.1})
+        self.r.sadd(k_posidx(self.UID), "legacy", "gone")
+
+    def test_index_userpos_backfills_legacy_positions(self):
+        from django.core.management import call_command
+        from marketdata.engine.redis_ops import k_symidx, k_userpos, positions_for_symbol
+        self.assertEqual(positions_for_symbol(self.UID, "EURUSD"), [])
+        call_command("cache_positions", "--index-userpos", stdout=StringIO())
+        self.assertEqual(self.r.smembers(k_userpos(self.UID, "EURUSD")), {"legacy"})
+        self.assertTrue(self.r.sismember(k_symidx("EURUSD"), self.UID))
+        self.assertEqual([p["id"] for p in positions_for_symbol(self.UID, "EURUSD")], ["legacy"])
+
+
+class RebuildFromFillsTests(TestCase):
+    def _fill(self, pid, side, lots, price, minute):
+        ts = timezone.now() - timedelta(hours=1) + timedelta(minutes=minute)
+        order = Order.objects.create(user_id=7, position_id=pid, symbol="EURUSD", side=side,
+                                     lots=Decimal(lots), price=Decimal(price), leverage=100)
+        Fill.objects.create(order=order, user_id=7, symbol="EURUSD", side=side, lots=Decimal(lots),
+                            price=Decimal(price), ts=ts)
+
+    def test_replays_only_positions_still_open(self):
+        from marketdata.management.commands.cache_positions import Command
+
+        self._fill("added", "Buy", "1", "1.1", 0)
+        self._fill("added", "Buy", "1", "1.2", 1)
+        self._fill("flat", "Buy", "1", "1.1", 0)
+        self._fill("flat", "Sell", "1", "1.2", 1)
+        self._fill("booked", "Buy", "1", "1.1", 0)
+        ClosedTrade.objects.create(user_id=7, position_id="booked", symbol="EURUSD", side="Buy",
+                                   lots=1, entry_price=Decimal("1.1"), exit_price=Decimal("1.1"),
+                                   realized_pnl=0)
+        # went flat, then the same id was reused for a short
+        self._fill("reopened", "Buy", "1", "1.0", 0)
+        self._fill("reopened", "Sell", "1", "1.1", 1)
+        self._fill("reopened", "Sell", "0.5", "1.2", 2)
+
+        out = dict(Command()._open_positions(chunk_size=2))
+        self.assertEqual(sorted(out), ["added", "reopened"])
+        added, reopened = out["added"], out["reopened"]
+        self.assertEqual((added["net_lots"], added["leverage"], added["user_id"]), (2.0, 100, 7))
+        self.assertAlmostEqual(added["avg_entry"], 1.15)
+        self.assertEqual(reopened["net_lots"], -0.5)
+        self.assertAlmostEqual(reopened["avg_entry"], 1.2)
+        self.assertEqual((reopened["realized_total"], reopened["closed_lots"]), (0.0, 0.0))
+
+
+# ---- pre-trade risk gate (engine/risk.py) ----
+
+@skipUnless(REDIS_UP, "needs Redis at REDIS_URL")
+class RiskReservationTests(TestCase):
+    def setUp(self):
+        from marketdata.engine.redis_ops import get_redis
+        from marketdata.engine.risk import k_risk, k_riskpend, k_riskres
+        self.users = [User.objects.create_user(f"risk_user_{i}", password="x") for i in range(2)]
+        UserAccount.objects.filter(user__in=self.users).update(balance=Decimal("1000"))
+        keys = [k for u in self.users for k in (k_risk(u.id), k_riskres(u.id), k_riskpend(u.id))]
+        get_redis().delete(*keys)
+        self.addCleanup(lambda: get_redis().delete(*keys))
+
+    def test_reservation_holds_free_margin(self):
+        from marketdata.engine.risk import release_margin, reserve_margin
+        uid = self.users[0].id
+        ok, free, rid = reserve_margin(uid, Decimal("600"))
+        self.assertTrue(ok)
+        self.assertEqual(free, Decimal("1000"))
+
+        ok, free, rid2 = reserve_margin(uid, Decimal("600"))
+        self.assertFalse(ok)
+        self.assertIsNone(rid2)
+        self.assertEqual(free, Decimal("400"))
+
+        release_margin(uid, rid)
+        self.assertTrue(reserve_margin(uid, Decimal("600"))[0])
+
+    def test_missing_account(self):
+        from marketdata.engine.risk import reserve_margin
+        ok, _free, rid = reserve_margin(10 ** 9, Decimal("1"))
+        self.assertIsNone(ok)
+        self.assertIsNone(rid)
+
+    def test_reserve_many_only_users_with_room(self):
+        from marketdata.engine.risk import check_margin, release_margins, reserve_margin_many
+        poor, rich = self.users
+        UserAccount.objects.filter(user=poor).update(balance=Decimal("10"))
+        held = reserve_margin_many([poor.id, rich.id], Decimal("500"))
+        self.assertEqual(set(held), {rich.id})
+        self.assertEqual(check_margin(rich.id, Decimal("0"))[1], Decimal("500"))
+        release_margins(held)
+        self.assertEqual(check_margin(rich.id, Decimal("0"))[1], Decimal("1000"))
+
+    def test_exposure_refresh_keeps_realized_balance(self):
+        from marketdata.engine.redis_ops import get_redis
+        from marketdata.engine.risk import check_margin, incr_risk_field, set_risk_exposure
+        uid = self.users[0].id
+        check_margin(uid, Decimal("0"))               # seeds balance 1000 from the database
+        incr_risk_field(get_redis(), uid, "balance", "-300")  # losing close, not persisted yet
+        set_risk_exposure(get_redis(), uid, "100", "-20")     # next tick / margin updater pass
+        self.assertEqual(check_margin(uid, Decimal("0"))[1], Decimal("580"))
+
+    def test_seed_adds_unbooked_realized_once(self):
+        from marketdata.engine.redis_ops import get_redis
+        from marketdata.engine.risk import check_margin, k_risk, stage_pending_realized
+        user = self.users[0]
+        stage_pending_realized(get_redis(), user.id, "e1", "-300")
+        self.assertEqual(check_margin(user.id, Decimal("0"))[1], Decimal("700"))
+
+        # the persister books it; a re-seed before the pending entry is cleared counts it once
+        order = Order.objects.create(user_id=user.id, symbol="EURUSD", side="Sell", lots=1, price=1)
+        Fill.objects.create(order=order, user_id=user.id, symbol="EURUSD", side="Sell", lots=1, price=1,
+                            realized_pnl=Decimal("-300"), event_id="e1")
+        UserAccount.objects.filter(user=user).update(balance=Decimal("700"))
+        get_redis().delete(k_risk(user.id))
+        self.assertEqual(check_margin(user.id, Decimal("0"))[1], Decimal("700"))
+
+
+# ---- fill journal persistence (engine/journal.py) ----
+
+def _event(uid, client_id=None, realized="0", lots="1"):
+    from marketdata.engine.journal import new_fill_event
+    ev = new_fill_event(uid, "EURUSD", "Buy", lots, "1.1", 500, client_id=client_id)
+    ev.update({"position_id": "pos-1", "realized": realized, "new_net": lots, "new_avg": "1.1"})
+    return ev
+
+
+class JournalRedeliveryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("journal_user", password="x")
+
+    def test_redelivered_event_is_booked_once(self):
+        from marketdata.engine.journal import persist_fill_events
+        ev = _event(self.user.id, realized="5")
+        self.assertEqual(persist_fill_events([ev]), 1)
+        self.assertEqual(persist_fill_events([ev]), 0)
+        self.assertEqual(persist_fill_events([ev, dict(ev)]), 0)
+
+        self.assertEqual(Fill.objects.filter(event_id=ev["eid"]).count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(user_id=self.user.id).count(), 1)
+        self.assertEqual(UserAccount.objects.get(user=self.user).balance, Decimal("5"))
+
+    def test_event_reusing_client_order_is_booked_once(self):
+        from marketdata.engine.journal import persist_fill_events
+        order = Order.objects.create(user_id=self.user.id, symbol="EURUSD", side="Buy", lots=1,
+                                     price=Decimal("1.1"), type="market", status="filled", client_id="c9")
+        ev = _event(self.user.id, client_id="c9")
+        self.assertEqual(persist_fill_events([ev]), 1)
+        self.assertEqual(persist_fill_events([ev]), 0)
+        self.assertEqual(Fill.objects.filter(order=order).count(), 1)
+        self.assertEqual(Order.objects.filter(client_id="c9").count(), 1)
+
+    def test_rows_carry_the_fill_time(self):
+        from marketdata.engine.journal import persist_fill_events
+        from marketdata.models import PositionSnapshot
+        ev = _event(self.user.id, realized="2")
+        fill_time = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+        ev["ts"] = fill_time.timestamp()
+        persist_fill_events([ev])
+
+        fill = Fill.objects.get(event_id=ev["eid"])
+        self.assertEqual(fill.ts, fill_time)
+        self.assertEqual(fill.order.created_at, fill_time)
+        self.assertEqual(LedgerEntry.objects.get(user_id=self.user.id).ts, fill_time)
+        self.assertEqual(PositionSnapshot.objects.get(user_id=self.user.id).ts, fill_time)
+
+    def test_duplicate_in_one_batch(self):
+        from marketdata.engine.journal import persist_fill_events
+        ev = _event(self.user.id)
+        self.assertEqual(persist_fill_events([ev, dict(ev)]), 1)
+        self.assertEqual(Fill.objects.count(), 1)
+
+
+class PersisterDeadLetterTests(SimpleTestCase):
+    def setUp(self):
+        from marketdata.management.commands.run_fill_persister import Command
+        self.cmd = Command(stdout=StringIO(), stderr=StringIO())
+        self.cmd._booked = 0
+        self.r = mock.Mock()
+        self.r.xpending_range.return_value = [{"times_delivered": 5}]
+        self.entries = [("1-0", {"data": '{"eid": "a"}'}), ("2-0", {"data": '{"eid": "b"}'})]
+
+    def _persist(self, error):
+        target = "marketdata.management.commands.run_fill_persister.persist_fill_events"
+        with mock.patch(target, side_effect=error):
+            self.cmd._persist(self.r, self.entries)
+
+    def test_database_outage_leaves_events_pending(self):
+        from django.db import OperationalError
+        self._persist(OperationalError("connection refused"))
+        self.r.xadd.assert_not_called()
+        self.r.xack.assert_not_called()
+
+    def test_persistent_error_dead_letters_after_max_deliveries(self):
+        from marketdata.engine.journal import DEAD_LETTER_STREAM
+        self._persist(ValueError("bad event"))
+        self.assertEqual([c.args[0] for c in self.r.xadd.call_args_list], [DEAD_LETTER_STREAM] * 2)
+        self.r.xack.assert_called_once_with("journal:fills", "persister", "1-0", "2-0")
+
+
+@skipUnless(REDIS_UP, "needs Redis at REDIS_URL")
+class RequeueDeadFillsTests(SimpleTestCase):
+    def setUp(self):
+        from marketdata.engine.journal import DEAD_LETTER_STREAM, JOURNAL_STREAM
+        from marketdata.engine.redis_ops import get_redis
+        self.r = get_redis()
+        self.dead, self.journal = f"test:{DEAD_LETTER_STREAM}", f"test:{JOURNAL_STREAM}"
+        self.r.delete(self.dead, self.journal)
+        self.addCleanup(self.r.delete, self.dead, self.journal)
+
+    def test_moves_events_back_to_the_journal(self):
+        from marketdata.engine import journal
+        keep = self.r.xadd(self.dead, {"data": '{"eid": "a"}', "error": "x"})
+        self.r.xadd(self.dead, {"data": '{"eid": "b"}', "error": "x"})
+        with mock.patch.object(journal, "DEAD_LETTER_STREAM", self.dead), \
+                mock.patch.object(journal, "JOURNAL_STREAM", self.journal):
+            self.assertEqual(journal.requeue_dead_letters(self.r, ids=[keep]), 1)
+            self.assertEqual(journal.requeue_dead_letters(self.r), 1)
+        self.assertEqual([f["data"] for _, f in self.r.xrange(self.journal)], ['{"eid": "a"}', '{"eid": "b"}'])
+        self.assertEqual(self.r.xlen(self.dead), 0)
+
+
+# ---- order idempotency (engine/idempotency.py, SimFillView) ----
+
+@skipUnless(REDIS_UP, "needs Redis at REDIS_URL")
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        from marketdata.engine import idempotency
+        self.idem = idempotency
+        self.user = User.objects.create_user("idem_user", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.addCleanup(lambda: idempotency.release(self.user.id, "c1"))
+
+    def test_claim_complete_replay(self):
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("new", None))
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("pending", None))
+        self.idem.complete(self.user.id, "c1", 200, {"ok": True})
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("done", {"status": 200, "body": {"ok": True}}))
+
+    def test_release_allows_retry(self):
+        self.idem.claim(self.user.id, "c1")
+        self.idem.release(self.user.id, "c1")
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("new", None))
+
+    def test_failure_after_apply_replays_instead_of_refilling(self):
+        calls = []
+
+        def on_fill(uid, symbol, side, lots, price, on_applied=None, **kwargs):
+            calls.append(symbol)
+            on_applied({"position_id": "p1", "new_net": lots, "new_avg": price, "realized": 0,
+                        "updated_at": 1})
+            raise RuntimeError("channel layer down")
+
+        body = {"symbol": "EURUSD", "side": "Buy", "lots": 1, "price": 1.1, "client_id": "c1"}
+        with mock.patch("marketdata.views.on_fill", on_fill):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/api/sim/fill", body, format="json")
+            resp = self.client.post("/api/sim/fill", body, format="json")
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Idempotent-Replayed"], "true")
+        self.assertEqual(resp.data["position"]["id"], "p1")
+
+    def test_failure_before_apply_releases_key(self):
+        def on_fill(*args, **kwargs):
+            raise RuntimeError("redis down")
+
+        body = {"symbol": "EURUSD", "side": "Buy", "lots": 1, "price": 1.1, "client_id": "c1"}
+        with mock.patch("marketdata.views.on_fill", on_fill):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/api/sim/fill", body, format="json")
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("new", None))
+
+    def test_rejected_request_releases_key(self):
+        body = {"symbol": "EURUSD", "side": "Hold", "lots": 1, "price": 1.1, "client_id": "c1"}
+        self.assertEqual(self.client.post("/api/sim/fill", body, format="json").status_code, 400)
+        self.assertEqual(self.idem.claim(self.user.id, "c1"), ("new", None))
+
+
+# ---- bulk orders and close-all (BulkOrderView, CloseAllPositionsView, apply_fills_batch) ----
+
+class BulkOrderViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("bulk_user", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _post(self, orders):
+        return self.client.post("/api/orders/bulk", {"orders": orders}, format="json")
+
+    def test_rejects_invalid_batches_before_filling(self):
+        good = {"symbol": "EURUSD", "side": "Buy", "lots": 1, "price": 1.1}
+        with mock.patch("marketdata.views.submit_orders") as submit:
+            self.assertEqual(self._post([]).status_code, 400)
+            resp = self._post([good, dict(good, side="Hold")])
+            self.assertEqual((resp.status_code, resp.data["index"]), (400, 1))
+            self.assertEqual(self._post([dict(good, symbol="NOPE")]).status_code, 400)
+            from marketdata.views import BULK_ORDER_MAX
+            self.assertEqual(self._post([good] * (BULK_ORDER_MAX + 1)).status_code, 400)
+        submit.assert_not_called()
+
+    def test_fills_all_orders(self):
+        def submit_orders(uid, orders, on_applied=None):
+            return [{"symbol": o["symbol"], "position_id": f"p{i}", "new_net": o["lots"],
+                     "new_avg": o["price"], "updated_at": 1} for i, o in enumerate(orders)]
+
+        orders = [{"symbol": "eurusd", "side": "Buy", "lots": 1, "price": 1.1, "client_id": "a"},
+                  {"symbol": "GBPUSD", "side": "Sell", "lots": 2, "price": 1.3}]
+        with mock.patch("marketdata.views.submit_orders", submit_orders):
+            resp = self._post(orders)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([o["position"]["id"] for o in resp.data["orders"]], ["p0", "p1"])
+        self.assertEqual(resp.data["orders"][0]["symbol"], "EURUSD")
+        self.assertEqual(resp.data["orders"][0]["client_id"], "a")
+
+    def test_conflicting_position_update_is_409(self):
+        import redis
+        with mock.patch("marketdata.views.submit_orders", side_effect=redis.WatchError):
+            resp = self._post([{"symbol": "EURUSD", "side": "Buy", "lots": 1, "price": 1.1}])
+        self.assertEqual(resp.status_code, 409)
+
+
+class CloseAllPositionsViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("closeall_user", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_closes_and_sums_realized(self):
+        results = [{"position_id": "p1", "symbol": "EURUSD", "fill_lots": -1.0, "realized": 5.0},
+                   {"position_id": "p2", "symbol": "EURUSD", "fill_lots": 2.0, "realized": -1.5}]
+        with mock.patch("marketdata.views.close_positions", return_value=(results, ["XAUUSD"])) as close:
+            resp = self.client.post("/api/positions/close_all", {"symbol": "eurusd"}, format="json")
+        close.assert_called_once_with(self.user.id, "EURUSD")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["realized_pnl"], 3.5)
+        self.assertEqual([c["side"] for c in resp.data["closed"]], ["Sell", "Buy"])
+        self.assertEqual(resp.data["skipped"], ["XAUUSD"])
+
+    def test_conflicting_position_update_is_409(self):
+        import redis
+        with mock.patch("marketdata.views.close_positions", side_effect=redis.WatchError):
+            resp = self.client.post("/api/positions/close_all", {}, format="json")
+        self.assertEqual(resp.status_code, 409)
+
+
+class ApplyFillsBatchWatchTests(SimpleTestCase):
+    def test_retries_when_a_position_changes_between_read_and_multi(self):
+        import redis
+        from marketdata.engine import redis_ops
+
+        res = {"uid": 7, "position_id": "p1", "new_net": 1.0}
+        with mock.patch.object(redis_ops, "get_redis"), \
+                mock.patch.object(redis_ops, "_book_sync") as book, \
+                mock.patch.object(redis_ops, "_fanout_once",
+                                  side_effect=[redis.WatchError, ([res], ["ev"])]) as once:
+            out = redis_ops.apply_fills_batch(7, [{"position_id": "p1", "fill_lots": 1.0}])
+        self.assertEqual(once.call_count, 2)
+        self.assertEqual(out, [{"position_id": "p1", "new_net": 1.0}])
+        book.assert_called_once_with(["ev"])
+
+    def test_gives_up_with_watch_error(self):
+        import redis
+        from marketdata.engine import redis_ops
+
+        with mock.patch.object(redis_ops, "get_redis"), \
+                mock.patch.object(redis_ops, "_book_sync") as book, \
+                mock.patch.object(redis_ops, "_fanout_once", side_effect=redis.WatchError):
+            with self.assertRaises(redis.WatchError):
+                redis_ops.apply_fills_batch(7, [{"position_id": "p1", "fill_lots": 1.0}])
+        book.assert_not_called()
+
+
+# ---- keyset pagination and history filters (pagination.py) ----
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("pager_user", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        order = Order.objects.create(user_id=self.user.id, symbol="EURUSD", side="Buy", lots=1,
+                                     price=Decimal("1.1"))
+        day = timezone.now().replace(year=2025, month=3, day=10, hour=12, minute=0, second=0, microsecond=0)
+        # two fills share a timestamp, so the id tie-break matters
+        for hours, symbol in ((0, "EURUSD"), (1, "EURUSD"), (1, "GBPUSD"), (24, "EURUSD"), (48, "EURUSD")):
+            Fill.objects.create(order=order, user_id=self.user.id, symbol=symbol, side="Buy", lots=1,
+                                price=Decimal("1.1"), ts=day + timedelta(hours=hours))
+        self.expected = list(Fill.objects.order_by("-ts", "-id").values_list("id", flat=True))
+
+    def _ids(self, url):
+        ids = []
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            ids += [row["id"] for row in resp.data["results"]]
+            url = resp.data["next"]
+        return ids
+
+    def test_pages_cover_every_row_once(self):
+        self.assertEqual(self._ids("/api/fills?limit=2"), self.expected)
+        self.assertEqual(self._ids("/api/fills?limit=500"), self.expected)
+
+    def test_filters_combine_with_cursor(self):
+        ids = self._ids("/api/fills?limit=1&symbol=eurusd&start=2025-03-10&end=2025-03-11")
+        self.assertEqual(len(ids), 3)
+        self.assertFalse(Fill.objects.filter(id__in=ids, symbol="GBPUSD").exists())
+        self.assertEqual(len(self._ids("/api/fills?start=2025-03-10T13:00:00Z")), 4)
+
+    def test_bad_parameters_are_400(self):
+        for query in ("start=2024-13-45", "end=2024-02-30T10:00", "start=yesterday", "cursor=abc", "limit=x"):
+            self.assertEqual(self.client.get(f"/api/fills?{query}").status_code, 400, query)
+
+
+# ---- time-series retention (services/retention.py) ----
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(minute=30, second=0, microsecond=0)
+        ages = (
+            timedelta(days=10), timedelta(days=10, minutes=-5),           # past keep_days
+            timedelta(days=2, minutes=25), timedelta(days=2, minutes=20),  # one hour bucket ...
+            timedelta(days=2, minutes=10),
+            timedelta(days=2, hours=-1),                                   # ... and the next one
+            timedelta(minutes=20), timedelta(minutes=10),                  # recent: kept as is
+        )
+        for age in ages:  # oldest first, so ids grow with ts as in production
+            PositionSnapshot.objects.create(
+                user_id=1, position_id="p1", symbol="EURUSD", net_lots=1, avg_entry=1,
+                unreal_pnl=0, margin=0, mark=1, ts=self.now - age,
+            )
+
+    def test_delete_before_in_small_chunks(self):
+        from marketdata.services.retention import delete_before
+        cutoff = self.now - timedelta(days=7)
+        self.assertEqual(delete_before(PositionSnapshot, "ts", self.now - timedelta(days=30)), 0)
+        self.assertEqual(delete_before(PositionSnapshot, "ts", cutoff, chunk_size=1), 2)
+        self.assertFalse(PositionSnapshot.objects.filter(ts__lt=cutoff).exists())
+        self.assertEqual(PositionSnapshot.objects.count(), 6)
+
+    def test_default_policy_deletes_then_downsamples(self):
+        from marketdata.services.retention import DEFAULT_POLICIES, apply_policy
+        out = apply_policy(DEFAULT_POLICIES[0], now=self.now)
+        self.assertEqual((out["deleted"], out["downsampled"]), (2, 2))
+        kept = list(PositionSnapshot.objects.order_by("ts").values_list("ts", flat=True))
+        self.assertEqual(kept, [self.now - age for age in (
+            timedelta(days=2, minutes=10), timedelta(days=2, hours=-1),
+            timedelta(minutes=20), timedelta(minutes=10),
+        )])
+
+    @override_settings(RETENTION_POLICIES=[{"model": "marketdata.Fill", "keep_days": 90,
+                                            "group_by": ["user_id"]}])
+    def test_configured_policies(self):
+        from marketdata.services.retention import RetentionPolicy, policies
+        self.assertEqual(policies(), [RetentionPolicy("marketdata.Fill", keep_days=90, group_by=("user_id",))])
+
+
+# ---- position checkpoint pruning (run_position_checkpointer) ----
+
+class CheckpointPruneTests(TestCase):
+    def setUp(self):
+        from marketdata.management.commands.run_position_checkpointer import Command
+        self.cmd = Command(stdout=StringIO(), stderr=StringIO())
+        self.started = timezone.now()
+        old = self.started - timedelta(seconds=30)
+        for pid in ("open-1", "open-2", "closed-1"):
+            PositionCheckpoint.objects.create(
+                position_id=pid, user_id=1, symbol="EURUSD", net_lots=1, avg_entry=1,
+                checkpointed_at=old,
+            )
+        ClosedTrade.objects.create(user_id=1, position_id="closed-1", symbol="EURUSD", side="Buy",
+                                   lots=1, entry_price=1, exit_price=1, realized_pnl=0,
+                                   closed_at=old + timedelta(seconds=5))
+
+    def _remaining(self):
+        return set(PositionCheckpoint.objects.values_list("position_id", flat=True))
+
+    def test_empty_pass_keeps_unconfirmed_checkpoints(self):
+        self.cmd._last_seen = 3
+        self.assertEqual(self.cmd._prune(self.started, seen=0), 1)
+        self.assertEqual(self._remaining(), {"open-1", "open-2"})
+        self.assertEqual(self.cmd._last_seen, 3)
+
+    def test_shrunken_pass_keeps_unconfirmed_checkpoints(self):
+        self.cmd._last_seen = 100
+        self.cmd._prune(self.started, seen=10)
+        self.assertEqual(self._remaining(), {"open-1", "open-2"})
+
+    def test_healthy_pass_drops_everything_unseen(self):
+        self.cmd._last_seen = 3
+        self.assertEqual(self.cmd._prune(self.started, seen=3), 3)
+        self.assertEqual(self._remaining(), set())
+        self.assertEqual(self.cmd._last_seen, 3)
+
+
+# ---- admin broadcast trade mirroring (services/admin_broadcast_trades.py, services/jobs.py) ----
+
+class MirrorRoutingTests(TestCase):
+    def setUp(self):
+        from marketdata.models_admintrades import AdminBroadcastTrade
+        self.trade = AdminBroadcastTrade.objects.create(
+            symbol="EURUSD", side="Buy", lots=Decimal("1"), entry_price=Decimal("1.1"),
+            status="live", mirror_positions=True, opened_at=timezone.now(),
+        )
+
+    def test_exit_before_open_ran_goes_to_close(self):
+        from marketdata.services.jobs import enqueue_admin_trade_apply
+        self.trade.exit_price = Decimal("1.2")
+        self.trade.save()
+        with mock.patch("marketdata.engine.redis_ops.get_redis") as get_redis:
+            get_redis.return_value.scard.return_value = 0  # mirror:{ref} not created yet
+            job, created = enqueue_admin_trade_apply(self.trade.id)
+        self.assertTrue(created)
+        self.assertEqual(job.kind, "admin_trade_mirror_close")
+
+    def test_open_after_exit_opens_nothing(self):
+        from marketdata.services.admin_broadcast_trades import open_mirror_chunk
+        self.trade.exit_price = Decimal("1.2")
+        self.trade.save()
+        with mock.patch("marketdata.engine.redis_ops.get_redis") as get_redis:
+            res = open_mirror_chunk(self.trade.id)
+        self.assertEqual(res, {"opened": 0, "skipped": 0, "last_user_id": 0, "finished": True})
+        get_redis.assert_not_called()
+
+    def test_close_defers_while_the_open_job_is_active(self):
+        from marketdata.services import jobs
+        jobs.enqueue_admin_trade_mirror_open(self.trade.id)
+        close = BackgroundJob(kind="admin_trade_mirror_close", key=f"admin_trade_close:{self.trade.id}",
+                              payload={"trade_id": self.trade.id, "cursor": 0})
+        with mock.patch("marketdata.services.admin_broadcast_trades.close_mirror_page") as page:
+            with self.assertRaises(jobs.Defer) as cm:
+                jobs.close_admin_trade_mirror(close)
+        self.assertEqual(cm.exception.seconds, jobs.CLOSE_DEFER_SECS)
+        page.assert_not_called()
+
+
+class FanoutWatchTests(SimpleTestCase):
+    def _fanout(self, busy_uid, collisions):
+        import redis
+        from marketdata.engine import redis_ops
+
+        calls = []
+
+        def once(r, fills, mode, track):
+            uids = [f["uid"] for f in fills]
+            calls.append(uids)
+            if busy_uid in uids and sum(busy_uid in c for c in calls) <= collisions:
+                raise redis.WatchError
+            return [{"uid": u} for u in uids], [f"ev{u}" for u in uids]
+
+        fills = [{"uid": uid, "position_id": "ref"} for uid in (1, 2, 3)]
+        with mock.patch.object(redis_ops, "get_redis"), \
+                mock.patch.object(redis_ops, "_book_sync") as book, \
+                mock.patch.object(redis_ops, "_fanout_once", once):
+            return redis_ops.apply_fills_fanout(fills), calls, book
+
+    def test_retries_then_splits_by_user(self):
+        from marketdata.engine.redis_ops import FANOUT_WATCH_RETRIES
+
+        results, calls, book = self._fanout(busy_uid=2, collisions=FANOUT_WATCH_RETRIES)
+        self.assertEqual(calls, [[1, 2, 3]] * FANOUT_WATCH_RETRIES + [[1], [2, 3]])
+        self.assertEqual(sorted(res["uid"] for res in results), [1, 2, 3])
+        book.assert_called_once_with(["ev1", "ev2", "ev3"])
+
+    def test_one_user_that_keeps_changing_raises(self):
+        import redis
+        with self.assertRaises(redis.WatchError):
+            self._fanout(busy_uid=2, collisions=100)
+
+
+class AdminTradeApplyTests(TestCase):
+    def setUp(self):
+        from marketdata.models_admintrades import AdminBroadcastTrade, UserTradeGroup
+        self.users = [User.objects.create_user(f"apply_user{i}", password="x") for i in range(3)]
+        UserAccount.objects.filter(user__in=self.users).update(balance=Decimal("1000"))
+        group = UserTradeGroup.objects.create(name="apply_group")
+        group.users.set(self.users)
+        # 0.01 move * 0.1 lot * 100k = 100 per user; margin 0.1 * 100k * 1.1 / 500 = 22
+        self.trade = AdminBroadcastTrade.objects.create(
+            symbol="EURUSD", side="Buy", lots=Decimal("0.1"), entry_price=Decimal("1.1"),
+            exit_price=Decimal("1.11"), status="live", opened_at=timezone.now(),
+        )
+        self.trade.groups.add(group)
+
+    def _assert_booked_once(self, users):
+        from marketdata.models_admintrades import AdminTradeApplication
+        for user in users:
+            self.assertEqual(UserAccount.objects.get(user=user).balance, Decimal("1100"))
+            self.assertEqual(LedgerEntry.objects.filter(user_id=user.id, ref=str(self.trade.ref)).count(), 1)
+            self.assertEqual(ClosedTrade.objects.filter(user_id=user.id).count(), 1)
+            self.assertEqual(AdminTradeApplication.objects.filter(trade=self.trade, user=user).count(), 1)
+
+    def test_rerunning_a_chunk_books_nothing_twice(self):
+        from marketdata.services.admin_broadcast_trades import apply_admin_trade_chunk
+
+        first = apply_admin_trade_chunk(self.trade.id, after_user_id=0, limit=2)
+        self.assertEqual((first["applied"], first["finished"]), (2, False))
+        # the job died before saving its cursor: the same chunk runs again
+        again = apply_admin_trade_chunk(self.trade.id, after_user_id=0, limit=2)
+        self.assertEqual((again["applied"], again["last_user_id"]), (1, self.users[2].id))
+        last = apply_admin_trade_chunk(self.trade.id, after_user_id=0, limit=2)
+        self.assertEqual((last["applied"], last["finished"]), (0, True))
+
+        self._assert_booked_once(self.users)
+        self.trade.refresh_from_db()
+        self.assertEqual(sorted(self.trade.applied_to_user_ids), sorted(u.id for u in self.users))
+
+    def test_user_without_free_margin_is_skipped_and_not_marked(self):
+        from marketdata.models_admintrades import AdminTradeApplication
+        from marketdata.services.admin_broadcast_trades import apply_admin_trade_chunk
+
+        poor = self.users[0]
+        UserAccount.objects.filter(user=poor).update(balance=Decimal("10"))
+        res = apply_admin_trade_chunk(self.trade.id)
+        self.assertEqual((res["applied"], res["skipped"]), (2, 1))
+        self.assertEqual(UserAccount.objects.get(user=poor).balance, Decimal("10"))
+        self.assertFalse(AdminTradeApplication.objects.filter(trade=self.trade, user=poor).exists())
+        self.assertEqual(apply_admin_trade_chunk(self.trade.id)["applied"], 0)
+        self._assert_booked_once(self.users[1:])
+
+    def test_bulk_apply_balance_deltas(self):
+        from marketdata.services.balances import bulk_apply_balance_deltas
+
+        a, b, c = self.users
+        self.assertEqual(bulk_apply_balance_deltas({a.id: Decimal("5.5"), b.id: 0, c.id: "-2"},
+                                                   chunk_size=1), 2)
+        self.assertEqual(
+            [UserAccount.objects.get(user=u).balance for u in self.users],
+            [Decimal("1005.5"), Decimal("1000"), Decimal("998")],
+        )
+        self.assertEqual(bulk_apply_balance_deltas({}), 0)
+
+
+# ---- background jobs (services/jobs.py) ----
+
+class BackgroundJobTests(TestCase):
+    def setUp(self):
+        from marketdata.services import jobs
+        self.jobs = jobs
+
+    def test_enqueue_returns_the_active_job_for_a_key(self):
+        job, created = self.jobs.enqueue("noop", "k1", {"a": 1})
+        again, created_again = self.jobs.enqueue("noop", "k1", {"a": 2})
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(again.id, job.id)
+
+        job.status = "done"
+        job.save()
+        self.assertTrue(self.jobs.enqueue("noop", "k1", {"a": 3})[1])
+
+    def test_defer_requeues_without_using_an_attempt(self):
+        def deferred(job):
+            raise self.jobs.Defer(30, "not yet")
+
+        self.jobs.enqueue("deferred", "k2", {})
+        with mock.patch.dict(self.jobs.HANDLERS, {"deferred": deferred}):
+            job = self.jobs.claim("w1")
+            self.jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error), ("queued", 0, "not yet"))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=20))
+        self.assertIsNone(self.jobs.claim("w1"))  # not runnable before run_after
+
+    def test_failure_retries_after_backoff_then_fails(self):
+        def broken(job):
+            raise RuntimeError("boom")
+
+        job, _ = self.jobs.enqueue("broken", "k3", {})
+        with mock.patch.dict(self.jobs.HANDLERS, {"broken": broken}):
+            for attempt in range(1, self.jobs.MAX_ATTEMPTS + 1):
+                self.jobs.run(self.jobs.claim("w1"))
+                job.refresh_from_db()
+                self.assertEqual(job.attempts, attempt)
+                if attempt < self.jobs.MAX_ATTEMPTS:
+                    self.assertEqual(job.status, "queued")
+                    self.assertIsNone(self.jobs.claim("w1"))  # backing off
+                    BackgroundJob.objects.filter(id=job.id).update(run_after=timezone.now())
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "RuntimeError: boom")
+        self.assertIsNotNone(job.finished_at)
+
+    def test_stale_job_out_of_attempts_is_failed_not_reclaimed(self):
+        job, _ = self.jobs.enqueue("noop", "k4", {})
+        BackgroundJob.objects.filter(id=job.id).update(
+            status="running", worker="dead:1", attempts=self.jobs.MAX_ATTEMPTS,
+            heartbeat_at=timezone.now() - self.jobs.STALE_AFTER - timedelta(seconds=1),
+        )
+        self.assertIsNone(self.jobs.claim("w1"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertIn("dead:1", job.error)
+
+    def test_reclaimed_apply_resumes_after_the_saved_cursor(self):
+        calls = []
+
+        def chunk(trade_id, after_user_id=0):
+            calls.append(after_user_id)
+            if len(calls) == 2:
+                raise RuntimeError("worker killed")
+            return {"applied": 10, "skipped": 0, "last_user_id": after_user_id + 10,
+                    "finished": after_user_id + 10 >= 30}
+
+        job, _ = self.jobs.enqueue("admin_trade_apply", "k5", {"trade_id": 1, "after_user_id": 0})
+        target = "marketdata.services.admin_broadcast_trades."
+        with mock.patch(target + "apply_admin_trade_chunk", chunk), \
+                mock.patch(target + "finish_admin_trade") as finish:
+            self.jobs.run(self.jobs.claim("w1"))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.payload["after_user_id"]), ("queued", 10))
+            BackgroundJob.objects.filter(id=job.id).update(run_after=None)
+            self.jobs.run(self.jobs.claim("w2"))
+
+        job.refresh_from_db()
+        self.assertEqual(calls, [0, 10, 10, 20])
+        self.assertEqual((job.status, job.result["applied"], job.progress_done), ("done", 30, 30))
+        finish.assert_called_once_with(1)
+
+
+# ---- point-in-time balances (services/balances.py, BalanceAtView) ----
+
+class BalanceCheckpointTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("cp_user", password="x")
+        self.t0 = timezone.now() - timedelta(days=3)
+        for day, kind, amount in ((1, "deposit", "50"), (2, " Fee", "5")):
+            LedgerEntry.objects.create(user_id=self.user.id, kind=kind, amount=Decimal(amount),
+                                       ts=self.t0 + timedelta(days=day))
+        # 100 of capital predates the ledger
+        UserAccount.objects.filter(user=self.user).update(balance=Decimal("145"))
+
+    def _checkpoint(self):
+        from marketdata.services.balances import checkpoint_users
+        return checkpoint_users([self.user.id], LedgerEntry.objects.order_by("-id").first().id)
+
+    def test_no_balance_before_the_first_checkpoint(self):
+        from marketdata.services.balances import balance_at, ledger_balances
+        self.assertIsNone(balance_at(self.user.id, timezone.now()))
+        self.assertEqual(ledger_balances([self.user.id]), {self.user.id: None})
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        resp = client.get("/api/balance_at", {"at": timezone.now().isoformat()})
+        self.assertEqual(resp.status_code, 409)
+
+    def test_balance_at_uses_checkpoint_plus_tail(self):
+        from marketdata.models import BalanceCheckpoint
+        from marketdata.services.balances import balance_at, ledger_balances
+
+        self.assertEqual(self._checkpoint(), 2)  # opening row + one at the last entry
+        self.assertEqual(BalanceCheckpoint.objects.get(user_id=self.user.id, ledger_id=0).balance,
+                         Decimal("100"))
+        LedgerEntry.objects.create(user_id=self.user.id, kind="withdrawal", amount=Decimal("20"),
+                                   ts=self.t0 + timedelta(days=3))
+
+        for day, expected in ((0, "100"), (1, "150"), (2, "145"), (3, "125")):
+            at = self.t0 + timedelta(days=day, hours=1)
+            self.assertEqual(balance_at(self.user.id, at), Decimal(expected))
+        self.assertEqual(ledger_balances([self.user.id]), {self.user.id: Decimal("125")})
+        self.assertEqual(self._checkpoint(), 1)
+
+    def test_view(self):
+        self._checkpoint()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        resp = client.get("/api/balance_at", {"at": (self.t0 + timedelta(days=1, hours=1)).isoformat()})
+        self.assertEqual((resp.status_code, resp.data["balance"]), (200, 150.0))
+        for bad in ("yesterday", "2024-02-30T00:00:00"):
+            self.assertEqual(client.get("/api/balance_at", {"at": bad}).status_code, 400)
+
+
+# ---- account reconciliation (reconcile_accounts) ----
+
+class ReconcileAccountsTests(TestCase):
+    def setUp(self):
+        from marketdata.management.commands.reconcile_accounts import Command
+        from marketdata.services.balances import checkpoint_users
+
+        self.cmd = Command()
+        self.user = User.objects.create_user("recon_user", password="x")
+        entry = LedgerEntry.objects.create(user_id=self.user.id, kind="deposit", amount=Decimal("50"))
+        UserAccount.objects.filter(user=self.user).update(balance=Decimal("150"))
+        checkpoint_users([self.user.id], entry.id)
+        # drift: a balance write that no ledger row explains
+        UserAccount.objects.filter(user=self.user).update(balance=Decimal("140"))
+
+    def _check(self, repair=False, repair_balance=False):
+        p = mock.MagicMock()
+        # posidx, then each position's net_lots/margin/unreal_pnl; p2 is gone from Redis
+        p.execute.side_effect = [[["p1", "p2"]], [["1", "22", "5"], [None, None, None]]]
+        with mock.patch("marketdata.management.commands.reconcile_accounts.get_redis") as get_redis:
+            get_redis.return_value.pipeline.return_value.__enter__.return_value = p
+            _n, issues, repaired = self.cmd._check_batch_inner(
+                [self.user.id], Decimal("0.01"), repair, repair_balance)
+        return issues, repaired, p
+
+    def test_reports_without_repairing(self):
+        issues, repaired, p = self._check()
+        self.assertEqual(sorted(i["field"] for i in issues),
+                         ["balance", "posidx", "unrealized_pnl", "used_margin"])
+        self.assertEqual(repaired, 0)
+        p.srem.assert_not_called()
+        acc = UserAccount.objects.get(user=self.user)
+        self.assertEqual((acc.balance, acc.used_margin), (Decimal("140"), Decimal("0")))
+
+    def test_repair(self):
+        issues, repaired, p = self._check(repair=True, repair_balance=True)
+        self.assertEqual(repaired, 3)  # totals, stale index entry, balance
+        p.srem.assert_called_once_with(f"posidx:{self.user.id}", "p2")
+        acc = UserAccount.objects.get(user=self.user)
+        self.assertEqual((acc.balance, acc.used_margin, acc.unrealized_pnl),
+                         (Decimal("150"), Decimal("22"), Decimal("5")))
+
+
+# ---- bulk ledger deletion (LedgerEntryQuerySet.delete_with_reversal) ----
+
+class LedgerReversalTests(TestCase):
+    ROWS = (("Withdrawal", "10"), ("fee ", "5"), ("deposit", "20"), ("realized_pnl", "-3"))
+
+    def _account(self, name):
+        user = User.objects.create_user(name, password="x")
+        UserAccount.objects.filter(user=user).update(balance=Decimal("100"))
+        for kind, amount in self.ROWS:
+            LedgerEntry.objects.create(user_id=user.id, kind=kind, amount=Decimal(amount))
+        return user
+
+    def test_bulk_matches_single_row_deletes(self):
+        bulk, single = self._account("bulk_user"), self._account("single_user")
+
+        self.assertEqual(LedgerEntry.objects.filter(user_id=bulk.id).delete_with_reversal(chunk_size=2), 4)
+        for entry in LedgerEntry.objects.filter(user_id=single.id):
+            entry.delete()  # pre_delete signal
+
+        # 100 + 10 (withdrawal) + 5 (fee) - 20 (deposit) + 3 (loss)
+        expected = Decimal("98")
+        self.assertEqual(UserAccount.objects.get(user=bulk).balance, expected)
+        self.assertEqual(UserAccount.objects.get(user=single).balance, expected)
+        self.assertFalse(LedgerEntry.objects.filter(user_id=bulk.id).exists())
+
+    def test_drops_checkpoints_after_first_deleted_row(self):
+        user = self._account("checkpoint_user")
+        first, *rest = LedgerEntry.objects.filter(user_id=user.id).order_by("id")
+        now = timezone.now()
+        BalanceCheckpoint.objects.create(user_id=user.id, ledger_id=0, ts=now, balance=0)
+        BalanceCheckpoint.objects.create(user_id=user.id, ledger_id=rest[-1].id, ts=now, balance=1)
+
+        LedgerEntry.objects.filter(id__in=[r.id for r in rest]).delete_with_reversal()
+        self.assertEqual(list(BalanceCheckpoint.objects.filter(user_id=user.id)
+                              .values_list("ledger_id", flat=True)), [0])
+
+
+# ---- per-loop async Redis clients (engine/redis_async.py) ----
+
+class AsyncRedisClientTests(SimpleTestCase):
+    def test_one_client_per_loop_released_with_the_loop(self):
+        import asyncio
+        import gc
+        from marketdata.engine import redis_async
+
+        async def client():
+            return redis_async.get_async_redis()
+
+        with mock.patch.object(redis_async, "_clients", redis_async.weakref.WeakKeyDictionary()):
+            loop = asyncio.new_event_loop()
+            first = loop.run_until_complete(client())
+            self.assertIs(loop.run_until_complete(client()), first)
+            other = asyncio.new_event_loop()
+            self.assertIsNot(other.run_until_complete(client()), first)
+            other.close()
+            del other
+            gc.collect()
+            self.assertEqual(list(redis_async._clients), [loop])
+            loop.close()
+
+
+# ---- capital stream (engine/capital.py, streams/user_ws.py) ----
+
+class CapitalStreamTests(SimpleTestCase):
+    def test_view_derives_equity_and_free_margin(self):
+        from marketdata.engine.capital import capital_view
+        self.assertEqual(capital_view("1000", "200", "-50"), {
+            "balance": 1000.0, "equity": 950.0, "used_margin": 200.0, "free_margin": 750.0,
+            "unrealized_pnl": -50.0,
+        })
+        self.assertEqual(capital_view(None, None, None)["equity"], 0.0)
+
+    def test_delta_holds_changed_fields_only(self):
+        from marketdata.engine.capital import capital_delta, capital_view
+        before = capital_view(1000, 200, -50)
+        self.assertEqual(capital_delta(None, before), before)
+        self.assertEqual(capital_delta(before, capital_view(1000, 200, -50.0000001)), {})
+        self.assertEqual(capital_delta(before, capital_view(1000, 200, -40)),
+                         {"equity": 960.0, "free_margin": 760.0, "unrealized_pnl": -40.0})
+
+    def test_snapshot_prefers_hot_risk_state(self):
+        from asgiref.sync import async_to_sync
+        from marketdata.engine.capital import capital_view
+        from marketdata.streams import user_ws
+
+        hot, db = capital_view(1100, 0, 0), capital_view(1000, 0, 0)
+        with mock.patch.object(user_ws, "_db_capital", mock.AsyncMock(return_value=db)) as from_db:
+            with mock.patch.object(user_ws, "capital_snapshot", mock.AsyncMock(return_value=(7, hot))):
+                self.assertEqual(async_to_sync(user_ws._capital_snapshot)("1"), (7, hot))
+            from_db.assert_not_called()
+            # risk:{uid} not seeded: fall back to UserAccount, keep the sequence
+            with mock.patch.object(user_ws, "capital_snapshot", mock.AsyncMock(return_value=(7, None))):
+                self.assertEqual(async_to_sync(user_ws._capital_snapshot)("1"), (7, db))
+
+    def test_legacy_consumer_merges_updates_into_full_objects(self):
+        from asgiref.sync import async_to_sync
+        from marketdata.engine.capital import capital_view
+        from marketdata.streams.user_ws import CapitalConsumer
+
+        consumer = CapitalConsumer()
+        consumer.capital = capital_view(1000, 200, -50)
+        consumer.send_json = mock.AsyncMock()
+        async_to_sync(consumer.capital_update)({"seq": 3, "capital": {"unrealized_pnl": -40.0}})
+        sent = consumer.send_json.call_args[0][0]
+        self.assertEqual((sent["type"], sent["balance"], sent["unrealized_pnl"]), ("capital", 1000.0, -40.0))
+
+
+# ---- positions_update frame encoding (streams/position_frames.py) ----
+
+def _pos(pid="p1", mark=1.1, pnl=0.0, net=1.0, ts=1):
+    return {"id": pid, "symbol": "EURUSD", "side": "Buy", "net_lots": net, "open_price": 1.1,
+            "open_time": 1, "mark": mark, "unreal_pnl": pnl, "margin": 22.0, "ts": ts}
+
+
+class PositionFrameEncoderTests(SimpleTestCase):
+    def test_full_passes_through(self):
+        from marketdata.streams.position_frames import PositionFrameEncoder
+        enc = PositionFrameEncoder("bogus")
+        self.assertEqual(enc.encoding, "full")
+        self.assertEqual(enc.encode(_pos()), [{"type": "positions_update", "data": _pos()}])
+
+    def test_delta_sends_meta_then_changed_fields(self):
+        from marketdata.streams.position_frames import PositionFrameEncoder
+        enc = PositionFrameEncoder("delta")
+        first = enc.encode(_pos())
+        self.assertEqual(first[0]["type"], "position_meta")
+        self.assertEqual(first[0]["data"]["symbol"], "EURUSD")
+
+        self.assertEqual(enc.encode(_pos(mark=1.2, pnl=10.0, ts=2)), [
+            {"type": "positions_update", "data": {"id": "p1", "mark": 1.2, "unreal_pnl": 10.0, "ts": 2}},
+        ])
+        self.assertEqual(enc.encode(_pos(mark=1.2, pnl=10.0, ts=2)), [])
+        # a size change re-sends the static part
+        self.assertEqual(enc.encode(_pos(net=2.0, mark=1.2, pnl=10.0, ts=3))[0]["type"], "position_meta")
+
+    def test_tuple_uses_handles_and_nulls(self):
+        from marketdata.streams.position_frames import PositionFrameEncoder
+        enc = PositionFrameEncoder("tuple")
+        self.assertEqual(enc.encode(_pos("a"))[0]["data"]["k"], 1)
+        self.assertEqual(enc.encode(_pos("b"))[0]["data"]["k"], 2)
+        self.assertEqual(enc.encode(_pos("b", mark=1.3, ts=5)), [{"t": "p", "d": [2, 1.3, None, None, 5]}])
+
+    def test_seed_and_passthrough(self):
+        from marketdata.streams.position_frames import PositionFrameEncoder
+        enc = PositionFrameEncoder("tuple")
+        seeded = enc.seed([_pos("a")])
+        self.assertEqual(seeded[0]["k"], 1)
+        self.assertEqual(enc.encode(_pos("a")), [])
+        batch = {"batch": True, "position_ids": ["a"]}
+        self.assertEqual(enc.encode(batch), [{"type": "positions_update", "data": batch}])
+
+        enc.reset("delta")
+        self.assertEqual(enc.encode(_pos("a"))[0]["type"], "position_meta")
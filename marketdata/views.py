@@ -1,7 +1,4 @@
 # backend/marketdata/views.py
-from operator import le
-import os, json
-import requests
 from django.http import JsonResponse
 from django.views.decorators.http import require_GET
 from django.conf import settings
@@ -9,12 +6,12 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_GET
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.generics import ListAPIView
 from .serializers import OrderSerializer, FillSerializer
 from .models import Order, Fill
 from decimal import Decimal
-from marketdata.engine.margin_utils import validate_order
+from marketdata.engine.margin_utils import check_order_margin
 from marketdata.contracts import spec_for
 from marketdata.models import UserAccount, WithdrawalRequest
 from django.db import transaction
@@ -30,11 +27,20 @@ from django.db.models import F, Window
 from django.db.models.functions import RowNumber
 from .serializers import ClosedTradeSerializer
 from django.db.models import Sum, Max, F
-from .models import Order, Fill, LedgerEntry
+from .models import Order, Fill, LedgerEntry, ClosedTrade
 from .serializers import OrderSerializer, FillSerializer
 from .contracts import SPECS
-from .engine.redis_ops import positions_snapshot, get_redis
-from .engine.positions import on_fill
+from .engine.redis_ops import (
+    positions_snapshot, positions_delta, positions_etag, positions_for_symbol, get_redis,
+)
+from .engine.positions import on_fill, submit_orders, close_positions
+from redis.exceptions import WatchError
+from .engine import idempotency
+from .pagination import KeysetPagination, filter_history
+from .services.klines import fetch_klines, INTERVAL_TTL, DEFAULT_TTL
+from .history.candle_store import get_series, is_contiguous, is_fresh, is_valid_series, to_rows
+from .history.tick_store import read_ticks
+from .streams.candles import INTERVAL_SECONDS
 from marketdata.serializers import (
     WithdrawalRequestCreateSerializer,
     WithdrawalRequestListSerializer,
@@ -50,45 +56,24 @@ def candles(request):
     symbol = request.GET.get("symbol", "EURUSD")
     interval = request.GET.get("interval", "1m")
     limit = int(request.GET.get("limit", "200"))
+    if not is_valid_series(symbol, interval):
+        return JsonResponse({"error": "unknown symbol or interval"}, status=400)
 
-    # Map interval to Alltick kline_type
-    interval_map = {
-        "1m": 1, "5m": 2, "15m": 3, "30m": 4,
-        "1h": 5, "4h": 6, "1d": 7
-    }
-    kline_type = interval_map.get(interval, 1)
-
-    query = {
-        "trace": "candles_req",
-        "data": {
-            "code": symbol,
-            "kline_type": kline_type,
-            "kline_timestamp_end": 0,
-            "query_kline_num": limit,
-            "adjust_type": 0
-        }
-    }
-
-    url = f"{settings.ALLTICK_BASE_REST}/kline?token={settings.ALLTICK_API_KEY}&query=" \
-          + requests.utils.quote(json.dumps(query))
+    # Serve from the local columnar history while it is being kept current and
+    # has no hole (feed downtime, market close) in the requested window
+    use_store = getattr(settings, "CANDLE_STORE_ENABLED", True)
+    if use_store:
+        series = get_series(symbol, interval)
+        if len(series) >= limit and is_fresh(series, INTERVAL_TTL.get(interval, DEFAULT_TTL)):
+            tail = series.tail(limit)
+            if is_contiguous(tail, INTERVAL_SECONDS[interval]):
+                return JsonResponse(to_rows(tail), safe=False)
 
-    r = requests.get(url, timeout=10)
-    j = r.json()
+    # Cached + coalesced upstream fetch (see services/klines.py)
+    candles = fetch_klines(symbol, interval, limit)
 
-    # Get candle list
-    kline_list = j.get("data", {}).get("kline_list", [])
-
-    candles = [
-        {
-            "time": int(item["timestamp"]),  # already seconds
-            "open": float(item["open_price"]),
-            "high": float(item["high_price"]),
-            "low": float(item["low_price"]),
-            "close": float(item["close_price"]),
-            "volume": float(item.get("volume", 0)),
-        }
-        for item in kline_list
-    ]
+    if use_store:
+        series.append(candles)
 
     return JsonResponse(candles, safe=False)
 
@@ -114,72 +99,168 @@ def symbols(request):
     return JsonResponse(data)
 
 
+class TickRangeView(APIView):
+    """
+    GET /api/ticks?symbol=EURUSD&start=<ms>&end=<ms>&limit=10000
+    Recorded ticks for audits and disputes (staff only).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        symbol = (request.query_params.get("symbol") or "").upper()
+        try:
+            start = int(request.query_params["start"])
+            end = int(request.query_params["end"])
+            limit = min(int(request.query_params.get("limit", 10000)), 100000)
+        except (KeyError, ValueError):
+            return Response({"error": "symbol, start and end (ms) required"}, status=400)
+        if not symbol or end < start:
+            return Response({"error": "invalid range"}, status=400)
+        return Response(read_ticks(symbol, start, end, limit=limit))
+
+
 class PositionsSnapshotView(APIView):
+    """
+    GET /api/positions/snapshot            -> full list, ETag = "<position version>.<last mark time>"
+    GET /api/positions/snapshot?since=<v>  -> {version, full, positions, closed} changed after v
+    If-None-Match with the current ETag    -> 304
+    The version moves on opens, closes and size changes only, so ?since= deltas
+    leave out re-marked positions (mark, unreal_pnl and margin stay live on the
+    stream); the ETag also moves with every mark, so a 304 never hides new P&L.
+    """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        snap = positions_snapshot(request.user.id)
-        return Response(snap)
+        uid = request.user.id
+        etag = positions_etag(uid)
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        since = request.query_params.get("since")
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response({"error": "since must be an integer version"}, status=400)
+            delta = positions_delta(uid, since)
+            return Response(delta, headers={"ETag": positions_etag(uid, delta["version"])})
+
+        snap = positions_snapshot(uid)
+        return Response(snap, headers={"ETag": etag})
 
 
 class SimFillView(APIView):
     """
     Temporary endpoint to simulate an executed fill and update Redis hot state.
+
+    Send `client_id` in the body (or an `Idempotency-Key` header) to make retries
+    safe: a repeated key returns the original response without re-applying the fill.
     """
     permission_classes = [IsAuthenticated]
 
-    @transaction.atomic
     def post(self, request):
         payload = request.data or {}
+        uid = request.user.id
+        client_id = payload.get("client_id") or request.headers.get("Idempotency-Key")
+        if client_id:
+            client_id = str(client_id)[:64]
+            state, cached = idempotency.claim(uid, client_id)
+            if state == "done":
+                return Response(cached["body"], status=cached["status"],
+                                headers={"Idempotent-Replayed": "true"})
+            if state == "pending":
+                return Response({"error": "a request with this client_id is still in progress"},
+                                status=409)
+
+        applied = []  # response body once the fill is in Redis
+        try:
+            resp = self._fill(uid, payload, client_id, applied.append)
+        except Exception:
+            if client_id:
+                if applied:
+                    # the fill is applied: a retry must replay it, not apply it again
+                    idempotency.complete(uid, client_id, 200, applied[0])
+                else:
+                    idempotency.release(uid, client_id)
+            raise
+
+        if client_id:
+            if 200 <= resp.status_code < 300:
+                idempotency.complete(uid, client_id, resp.status_code, resp.data)
+            else:
+                idempotency.release(uid, client_id)  # rejected: let the client fix and retry
+        return resp
+
+    def _fill(self, uid, payload, client_id, on_applied):
         symbol = payload.get("symbol")
         side = payload.get("side")
         lots = float(payload.get("lots", 0))
         price = float(payload.get("price", 0))
         leverage = int(payload.get("leverage", 500))
-        print("Levergae ", leverage)
         if not symbol or side not in ("Buy", "Sell") or lots <= 0 or price <= 0:
             return Response({"error": "invalid payload"}, status=400)
 
-        # Your logic inside atomic transaction so that select_for_update can work correctly
-        res = on_fill(request.user.id, symbol, side, lots, price, leverage=leverage)
-        
-        return Response({
+        # Redis only; the database rows are written by run_fill_persister
+        res = on_fill(uid, symbol, side, lots, price, leverage=leverage, client_id=client_id,
+                      on_applied=lambda res: on_applied(self._body(symbol, side, lots, price, client_id, res)))
+        if isinstance(res, Response):
+            return res  # rejected by the margin check
+        return Response(self._body(symbol, side, lots, price, client_id, res))
+
+    @staticmethod
+    def _body(symbol, side, lots, price, client_id, res):
+        return {
             "ok": True,
             "symbol": symbol,
             "side": side,
             "lots": lots,
             "price": price,
+            "client_id": client_id,
             "position": {
+                "id": res.get("position_id"),
                 "net_lots": res.get("new_net", 0),
                 "avg_entry": res.get("new_avg", 0),
                 "realized_pnl": res.get("realized", 0),
                 "updated_at": res.get("updated_at", 0),
             }
-        })
+        }
 
 
 class ClosePositionView(APIView):
+    """
+    POST /api/positions/close {symbol, lots?, all?}
+    Closes (or partially closes) one open position on the symbol at the latest mark;
+    with all=true closes every position on that symbol.
+    """
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        symbol = request.data.get("symbol")
+        symbol = (request.data.get("symbol") or "").upper()
         lots_req = request.data.get("lots")  # optional for partial close
+        close_all = str(request.data.get("all", "")).lower() in ("1", "true")
         if not symbol:
             return Response({"error": "symbol required"}, status=400)
 
-        snap = positions_snapshot(request.user.id)
-        matching_positions = [p for p in snap if p.get("symbol") == symbol and abs(float(p.get("net_lots", 0))) > 0]
+        # Only this user's positions on this symbol (userpos index), one pipelined read
+        matching_positions = positions_for_symbol(request.user.id, symbol)
         if not matching_positions:
             return Response({"error": "no open position"}, status=400)
 
+        # use latest mark as close price
+        r = get_redis()
+        mk = r.get(f"mark:{symbol}")
+        if mk is None:
+            return Response({"error": "no mark price available"}, status=503)
+        price = float(mk)
+
+        if close_all:
+            results, _ = close_positions(request.user.id, symbol)
+            return Response({"ok": True, "symbol": symbol, "price": price,
+                             "closed": _closed_rows(results)})
+
         # If you want to always close the largest, just pick the first
         pos = matching_positions[0]
-        if not pos:
-            return Response({"error": "no open position"}, status=400)
-
         net = float(pos.get("net_lots", 0))
-        if abs(net) < 1e-12:
-            return Response({"error": "already flat"}, status=400)
 
         # determine close size and side
         close_lots = float(lots_req) if lots_req else abs(net)
@@ -187,17 +268,14 @@ class ClosePositionView(APIView):
             return Response({"error": "invalid lots"}, status=400)
         side = "Sell" if net > 0 else "Buy"
 
-        # use latest mark as close price
-        r = get_redis()
-        mk = r.get(f"mark:{symbol}")
-        if mk is None:
-            return Response({"error": "no mark price available"}, status=503)
-        price = float(mk)
-
-        res = on_fill(request.user.id, symbol, side, close_lots, price)
+        res = on_fill(request.user.id, symbol, side, close_lots, price,
+                      leverage=int(pos.get("leverage") or 500), position_id=pos["id"])
+        if isinstance(res, Response):
+            return res
         return Response({
             "ok": True,
             "symbol": symbol,
+            "position_id": pos["id"],
             "closed_lots": close_lots,
             "side": side,
             "price": price,
@@ -210,21 +288,150 @@ class ClosePositionView(APIView):
         })
 
 
+def _closed_rows(results):
+    return [{
+        "position_id": res["position_id"],
+        "symbol": res["symbol"],
+        "closed_lots": abs(res["fill_lots"]),
+        "side": "Sell" if res["fill_lots"] < 0 else "Buy",
+        "realized_pnl": res["realized"],
+    } for res in results]
+
+
+class CloseAllPositionsView(APIView):
+    """
+    POST /api/positions/close_all {symbol?}
+    Closes every open position (or every position on `symbol`) at the latest
+    marks in one batch. Symbols without a mark are left open and listed in `skipped`.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        symbol = (request.data.get("symbol") or "").upper() or None
+        try:
+            results, skipped = close_positions(request.user.id, symbol)
+        except WatchError:
+            return Response({"error": "positions changed while closing, retry"}, status=409)
+        return Response({
+            "ok": True,
+            "closed": _closed_rows(results),
+            "realized_pnl": sum(float(res["realized"] or 0) for res in results),
+            "skipped": skipped,
+        })
+
+
+BULK_ORDER_MAX = 100
+
+
+class BulkOrderView(APIView):
+    """
+    POST /api/orders/bulk {orders: [{symbol, side, lots, price, leverage?, client_id?}, ...]}
+    Validates all orders, reserves their total margin once and fills them in one
+    batch; either every order fills or none does. An Idempotency-Key header makes
+    the whole batch safe to retry.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        uid = request.user.id
+        key = request.headers.get("Idempotency-Key")
+        if key:
+            key = "bulk:" + key[:58]
+            state, cached = idempotency.claim(uid, key)
+            if state == "done":
+                return Response(cached["body"], status=cached["status"],
+                                headers={"Idempotent-Replayed": "true"})
+            if state == "pending":
+                return Response({"error": "a request with this Idempotency-Key is still in progress"},
+                                status=409)
+        applied = []
+        try:
+            resp = self._submit(uid, request.data.get("orders"), applied.append)
+        except Exception:
+            if key:
+                if applied:
+                    idempotency.complete(uid, key, 200, applied[0])  # filled: never re-apply on retry
+                else:
+                    idempotency.release(uid, key)
+            raise
+        if key:
+            if 200 <= resp.status_code < 300:
+                idempotency.complete(uid, key, resp.status_code, resp.data)
+            else:
+                idempotency.release(uid, key)
+        return resp
+
+    def _submit(self, uid, raw, on_applied):
+        if not isinstance(raw, list) or not raw:
+            return Response({"error": "orders must be a non-empty list"}, status=400)
+        if len(raw) > BULK_ORDER_MAX:
+            return Response({"error": f"at most {BULK_ORDER_MAX} orders per request"}, status=400)
+
+        orders = []
+        for i, o in enumerate(raw):
+            try:
+                symbol = str(o.get("symbol") or "").upper()
+                side = o.get("side")
+                lots = float(o.get("lots", 0))
+                price = float(o.get("price", 0))
+                leverage = int(o.get("leverage", 500))
+                spec_for(symbol)
+            except (AttributeError, TypeError, ValueError, KeyError):
+                return Response({"error": "invalid order", "index": i}, status=400)
+            if side not in ("Buy", "Sell") or lots <= 0 or price <= 0 or leverage <= 0:
+                return Response({"error": "invalid order", "index": i}, status=400)
+            client_id = o.get("client_id")
+            orders.append({"symbol": symbol, "side": side, "lots": lots, "price": price,
+                           "leverage": leverage, "client_id": str(client_id)[:64] if client_id else None})
+
+        try:
+            results = submit_orders(uid, orders,
+                                    on_applied=lambda results: on_applied(self._body(orders, results)))
+        except WatchError:
+            return Response({"error": "positions changed while filling, retry"}, status=409)
+        if isinstance(results, Response):
+            return results  # rejected by the margin check
+        return Response(self._body(orders, results))
+
+    @staticmethod
+    def _body(orders, results):
+        return {
+            "ok": True,
+            "orders": [{
+                "client_id": o["client_id"],
+                "symbol": res["symbol"],
+                "side": o["side"],
+                "lots": o["lots"],
+                "price": o["price"],
+                "position": {
+                    "id": res["position_id"],
+                    "net_lots": res["new_net"],
+                    "avg_entry": res["new_avg"],
+                    "updated_at": res["updated_at"],
+                },
+            } for o, res in zip(orders, results)],
+        }
+
+
 class OrderListView(ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
+    keyset_field = "created_at"
+
     def get_queryset(self):
-        qs = Order.objects.filter(user_id=self.request.user.id).order_by("-created_at")
-        symbol = self.request.query_params.get("symbol")
-        return qs.filter(symbol=symbol) if symbol else qs
+        qs = Order.objects.filter(user_id=self.request.user.id)
+        return filter_history(qs, self.request, self.keyset_field)
 
 class FillListView(ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FillSerializer
+    pagination_class = KeysetPagination
+    keyset_field = "ts"
+
     def get_queryset(self):
-        qs = Fill.objects.filter(user_id=self.request.user.id).order_by("-ts")
-        symbol = self.request.query_params.get("symbol")
-        return qs.filter(symbol=symbol) if symbol else qs
+        qs = Fill.objects.filter(user_id=self.request.user.id)
+        return filter_history(qs, self.request, self.keyset_field)
 
 
 class MarginCheckView(APIView):
@@ -235,17 +442,14 @@ class MarginCheckView(APIView):
         lots = Decimal(request.data.get("lots", "0"))
         price = Decimal(request.data.get("price", "0"))
 
-        try:
-            # Fetch the UserAccount explicitly
-            account = UserAccount.objects.get(user=request.user)
-        except UserAccount.DoesNotExist:
-            return Response({"ok": False, "error": "User account not found."}, status=400)
-
         # You may want to get leverage from request or from account if exists
         leverage = int(request.data.get("leverage", 500))  # Default leverage if none provided
 
         spec = spec_for(symbol)
-        result = validate_order(account, lots, price, spec.contract_size, leverage)
+        # Checked against the Redis risk state (same numbers the order path reserves against)
+        result = check_order_margin(request.user.id, lots, price, spec.contract_size, leverage)
+        if not result["ok"] and result["error"] == "User account not found.":
+            return Response(result, status=400)
         return Response(result)
 
 
@@ -283,42 +487,60 @@ class CapitalView(APIView):
             return Response({"error": "User account not found"}, status=404)
 
 
+class BalanceAtView(APIView):
+    """
+    GET /api/balance_at?at=<ISO datetime>
+    Ledger balance as of `at`: nearest checkpoint plus the ledger rows after it.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        from datetime import timezone as dt_timezone
+        from django.utils.dateparse import parse_datetime
+        from marketdata.services.balances import balance_at
+
+        try:
+            at = parse_datetime(request.query_params.get("at") or "")
+        except ValueError:  # well formed but impossible, e.g. Feb 30
+            at = None
+        if at is None:
+            return Response({"error": "at must be an ISO datetime"}, status=400)
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=dt_timezone.utc)
+        balance = balance_at(request.user.id, at)
+        if balance is None:
+            return Response({"error": "balance history is not available yet for this account"},
+                            status=409)
+        return Response({"at": at.isoformat(), "balance": float(balance)})
+
+
 class OrderHistoryView(generics.ListAPIView):
     serializer_class = ClosedTradeSerializer
     permission_classes = [permissions.IsAuthenticated]
-
+    pagination_class = KeysetPagination
+    keyset_field = "closed_at"
 
     def get_queryset(self):
         uid = self.request.user.id
-        return (
-            LedgerEntry.objects
-            .filter(user_id=uid, kind="realized_pnl")
-            .exclude(ref__isnull=True).exclude(ref="")
-            .values("ref", "symbol")
-            .annotate(
-                realized=Sum("amount"),  # sum realized PnL
-                last_ts=Max("ts"),       # <-- use ts, not created_at
-            )
-            .order_by("-last_ts")
-        )
+        return filter_history(ClosedTrade.objects.filter(user_id=uid), self.request, self.keyset_field)
 
 
 class OrderHistoryLastFillView(ListAPIView):
+    """Closing fill of each closed position, newest first."""
     permission_classes = [IsAuthenticated]
     serializer_class = FillSerializer
+    pagination_class = KeysetPagination
+    keyset_field = "ts"
 
     def get_queryset(self):
-        from django.db.models import Window
-        from django.db.models.functions import RowNumber
         uid = self.request.user.id
-        return (
+        qs = (
             Fill.objects
-            .filter(user_id=uid, order__position_id__isnull=False)
-            .annotate(
-                pos_id=F("order__position_id"),
-                rn=Window(RowNumber(), partition_by=[F("order__position_id")], order_by=F("ts").desc()),
-            ).filter(rn=1).order_by("-ts")
+            .filter(user_id=uid, id__in=ClosedTrade.objects.filter(user_id=uid, close_fill_id__isnull=False)
+                    .values("close_fill_id"))
+            .annotate(pos_id=F("order__position_id"))
         )
+        return filter_history(qs, self.request, self.keyset_field)
 
 
 class WithdrawalViewSet(